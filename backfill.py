@@ -0,0 +1,711 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Personal Weather Station
+#
+# Author: Xorfor
+#
+
+"""
+Load a CSV export of the station (SD card of the console, or the export of the
+Ecowitt cloud) into the history of the devices of the plugin.
+
+Stop Domoticz and make a backup of the database before the import:
+
+    sudo service domoticz.sh stop
+    cp domoticz.db domoticz.db.bak
+    python3 backfill.py --database domoticz.db --hardware 5 export.csv
+    sudo service domoticz.sh start
+
+The file is read in chunks, so the memory use does not depend on its size. The
+rows must be in chronological order. For every day the minimum, maximum and
+mean are added to the day history (the *_Calendar tables) of the temperature,
+humidity, wind, UV and rain devices, unless the day is already there. The rows
+of the last --short-days days are also added to the short log, 1 per 5 minutes.
+"""
+
+import argparse
+import csv
+import datetime
+import itertools
+import re
+import sqlite3
+import sys
+import time
+from converters import (
+    temperature_f2iso,
+    speed_kmh2iso,
+    speed_mph2iso,
+    speed_knots2iso,
+    pressure_inches2iso,
+    pressure_mmhg2iso,
+    distance_inch2mm,
+    dew_point_batch,
+    wind_chill_batch,
+    heat_index_batch,
+    round_decimals,
+)
+
+# Units of the devices, see unit in plugin.py
+TEMP_IND = 1
+THB = 2
+HUMIDITY = 3
+WIND1 = 4
+TEMP_HUM = 5
+RAIN = 6
+UVI = 8
+DEWPOINT = 9
+WIND2 = 10
+CHILL = 11
+TEMP = 14
+HUMIDITY_IND = 15
+HEAT_INDEX = 24
+HEAT_INDEX_IN = 27
+
+STATION_UNITS = 64
+
+CHUNK = 10000
+SHORT_LOG_INTERVAL = 300
+
+# Column name (lower case, without the unit): field
+COLUMNS = {
+    "outdoor temperature": "temp",
+    "outdoor temp": "temp",
+    "temperature": "temp",
+    "indoor temperature": "tempin",
+    "indoor temp": "tempin",
+    "outdoor humidity": "humidity",
+    "humidity": "humidity",
+    "indoor humidity": "humidityin",
+    "dew point": "dewpt",
+    "dewpoint": "dewpt",
+    "windchill": "windchill",
+    "wind chill": "windchill",
+    "wind": "windspeedms",
+    "wind speed": "windspeedms",
+    "gust": "windgustms",
+    "wind gust": "windgustms",
+    "wind direction": "winddir",
+    "rel pressure": "baromrel",
+    "relative pressure": "baromrel",
+    "uvi": "uv",
+    "uv": "uv",
+    "rain rate": "rainmm",
+    "hourly rain rate": "rainmm",
+    "daily rain": "dailyrainmm",
+}
+TIME_COLUMNS = {"time", "date", "datetime", "date/time"}
+TIME_FORMATS = (
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y/%m/%d %H:%M",
+    "%d/%m/%Y %H:%M:%S",
+    "%d/%m/%Y %H:%M",
+)
+
+# Unit of a column (lower case): conversion to the unit of the plugin
+UNITS = {
+    "": None,
+    "%": None,
+    "°": None,
+    "℃": None,
+    "°c": None,
+    "c": None,
+    "℉": temperature_f2iso,
+    "°f": temperature_f2iso,
+    "f": temperature_f2iso,
+    "m/s": None,
+    "km/h": speed_kmh2iso,
+    "mph": speed_mph2iso,
+    "knots": speed_knots2iso,
+    "kn": speed_knots2iso,
+    "hpa": None,
+    "mbar": None,
+    "inhg": pressure_inches2iso,
+    "mmhg": pressure_mmhg2iso,
+    "mm": None,
+    "mm/h": None,
+    "mm/hr": None,
+    "in": distance_inch2mm,
+    "in/h": distance_inch2mm,
+    "in/hr": distance_inch2mm,
+}
+
+# Precision of the fields, as decoded by the plugin
+PRECISION = {
+    "temp": 1,
+    "tempin": 1,
+    "humidity": 0,
+    "humidityin": 0,
+    "dewpt": 1,
+    "windchill": 1,
+    "windspeedms": 1,
+    "windgustms": 1,
+    "winddir": 0,
+    "baromrel": 0,
+    "uv": None,
+    "rainmm": 2,
+    "dailyrainmm": 2,
+}
+
+# unit, table, short log columns, day columns. The first field of the short log
+# is required, the other ones are 0 when missing or None. Day columns are
+# (column, field, aggregate).
+SERIES = (
+    (
+        TEMP,
+        "Temperature",
+        (("Temperature", "temp"),),
+        (
+            ("Temp_Min", "temp", "min"),
+            ("Temp_Max", "temp", "max"),
+            ("Temp_Avg", "temp", "mean"),
+        ),
+    ),
+    (
+        TEMP_IND,
+        "Temperature",
+        (("Temperature", "tempin"),),
+        (
+            ("Temp_Min", "tempin", "min"),
+            ("Temp_Max", "tempin", "max"),
+            ("Temp_Avg", "tempin", "mean"),
+        ),
+    ),
+    (
+        DEWPOINT,
+        "Temperature",
+        (("Temperature", "dewpt"),),
+        (
+            ("Temp_Min", "dewpt", "min"),
+            ("Temp_Max", "dewpt", "max"),
+            ("Temp_Avg", "dewpt", "mean"),
+        ),
+    ),
+    (
+        CHILL,
+        "Temperature",
+        (("Temperature", "windchill"),),
+        (
+            ("Temp_Min", "windchill", "min"),
+            ("Temp_Max", "windchill", "max"),
+            ("Temp_Avg", "windchill", "mean"),
+        ),
+    ),
+    (
+        HEAT_INDEX,
+        "Temperature",
+        (("Temperature", "heatindex"),),
+        (
+            ("Temp_Min", "heatindex", "min"),
+            ("Temp_Max", "heatindex", "max"),
+            ("Temp_Avg", "heatindex", "mean"),
+        ),
+    ),
+    (
+        HEAT_INDEX_IN,
+        "Temperature",
+        (("Temperature", "heatindexin"),),
+        (
+            ("Temp_Min", "heatindexin", "min"),
+            ("Temp_Max", "heatindexin", "max"),
+            ("Temp_Avg", "heatindexin", "mean"),
+        ),
+    ),
+    (
+        HUMIDITY,
+        "Temperature",
+        (("Humidity", "humidity"), ("Temperature", None)),
+        (
+            ("Temp_Min", None, None),
+            ("Temp_Max", None, None),
+            ("Humidity", "humidity", "mean"),
+        ),
+    ),
+    (
+        HUMIDITY_IND,
+        "Temperature",
+        (("Humidity", "humidityin"), ("Temperature", None)),
+        (
+            ("Temp_Min", None, None),
+            ("Temp_Max", None, None),
+            ("Humidity", "humidityin", "mean"),
+        ),
+    ),
+    (
+        TEMP_HUM,
+        "Temperature",
+        (
+            ("Temperature", "temp"),
+            ("Humidity", "humidity"),
+            ("DewPoint", "dewpt"),
+        ),
+        (
+            ("Temp_Min", "temp", "min"),
+            ("Temp_Max", "temp", "max"),
+            ("Temp_Avg", "temp", "mean"),
+            ("Humidity", "humidity", "mean"),
+            ("DewPoint", "dewpt", "mean"),
+        ),
+    ),
+    (
+        THB,
+        "Temperature",
+        (
+            ("Temperature", "temp"),
+            ("Humidity", "humidity"),
+            ("Barometer", "baromrel"),
+            ("DewPoint", "dewpt"),
+        ),
+        (
+            ("Temp_Min", "temp", "min"),
+            ("Temp_Max", "temp", "max"),
+            ("Temp_Avg", "temp", "mean"),
+            ("Humidity", "humidity", "mean"),
+            ("Barometer", "baromrel", "mean"),
+            ("DewPoint", "dewpt", "mean"),
+        ),
+    ),
+    (
+        WIND1,
+        "Wind",
+        (
+            ("Speed", "speed10"),
+            ("Direction", "winddir"),
+            ("Gust", "gust10"),
+        ),
+        (
+            ("Direction", "winddir", "mean"),
+            ("Speed_Min", "speed10", "min"),
+            ("Speed_Max", "speed10", "max"),
+            ("Gust_Min", "gust10", "min"),
+            ("Gust_Max", "gust10", "max"),
+        ),
+    ),
+    (
+        WIND2,
+        "Wind",
+        (
+            ("Speed", "speed10"),
+            ("Direction", "winddir"),
+            ("Gust", "gust10"),
+        ),
+        (
+            ("Direction", "winddir", "mean"),
+            ("Speed_Min", "speed10", "min"),
+            ("Speed_Max", "speed10", "max"),
+            ("Gust_Min", "gust10", "min"),
+            ("Gust_Max", "gust10", "max"),
+        ),
+    ),
+    (UVI, "UV", (("Level", "uv"),), (("Level", "uv", "max"),)),
+    (
+        RAIN,
+        "Rain",
+        (),
+        (
+            ("Total", "dailyrainmm", "max"),
+            ("Rate", "rate100", "max"),
+        ),
+    ),
+)
+
+
+class Aggregate:
+    """Minimum, maximum and mean of a field over a day"""
+
+    __slots__ = ("min", "max", "total", "count")
+
+    def __init__(self):
+        self.min = None
+        self.max = None
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value):
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if self.count == 0 or value > self.max:
+            self.max = value
+        self.total += value
+        self.count += 1
+
+    def result(self, aggregate):
+        if aggregate == "mean":
+            return round(self.total / self.count, 2)
+        return getattr(self, aggregate)
+
+
+class Series:
+    """History of one device: the rows for the short log and the aggregates of
+    the current day for the day history
+    """
+
+    def __init__(self, rowid, table, short, day):
+        self.rowid = rowid
+        self.table = table
+        self.short = short
+        self.day = day
+        self.fields = {field for _, field, _ in day if field is not None}
+        self.date = None
+        self.aggregates = {}
+        # Days and short log intervals which are already in the history
+        self.days = set()
+        self.intervals = set()
+
+    def load(self, db, cutoff):
+        self.days = {
+            str(date)[:10]
+            for (date,) in db.execute(
+                "SELECT Date FROM {}_Calendar WHERE DeviceRowID=?".format(self.table),
+                (self.rowid,),
+            )
+        }
+        if self.short:
+            self.intervals = {
+                interval(timestamp)
+                for timestamp in (
+                    parse_time(str(date), "%Y-%m-%d %H:%M:%S")
+                    for (date,) in db.execute(
+                        "SELECT Date FROM {} WHERE DeviceRowID=? AND Date>=?".format(
+                            self.table
+                        ),
+                        (self.rowid, cutoff),
+                    )
+                )
+                if timestamp is not None
+            }
+
+    def add(self, date, obs):
+        """Add a row to the aggregates, returns the row of the finished day"""
+        row = None
+        if date != self.date:
+            row = self.finish()
+            self.date = date
+        if date in self.days:
+            return row
+        for field in self.fields:
+            value = obs[field]
+            if value is not None:
+                aggregate = self.aggregates.get(field)
+                if aggregate is None:
+                    aggregate = self.aggregates[field] = Aggregate()
+                aggregate.add(value)
+        return row
+
+    def finish(self):
+        """Row of the day history for the current day, None when no data"""
+        aggregates = self.aggregates
+        self.aggregates = {}
+        if self.date is None or not aggregates:
+            return None
+        row = [self.rowid, self.date]
+        for _, field, aggregate in self.day:
+            if field is None:
+                row.append(0)
+            elif field in aggregates:
+                row.append(aggregates[field].result(aggregate))
+            else:
+                row.append(0)
+        return row
+
+    def shortlog(self, timestamp, obs):
+        """Row of the short log, None when not available or already there"""
+        first = self.short[0][1]
+        if obs[first] is None or interval(timestamp) in self.intervals:
+            return None
+        row = [self.rowid, timestamp.strftime("%Y-%m-%d %H:%M:%S")]
+        for _, field in self.short:
+            value = obs[field] if field is not None else None
+            row.append(0 if value is None else value)
+        return row
+
+    def insert_day(self):
+        return "INSERT INTO {}_Calendar (DeviceRowID, Date, {}) VALUES ({})".format(
+            self.table,
+            ", ".join(column for column, _, _ in self.day),
+            ", ".join("?" * (len(self.day) + 2)),
+        )
+
+    def insert_short(self):
+        return "INSERT INTO {} (DeviceRowID, Date, {}) VALUES ({})".format(
+            self.table,
+            ", ".join(column for column, _ in self.short),
+            ", ".join("?" * (len(self.short) + 2)),
+        )
+
+
+def interval(timestamp):
+    """Short log interval of a timestamp"""
+    return (
+        timestamp.toordinal(),
+        (timestamp.hour * 3600 + timestamp.minute * 60) // SHORT_LOG_INTERVAL,
+    )
+
+
+def parse_time(value, format):
+    try:
+        return datetime.datetime.strptime(value.strip(), format)
+    except ValueError:
+        return None
+
+
+def parse_times(values, format):
+    """Timestamps of a column, None when not valid. strptime is slow, so it is
+    only used once per date and the time of the day is split by hand.
+    """
+    dateformat, _, _ = format.partition(" ")
+    dates = {}
+    times = []
+    for value in values:
+        datepart, _, timepart = value.strip().partition(" ")
+        day = dates.get(datepart)
+        if day is None and datepart not in dates:
+            day = dates[datepart] = parse_time(datepart, dateformat)
+        try:
+            clock = timepart.split(":")
+            times.append(
+                day.replace(
+                    hour=int(clock[0]),
+                    minute=int(clock[1]),
+                    second=int(clock[2]) if len(clock) > 2 else 0,
+                )
+            )
+        except (AttributeError, IndexError, ValueError):
+            times.append(None)
+    return times
+
+
+def parse_header(header):
+    """Columns of the file
+    Args:
+        header: first row of the file
+    Returns:
+        (index of the time, [(index, field, conversion)])
+    """
+    pattern = re.compile(r"^\s*(.*?)\s*(?:\((.*)\))?\s*$")
+    timecolumn = None
+    columns = []
+    fields = set()
+    for index, title in enumerate(header):
+        name, unitname = pattern.match(title).groups()
+        name = name.lower()
+        if name in TIME_COLUMNS and timecolumn is None:
+            timecolumn = index
+            continue
+        field = COLUMNS.get(name)
+        if field is None or field in fields:
+            continue
+        unitname = (unitname or "").strip().lower()
+        if unitname not in UNITS:
+            raise ValueError("Unknown unit of column {}: {}".format(title, unitname))
+        fields.add(field)
+        columns.append((index, field, UNITS[unitname]))
+    if timecolumn is None:
+        raise ValueError("No time column found")
+    return timecolumn, columns
+
+
+def convert(values, conversion, precision):
+    """Column of values from the file in the unit and precision of the plugin"""
+    result = []
+    for value in values:
+        try:
+            value = float(value)
+        except ValueError:
+            value = None
+        if value is not None:
+            if conversion is not None:
+                value = conversion(value)
+            if precision == 0:
+                value = round(value)
+            elif precision is not None:
+                # As the decoder of the plugin, for the same last decimal
+                value = round_decimals(value, precision)
+        result.append(value)
+    return result
+
+
+def derive(chunk):
+    """Add the derived values to the columns of a chunk, like the plugin does"""
+    n = len(chunk["time"])
+    none = [None] * n
+    temp = chunk.get("temp", none)
+    humidity = chunk.get("humidity", none)
+    tempin = chunk.get("tempin", none)
+    humidityin = chunk.get("humidityin", none)
+    speed = chunk.get("windspeedms", none)
+    gust = chunk.get("windgustms", none)
+    rate = chunk.get("rainmm", none)
+    for field, values in (
+        ("dewpt", dew_point_batch(temp, humidity)),
+        ("windchill", wind_chill_batch(temp, speed)),
+    ):
+        reported = chunk.get(field, none)
+        chunk[field] = [
+            r if r is not None else (round(v, 1) if v is not None else None)
+            for r, v in zip(reported, values)
+        ]
+    chunk["heatindex"] = heat_index_batch(temp, humidity)
+    chunk["heatindexin"] = heat_index_batch(tempin, humidityin)
+    chunk["speed10"] = [round(v * 10) if v is not None else None for v in speed]
+    chunk["gust10"] = [round(v * 10) if v is not None else None for v in gust]
+    chunk["rate100"] = [round(v * 100) if v is not None else None for v in rate]
+    # The columns which are not in the file, for the series of their devices
+    for field in (
+        "temp",
+        "humidity",
+        "tempin",
+        "humidityin",
+        "winddir",
+        "baromrel",
+        "uv",
+        "dailyrainmm",
+    ):
+        chunk.setdefault(field, none)
+
+
+def backfill(db, hardware, station, csvfile, short_days=1, log=print):
+    """Import the file into the history
+    Returns:
+        (number of rows, rows skipped, short log rows, day rows)
+    """
+    base = (station - 1) * STATION_UNITS
+    devices = dict(
+        db.execute("SELECT Unit, ID FROM DeviceStatus WHERE HardwareID=?", (hardware,))
+    )
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=short_days)
+    cutoff = cutoff.replace(hour=0, minute=0, second=0, microsecond=0)
+    today = datetime.date.today().strftime("%Y-%m-%d")
+    series = []
+    for u, table, short, day in SERIES:
+        rowid = devices.get(base + u)
+        if rowid is None:
+            log("No device for unit {}, skipped".format(base + u))
+            continue
+        s = Series(rowid, table, short, day)
+        s.load(db, cutoff.strftime("%Y-%m-%d %H:%M:%S"))
+        # Today is not over, Domoticz adds its day row at midnight from the
+        # short log, and a row of the incomplete day would be kept instead
+        s.days.add(today)
+        series.append(s)
+
+    reader = csv.reader(csvfile)
+    timecolumn, columns = parse_header(next(reader))
+    log("Columns: {}".format(", ".join(field for _, field, _ in columns)))
+    format = None
+    ordinal = date = None
+    rows = skipped = shortrows = dayrows = 0
+    while True:
+        block = list(itertools.islice(reader, CHUNK))
+        if not block:
+            break
+        rows += len(block)
+        # Timestamps, the format is detected on the first one
+        values = [row[timecolumn] if len(row) > timecolumn else "" for row in block]
+        if format is None:
+            format = next(
+                (f for f in TIME_FORMATS if parse_time(values[0], f) is not None),
+                None,
+            )
+        times = parse_times(values, format) if format else [None] * len(values)
+        chunk = {"time": times}
+        for index, field, conversion in columns:
+            chunk[field] = convert(
+                (row[index] if len(row) > index else "" for row in block),
+                conversion,
+                PRECISION[field],
+            )
+        derive(chunk)
+        del block
+
+        days = {s: [] for s in series}
+        shorts = {s: [] for s in series if s.short}
+        fields = list(chunk)
+        last = None
+        for i, timestamp in enumerate(times):
+            if timestamp is None:
+                skipped += 1
+                continue
+            obs = {field: chunk[field][i] for field in fields}
+            if timestamp.toordinal() != ordinal:
+                ordinal = timestamp.toordinal()
+                date = timestamp.strftime("%Y-%m-%d")
+            recent = timestamp >= cutoff and interval(timestamp) != last
+            if recent:
+                last = interval(timestamp)
+            for s in series:
+                row = s.add(date, obs)
+                if row is not None:
+                    days[s].append(row)
+                if recent and s.short:
+                    row = s.shortlog(timestamp, obs)
+                    if row is not None:
+                        shorts[s].append(row)
+        with db:
+            for s, values in days.items():
+                if values:
+                    db.executemany(s.insert_day(), values)
+                    dayrows += len(values)
+            for s, values in shorts.items():
+                if values:
+                    db.executemany(s.insert_short(), values)
+                    shortrows += len(values)
+    with db:
+        for s in series:
+            row = s.finish()
+            if row is not None:
+                db.execute(s.insert_day(), row)
+                dayrows += 1
+    return rows, skipped, shortrows, dayrows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load a CSV export of the station into the Domoticz history"
+    )
+    parser.add_argument("file", help="CSV file (SD card or Ecowitt cloud export)")
+    parser.add_argument("--database", required=True, help="domoticz.db")
+    parser.add_argument(
+        "--hardware", type=int, required=True, help="Idx of the PWS hardware"
+    )
+    parser.add_argument(
+        "--station",
+        type=int,
+        default=1,
+        choices=range(1, 5),
+        help="Station number, 2 for the devices named #2, etc. (default 1)",
+    )
+    parser.add_argument(
+        "--short-days",
+        type=int,
+        default=1,
+        help="Days of the short log, as in the Domoticz settings (default 1)",
+    )
+    args = parser.parse_args(argv)
+
+    db = sqlite3.connect(args.database)
+    start = time.perf_counter()
+    try:
+        with open(args.file, newline="", encoding="utf-8-sig") as csvfile:
+            rows, skipped, shortrows, dayrows = backfill(
+                db, args.hardware, args.station, csvfile, args.short_days
+            )
+    except ValueError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 1
+    finally:
+        db.close()
+    elapsed = time.perf_counter() - start
+    print(
+        "{} rows ({} skipped) in {:.1f} s, {:.0f} rows/s: "
+        "{} short log and {} day rows added".format(
+            rows, skipped, elapsed, rows / elapsed if elapsed else 0, shortrows, dayrows
+        )
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
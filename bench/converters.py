@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Microbenchmark of the status converters in converters.py against the
+# if-chains as they were, per value and as a batch. The bearing and Beaufort
+# converters are table lookups, UV and pressure keep their if-chains, as a
+# bisection is not faster for 4 or 5 bands. The outputs are checked to be
+# identical first.
+#
+# Usage (from the repository root):
+#   python -m bench.converters
+#
+import sys
+import timeit
+
+import converters as c
+
+
+def legacy_bearing2status(d):
+    dirs = [
+        "N",
+        "NNE",
+        "NE",
+        "ENE",
+        "E",
+        "ESE",
+        "SE",
+        "SSE",
+        "S",
+        "SSW",
+        "SW",
+        "WSW",
+        "W",
+        "WNW",
+        "NW",
+        "NNW",
+    ]
+    count = len(dirs)  # Number of entries in list
+    step = 360 / count  # Wind direction is in steps of 22.5 degrees (360/16)
+    ix = int((d + (step / 2)) / step)  # Calculate index in the list
+    return dirs[ix % count]
+
+
+def legacy_beaufort(speed):
+    """The Beaufort branch of speed2unit"""
+    if 0 <= speed < 0.3:
+        return 0
+    elif 0.3 <= speed < 1.6:
+        return 1
+    elif 1.6 <= speed < 3.4:
+        return 2
+    elif 3.4 <= speed < 5.5:
+        return 3
+    elif 5.5 <= speed < 8.0:
+        return 4
+    elif 8.0 <= speed < 10.8:
+        return 5
+    elif 10.8 <= speed < 13.9:
+        return 6
+    elif 13.9 <= speed < 17.2:
+        return 7
+    elif 17.2 <= speed < 20.8:
+        return 8
+    elif 20.8 <= speed < 24.5:
+        return 9
+    elif 24.5 <= speed < 28.5:
+        return 10
+    elif 28.5 <= speed < 32.7:
+        return 11
+    elif 32.7 <= speed:
+        return 12
+
+
+def legacy_uv2status(value):
+    if value is None:
+        return None
+    if value < 3:
+        return 0
+    elif value < 6:
+        return 1
+    elif value < 8:
+        return 2
+    elif value < 11:
+        return 3
+    else:
+        return 4
+
+
+def legacy_pressure2status(value):
+    if value is None:
+        return None
+    if value < 1000:
+        return c.BARO_FORECAST_RAIN
+    elif value < 1020:
+        return c.BARO_FORECAST_CLOUDY
+    elif value < 1030:
+        return c.BARO_FORECAST_PARTLYCLOUDY
+    else:
+        return c.BARO_FORECAST_SUNNY
+
+
+def steps(start, stop, step):
+    return [round(start + i * step, 2) for i in range(int((stop - start) / step))]
+
+
+# name, legacy, current, batch, values (including the bounds of the bands)
+CASES = (
+    (
+        "bearing2status",
+        legacy_bearing2status,
+        c.bearing2status,
+        c.bearing2status_batch,
+        list(range(-10, 370)) + steps(0, 360, 0.25),
+    ),
+    (
+        "speed2beaufort",
+        legacy_beaufort,
+        c.speed2beaufort,
+        lambda vs: c.speed2unit_batch(vs, c.WIND_SPEED_BEAUFORT),
+        steps(-1, 40, 0.05) + list(c.BEAUFORT_BANDS) + [float("nan")],
+    ),
+    (
+        "uv2status",
+        legacy_uv2status,
+        c.uv2status,
+        c.uv2status_batch,
+        steps(0, 16, 0.1) + list(range(16)) + [None],
+    ),
+    (
+        "pressure2status",
+        legacy_pressure2status,
+        c.pressure2status,
+        c.pressure2status_batch,
+        steps(950, 1060, 0.5) + [None],
+    ),
+)
+
+
+def measure(function, number):
+    """Best of 5 runs, in µs per call"""
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def check():
+    """Names of the converters with outputs which differ from the legacy ones"""
+    different = []
+    for name, legacy, current, batch, values in CASES:
+        expected = [legacy(v) for v in values]
+        if [current(v) for v in values] != expected or batch(values) != expected:
+            different.append(name)
+    return different
+
+
+def main(number=200):
+    different = check()
+    for name in different:
+        print("{}: outputs differ from the legacy function".format(name))
+    # Speedups against the legacy function, per value and as a batch
+    print(
+        "{:<17}{:>12}{:>12}{:>12}{:>10}{:>10}".format(
+            "converter", "legacy ns", "current ns", "batch ns", "current", "batch"
+        )
+    )
+    for name, legacy, current, batch, values in CASES:
+        scale = 1000 / len(values)
+        old = measure(lambda: [legacy(v) for v in values], number) * scale
+        new = measure(lambda: [current(v) for v in values], number) * scale
+        bulk = measure(lambda: batch(values), number) * scale
+        print(
+            "{:<17}{:>12.1f}{:>12.1f}{:>12.1f}{:>9.2f}x{:>9.2f}x".format(
+                name, old, new, bulk, old / new, old / bulk
+            )
+        )
+    return 1 if different else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Per-packet cost of the debug logging in onMessage. Before the Debug facade
+# every message was formatted, even when Domoticz dropped it because debugging
+# was off. That is measured here with debugging on and a Domoticz.Debug which
+# drops the message, against the facade with debugging off.
+#
+# Usage (from the repository root):
+#   python -m bench.debug
+#
+import timeit
+
+from bench import domoticz
+from bench.decoder import ECOWITT, WUNDERGROUND
+
+
+def measure(function, number):
+    """Best of 5 runs, in µs per call"""
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main(number=5000):
+    # The packets come much faster than from a station, without rate=0 the
+    # rate limiter would answer 429 and this would measure the rejection
+    plugin = domoticz.load_plugin({"Mode5": "rate=0"})
+    # The same packet is handled over and over, so keep no duplicates
+    plugin.RecentPackets.SIZE = 0
+    plugin.onStart()
+    connection = domoticz.Connection(Name="Station", Address="192.168.0.20")
+    packets = (
+        (
+            "Wunderground",
+            {"Verb": "GET", "URL": "/weatherstation/updateweatherstation.php?" + WUNDERGROUND},
+        ),
+        ("Ecowitt", {"Verb": "POST", "URL": "/data/report/", "Data": ECOWITT.encode()}),
+    )
+    print("{:<14}{:>12}{:>12}{:>10}".format("protocol", "format µs", "facade µs", "saved"))
+    for name, data in packets:
+        plugin.Debugging(True)
+        old = measure(lambda: plugin.onMessage(connection, data), number)
+        plugin.Debugging(False)
+        new = measure(lambda: plugin.onMessage(connection, data), number)
+        print("{:<14}{:>12.2f}{:>12.2f}{:>9.0f}%".format(name, old, new, 100 * (old - new) / old))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Microbenchmark of the per-packet decoding: the schema based FieldDecoder
+# against the hand written parsing as it was in BasePlugin.onMessage. The
+# legacy Ecowitt branch converts 14 fields, the FieldDecoder 20 (the weekly,
+# monthly and yearly rain, the battery, the key and the time, of which the
+# legacy code crashed on some).
+#
+# The FieldDecoder keeps the converted values of the segments it has seen, so
+# it is measured on one packet, decoded with an empty cache, and on the packets
+# of bench/corpus in order, where most values repeat as with a real station.
+#
+# Usage (from the repository root):
+#   python -m bench.decoder
+#
+import os
+import timeit
+
+from bench import domoticz
+from bench.replay import CORPUS, read_corpus
+import converters
+
+plugin = domoticz.load_plugin()
+
+WUNDERGROUND = (
+    "ID=IHOME1&PASSWORD=secret&indoortempf=73.2&tempf=61.3&dewptf=50.2"
+    "&windchillf=61.3&indoorhumidity=45&humidity=67&windspeedmph=3.4"
+    "&windgustmph=4.5&winddir=212&absbaromin=29.740&baromin=29.917"
+    "&rainin=0.000&dailyrainin=0.020&weeklyrainin=0.150&monthlyrainin=0.150"
+    "&yearlyrainin=5.120&solarradiation=372.58&UV=3"
+    "&dateutc=2020-05-03%2009:45:52&softwaretype=EasyWeatherV1.5.2"
+    "&action=updateraw&realtime=1&rtfreq=5"
+)
+ECOWITT = (
+    "PASSKEY=F1E2D3C4B5A69788&stationtype=GW1000_V1.6.1"
+    "&dateutc=2020-05-03+09:45:52&tempinf=73.2&humidityin=45"
+    "&baromrelin=29.917&baromabsin=29.740&tempf=61.3&humidity=67&winddir=212"
+    "&windspeedmph=3.36&windgustmph=4.47&maxdailygust=10.29&rainratein=0.000"
+    "&eventrainin=0.000&hourlyrainin=0.000&dailyrainin=0.020"
+    "&weeklyrainin=0.150&monthlyrainin=0.150&yearlyrainin=5.120"
+    "&totalrainin=5.120&solarradiation=372.58&uv=3&wh65batt=0&freq=868M"
+    "&model=GW1000_Pro"
+)
+
+
+def legacy_wunderground(strData):
+    """The Wunderground branch of onMessage before the FieldDecoder"""
+    p = converters
+    data = dict(item.split("=") for item in strData.split("&"))
+    temp = p.temperature_f2iso(p.float_or_none(data.get("tempf")))
+    tempin = p.temperature_f2iso(p.float_or_none(data.get("indoortempf")))
+    humidity = p.int_or_none(data.get("humidity"))
+    humidityin = p.int_or_none(data.get("indoorhumidity"))
+    dewpt = p.temperature_f2iso(p.float_or_none(data.get("dewptf")))
+    windchill = p.temperature_f2iso(p.float_or_none(data.get("windchillf")))
+    windspeedms = p.speed_mph2iso(p.float_or_none(data.get("windspeedmph")))
+    windgustms = p.speed_mph2iso(p.float_or_none(data.get("windgustmph")))
+    winddir = p.int_or_none(data.get("winddir"))
+    solarradiation = p.float_or_none(data.get("solarradiation"))
+    uv = p.float_or_none(data.get("UV"))
+    softwaretype = data.get("softwaretype")
+    baromrel = p.pressure_inches2iso(p.float_or_none(data.get("baromin")))
+    baromabs = p.pressure_inches2iso(p.float_or_none(data.get("baromin"))) - 46
+    rainmm = 10 * p.distance_inch2iso(p.float_or_none(data.get("rainin")))
+    dailyrainmm = 10.0 * p.distance_inch2iso(p.float_or_none(data.get("dailyrainin")))
+    weeklyrainmm = 10.0 * p.distance_inch2iso(
+        p.float_or_none(data.get("weeklyrainin"))
+    )
+    monthlyrainmm = 10.0 * p.distance_inch2iso(
+        p.float_or_none(data.get("monthlyrainin"))
+    )
+    yearlyrainmm = 10.0 * p.distance_inch2iso(
+        p.float_or_none(data.get("yearlyrainin"))
+    )
+    lowbatt = data.get("lowbatt")
+    temp = round(temp, 1) if temp is not None else None
+    tempin = round(tempin, 1) if tempin is not None else None
+    windspeedms = round(windspeedms, 1) if windspeedms is not None else None
+    dewpt = round(dewpt, 1) if dewpt is not None else None
+    windchill = round(windchill, 1) if windchill is not None else None
+    windgustms = round(windgustms, 1) if windgustms is not None else None
+    baromrel = round(baromrel) if baromrel is not None else None
+    baromabs = round(baromabs) if baromabs is not None else None
+    rainmm = round(rainmm, 2) if rainmm is not None else None
+    dailyrainmm = round(dailyrainmm, 2) if dailyrainmm is not None else None
+    solarradiation = round(solarradiation, 1) if solarradiation is not None else None
+    return (
+        temp, tempin, humidity, humidityin, dewpt, windchill, windspeedms,
+        windgustms, winddir, solarradiation, uv, softwaretype, baromrel,
+        baromabs, rainmm, dailyrainmm, weeklyrainmm, monthlyrainmm,
+        yearlyrainmm, lowbatt,
+    )
+
+
+def legacy_ecowitt(strData):
+    """The Ecowitt branch of onMessage before the FieldDecoder"""
+    p = converters
+    data = dict(item.split("=") for item in strData.split("&"))
+    temp = p.temperature_f2iso(p.float_or_none(data.get("tempf")))
+    tempin = p.temperature_f2iso(p.float_or_none(data.get("tempinf")))
+    humidity = p.int_or_none(data.get("humidity"))
+    humidityin = p.int_or_none(data.get("humidityin"))
+    windspeedms = p.speed_mph2iso(p.float_or_none(data.get("windspeedmph")))
+    windgustms = p.speed_mph2iso(p.float_or_none(data.get("windgustmph")))
+    winddir = p.int_or_none(data.get("winddir"))
+    baromrel = p.pressure_inches2iso(p.float_or_none(data.get("baromrelin")))
+    baromabs = p.pressure_inches2iso(p.float_or_none(data.get("baromabsin")))
+    rainmm = 10 * p.distance_inch2iso(p.float_or_none(data.get("rainratein")))
+    dailyrainmm = 10 * p.distance_inch2iso(p.float_or_none(data.get("dailyrainin")))
+    softwaretype = data.get("stationtype")
+    solarradiation = p.float_or_none(data.get("solarradiation"))
+    uv = p.float_or_none(data.get("uv"))
+    temp = round(temp, 1) if temp is not None else None
+    tempin = round(tempin, 1) if tempin is not None else None
+    windspeedms = round(windspeedms, 1) if windspeedms is not None else None
+    windgustms = round(windgustms, 1) if windgustms is not None else None
+    baromrel = round(baromrel) if baromrel is not None else None
+    baromabs = round(baromabs) if baromabs is not None else None
+    rainmm = round(rainmm, 2) if rainmm is not None else None
+    dailyrainmm = round(dailyrainmm, 2) if dailyrainmm is not None else None
+    solarradiation = round(solarradiation, 1) if solarradiation is not None else None
+    return (
+        temp, tempin, humidity, humidityin, windspeedms, windgustms, winddir,
+        solarradiation, uv, softwaretype, baromrel, baromabs, rainmm,
+        dailyrainmm,
+    )
+
+
+def measure(functions, number, repeat=40):
+    """Best of the runs, in µs per call. The functions are run in turns, so
+    a busy machine slows them down alike.
+    """
+    best = [float("inf")] * len(functions)
+    for _ in range(repeat):
+        for i, function in enumerate(functions):
+            best[i] = min(best[i], timeit.timeit(function, number=number))
+    return [t / number * 1e6 for t in best]
+
+
+def corpus(name):
+    """Data of the packets of a corpus file, as the decoders get it"""
+    packets = read_corpus([os.path.join(CORPUS, name)])
+    return [p["data"] or p["url"].partition("?")[2] for p in packets]
+
+
+def main(number=600):
+    cases = (
+        (
+            "Wunderground",
+            WUNDERGROUND,
+            "wunderground.jsonl",
+            legacy_wunderground,
+            plugin.WUNDERGROUND_SCHEMA,
+        ),
+        ("Ecowitt", ECOWITT, "ecowitt.jsonl", legacy_ecowitt, plugin.ECOWITT_SCHEMA),
+    )
+    print(
+        "{:<14}{:<8}{:>12}{:>12}{:>10}".format(
+            "protocol", "data", "legacy µs", "schema µs", "speedup"
+        )
+    )
+    for name, payload, path, legacy, schema in cases:
+        decoder = plugin.FieldDecoder(schema)
+
+        def decode(packets):
+            # Every run starts without cached values
+            decoder.cache.clear()
+            for data in packets:
+                decoder.decode(data)
+
+        def decode_legacy(packets):
+            for data in packets:
+                legacy(data)
+
+        for label, packets in (("packet", [payload]), ("corpus", corpus(path))):
+            old, new = (
+                t / len(packets)
+                for t in measure(
+                    (lambda: decode_legacy(packets), lambda: decode(packets)),
+                    max(1, number // len(packets)),
+                )
+            )
+            print(
+                "{:<14}{:<8}{:>12.2f}{:>12.2f}{:>9.2f}x".format(
+                    name, label, old, new, old / new
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# In-memory stand-in for the Domoticz module, to run plugin.py outside of
+# Domoticz. Device updates are recorded, log messages are dropped unless a
+# log function is given.
+#
+import importlib.util
+import os
+import sys
+import tempfile
+import types
+
+PLUGIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plugin.py")
+
+
+class Device:
+    """Domoticz.Device, created devices are added to the Devices of the plugin"""
+
+    def __init__(self, Name="", Unit=0, Type=0, Subtype=0, Switchtype=0,
+                 Options=None, Used=0, DeviceID="", Image=0, Description=""):
+        self.Name = Name
+        self.Unit = Unit
+        self.ID = Unit
+        self.DeviceID = DeviceID
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Options = dict(Options or {})
+        self.Used = Used
+        self.Image = Image
+        self.Description = Description
+        self.nValue = 0
+        self.sValue = ""
+        self.TimedOut = 0
+        self.LastLevel = 0
+        self.LastUpdate = ""
+
+    def Create(self):
+        _domoticz.Devices[self.Unit] = self
+
+    def Delete(self):
+        _domoticz.Devices.pop(self.Unit, None)
+
+    def Update(self, nValue, sValue, TimedOut=0, Options=None, **kwargs):
+        self.nValue = nValue
+        self.sValue = sValue
+        self.TimedOut = TimedOut
+        if Options is not None:
+            self.Options = dict(Options)
+        _domoticz.updates.append((self.Unit, nValue, sValue, TimedOut))
+
+    def __str__(self):
+        return "Unit: {}, Name: '{}', nValue: {}, sValue: '{}'".format(
+            self.Unit, self.Name, self.nValue, self.sValue
+        )
+
+
+class Connection:
+    """Domoticz.Connection, sent messages are kept in sent"""
+
+    def __init__(self, Name="", Transport="TCP/IP", Protocol="HTTP",
+                 Address="127.0.0.1", Port="0"):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self.sent = []
+        self.connected = True
+
+    def Listen(self):
+        pass
+
+    def Connect(self):
+        self.connected = True
+
+    def Connected(self):
+        return self.connected
+
+    def Send(self, Message, Delay=0):
+        self.sent.append(Message)
+
+    def Disconnect(self):
+        self.connected = False
+
+    def __str__(self):
+        return "Name: '{}', Address: '{}', Port: '{}'".format(
+            self.Name, self.Address, self.Port
+        )
+
+
+class _Domoticz(types.ModuleType):
+    def __init__(self):
+        super().__init__("Domoticz")
+        self.Device = Device
+        self.Connection = Connection
+        self.Devices = {}
+        self.updates = []
+        self.log = None
+        self.debugging = 0
+
+    def _message(self, level, message):
+        if self.log is not None:
+            self.log(level, message)
+
+    def Debug(self, message):
+        if self.debugging:
+            self._message("Debug", message)
+
+    def Log(self, message):
+        self._message("Log", message)
+
+    def Status(self, message):
+        self._message("Status", message)
+
+    def Error(self, message):
+        self._message("Error", message)
+
+    def Debugging(self, level):
+        self.debugging = level
+
+
+_domoticz = _Domoticz()
+sys.modules.setdefault("Domoticz", _domoticz)
+# Domoticz adds the plugin folder to the path, for the modules next to plugin.py
+sys.path.insert(0, os.path.dirname(PLUGIN))
+
+PARAMETERS = {
+    "Address": "5000",
+    "HardwareID": 1,
+    "HomeFolder": tempfile.gettempdir() + os.sep,
+    "Mode1": "",
+    "Mode2": "",
+    "Mode3": "",
+    "Mode4": "",
+    "Mode5": "",
+    "Mode6": "Normal",
+}
+SETTINGS = {"WindUnit": "0", "TempUnit": "0"}
+
+
+def load_plugin(parameters=None, settings=None, log=None):
+    """Load a fresh plugin.py with empty Devices, the module is returned
+
+    Args:
+        parameters: Parameters, updating the defaults in PARAMETERS
+        settings: Settings, updating the defaults in SETTINGS
+        log: function(level, message) for the Domoticz log messages
+    """
+    _domoticz.Devices = {}
+    _domoticz.updates = []
+    _domoticz.log = log
+    _domoticz.debugging = 0
+    spec = importlib.util.spec_from_file_location("plugin", PLUGIN)
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    plugin.Devices = _domoticz.Devices
+    plugin.Parameters = dict(PARAMETERS, **(parameters or {}))
+    plugin.Settings = dict(SETTINGS, **(settings or {}))
+    return plugin
+
+
+def updates():
+    """Device.Update calls since the plugin was loaded, as (Unit, nValue, sValue, TimedOut)"""
+    return _domoticz.updates
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Forwarding of the packets to an upstream server: the corpus is replayed
+# through onMessage with the forward URL set to a local HTTP server, which
+# answers after --delay ms and fails --fail % of the requests with HTTP 500.
+# Reports the latency of onMessage, which should not depend on the upstream,
+# and how the packets arrived upstream. The server runs in the same process,
+# so with few cores the p99 includes its share of the interpreter.
+#
+# Usage (from the repository root):
+#   python -m bench.forward [--delay 50] [--fail 10]
+#
+import argparse
+import glob
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench.replay import CORPUS, read_corpus, replay
+
+
+class Upstream(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body in one write, a small second write waits for the ACK
+    wbufsize = -1
+    delay = 0
+    fail = 0
+    received = 0
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with self.lock:
+            Upstream.connections += 1
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        time.sleep(self.delay)
+        status = 500 if random.random() * 100 < self.fail else 200
+        if status == 200:
+            with self.lock:
+                Upstream.received += 1
+        body = b"success\n"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Forward packets to a local server")
+    parser.add_argument("--delay", type=float, default=50, help="upstream delay (ms)")
+    parser.add_argument("--fail", type=float, default=0, help="upstream HTTP 500 (%%)")
+    args = parser.parse_args(argv)
+    Upstream.delay = args.delay / 1000
+    Upstream.fail = args.fail
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/weatherstation/updateweatherstation.php".format(
+        server.server_address[1]
+    )
+    packets = read_corpus(sorted(glob.glob(os.path.join(CORPUS, "*.jsonl"))))
+
+    baseline = replay(packets)
+    result = replay(packets, 1, {"Mode3": url})
+    forwarder = result["plugin"]._plugin.forwarder
+    # Short backoff, so the retries finish within the run
+    forwarder.BACKOFF = 0.05
+    start = time.monotonic()
+    while forwarder.queue or forwarder.forwarded + forwarder.failed < len(packets):
+        if time.monotonic() - start > 60:
+            break
+        time.sleep(0.01)
+    forwarder.stop()
+    server.shutdown()
+
+    print(
+        "onMessage p99 µs:  {:.1f} without, {:.1f} with forwarding".format(
+            baseline["p99_us"], result["p99_us"]
+        )
+    )
+    print(
+        "upstream:          {:.0f} ms delay, {:.0f}% HTTP 500".format(
+            args.delay, args.fail
+        )
+    )
+    print(
+        "packets:           {}, forwarded {}, failed {}, "
+        "dropped {}, retries {}".format(
+            len(packets),
+            forwarder.forwarded,
+            forwarder.failed,
+            forwarder.dropped,
+            forwarder.retries,
+        )
+    )
+    print(
+        "upstream received: {} on {} connections in {:.1f} s".format(
+            Upstream.received, Upstream.connections, time.monotonic() - start
+        )
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Microbenchmark of the query string parsing: the expression as it was in
+# onMessage, on the body decoded to a str, against FieldDecoder on the bytes
+# of the body. The expression only splits the data, so it is also measured
+# with the conversion of the values as it was (bench.decoder). The escapes
+# and malformed packets are checked first: the expression raises, the
+# FieldDecoder skips and counts the bad values.
+#
+# Usage (from the repository root):
+#   python -m bench.query
+#
+import sys
+
+from bench import domoticz
+from bench.decoder import (
+    ECOWITT,
+    WUNDERGROUND,
+    corpus,
+    legacy_ecowitt,
+    legacy_wunderground,
+    measure,
+)
+
+plugin = domoticz.load_plugin()
+
+# data, field, expected value
+ESCAPES = (
+    (b"dateutc=2020-05-03+09%3A45%3A52", "dateutc", "2020-05-03 09:45:52"),
+    (b"dateutc=2020-05-03%2009:45:52", "dateutc", "2020-05-03 09:45:52"),
+    (b"stationtype=GW1000%5FV1.6.1", "softwaretype", "GW1000_V1.6.1"),
+    (b"stationtype=Z%C3%BCrich", "softwaretype", "Zürich"),
+    (b"tempf=%2D4.0", "temp", -20.0),
+)
+
+# data, number of malformed values
+MALFORMED = (
+    (b"tempf=61.2&&humidity=67&", 0),
+    (b"stationtype=a=b&tempf=61.2", 0),
+    (b"tempf&humidity=67", 1),
+    (b"stationtype=%zz&tempf=61.2", 1),
+    (b"stationtype=\xff\xfe&tempf=61.2", 1),
+    (b"dateutc=2020%2", 1),
+)
+
+
+def legacy(body):
+    """The parsing of onMessage before the FieldDecoder"""
+    strData = body.decode("utf-8")
+    return dict(item.split("=") for item in strData.split("&"))
+
+
+def check():
+    """Descriptions of the cases which are not decoded as expected"""
+    failed = []
+    decoder = plugin.FieldDecoder(plugin.ECOWITT_SCHEMA)
+    for data, field, expected in ESCAPES:
+        value = decoder.decode(data)[field]
+        if value != expected:
+            failed.append("{!r}: {!r}, expected {!r}".format(data, value, expected))
+    for data, expected in MALFORMED:
+        decoder.malformed = 0
+        try:
+            legacy(data)
+            result = "parsed"
+        except ValueError:
+            result = "raised"
+        decoder.decode(data)
+        print(
+            "{:<38}expression {}, malformed {}".format(
+                repr(data), result, decoder.malformed
+            )
+        )
+        if decoder.malformed != expected:
+            failed.append(
+                "{!r}: {} malformed, expected {}".format(
+                    data, decoder.malformed, expected
+                )
+            )
+    return failed
+
+
+def main(number=600):
+    failed = check()
+    for message in failed:
+        print(message)
+    cases = (
+        ("Wunderground", WUNDERGROUND, "wunderground.jsonl", legacy_wunderground, plugin.WUNDERGROUND_SCHEMA),
+        ("Ecowitt", ECOWITT, "ecowitt.jsonl", legacy_ecowitt, plugin.ECOWITT_SCHEMA),
+    )
+    print()
+    print(
+        "{:<14}{:<8}{:>15}{:>15}{:>15}".format(
+            "protocol", "data", "expression µs", "+ convert µs", "decode µs"
+        )
+    )
+    for name, payload, path, convert, schema in cases:
+        decoder = plugin.FieldDecoder(schema)
+
+        def expression(bodies):
+            for body in bodies:
+                legacy(body)
+
+        def converted(bodies):
+            for body in bodies:
+                convert(body.decode("utf-8"))
+
+        def decode(bodies):
+            # Every run starts without cached values
+            decoder.cache.clear()
+            for body in bodies:
+                decoder.decode(body)
+
+        for label, bodies in (
+            ("packet", [payload.encode("utf-8")]),
+            ("corpus", [data.encode("utf-8") for data in corpus(path)]),
+        ):
+            times = measure(
+                (
+                    lambda: expression(bodies),
+                    lambda: converted(bodies),
+                    lambda: decode(bodies),
+                ),
+                max(1, number // len(bodies)),
+            )
+            print(
+                "{:<14}{:<8}{:>15.2f}{:>15.2f}{:>15.2f}".format(
+                    name, label, *(t / len(bodies) for t in times)
+                )
+            )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
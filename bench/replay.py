@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Replay captured station packets through BasePlugin.onMessage and report the
+# throughput, the per-packet latency percentiles and the device writes.
+#
+# Usage (from the repository root):
+#   python -m bench.replay [corpus.jsonl ...] [--repeat N] [--max-p99 µs]
+#
+# A corpus has one packet per line: {"verb", "url", "data", "address"}, with
+# "data64" (base64) instead of "data" for a body which is not UTF-8. Without
+# corpus files, the samples in bench/corpus are replayed. The recordings of the
+# plugin (option record) are corpus files too, compressed with gzip. With
+# --max-p99 the exit status is 1 when the p99 latency is above the limit, to
+# guard against regressions.
+#
+import argparse
+import base64
+import glob
+import gzip
+import json
+import os
+import sys
+import time
+import zlib
+
+from bench import domoticz
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+
+def read_corpus(paths):
+    packets = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        packets.append(json.loads(line))
+            except (EOFError, zlib.error) as e:
+                # A recording which is still written, or was not closed, eg.
+                # after a crash of Domoticz: the lines before the end are kept
+                print("{}: truncated ({})".format(path, e), file=sys.stderr)
+    return packets
+
+
+def to_message(packet):
+    """Data as passed by Domoticz to onMessage for an HTTP request"""
+    message = {"Verb": packet["verb"], "URL": packet["url"], "Headers": {}}
+    if packet.get("data64"):
+        # A recorded body which is not UTF-8
+        message["Data"] = base64.b64decode(packet["data64"])
+    elif packet.get("data"):
+        message["Data"] = packet["data"].encode("utf-8")
+    return message
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def replay(packets, repeat=1, parameters=None, settings=None):
+    """Replay the packets, each repeat through a fresh plugin (the plugin
+    drops packets it has seen), returns the statistics
+    """
+    messages = [(to_message(p), p.get("address", "127.0.0.1")) for p in packets]
+    # The packets come much faster than from a station, so without the rate
+    # limit, unless the options set one
+    parameters = dict(parameters or {})
+    parameters["Mode5"] = "rate=0;" + parameters.get("Mode5", "")
+    latencies = []
+    writes = 0
+    elapsed = 0
+    for _ in range(repeat):
+        plugin = domoticz.load_plugin(parameters, settings)
+        plugin.onStart()
+        connections = {}
+        start = time.perf_counter_ns()
+        for message, address in messages:
+            connection = connections.get(address)
+            if connection is None:
+                connection = connections[address] = domoticz.Connection(
+                    Name=address, Address=address, Port="50000"
+                )
+            t = time.perf_counter_ns()
+            plugin.onMessage(connection, message)
+            latencies.append(time.perf_counter_ns() - t)
+        elapsed += time.perf_counter_ns() - start
+        writes += len(domoticz.updates())
+    latencies.sort()
+    count = len(latencies)
+    return {
+        "packets": count,
+        "packets_per_s": count / (elapsed / 1e9) if elapsed else 0,
+        "p50_us": percentile(latencies, 50) / 1000,
+        "p95_us": percentile(latencies, 95) / 1000,
+        "p99_us": percentile(latencies, 99) / 1000,
+        "writes": writes,
+        "writes_per_packet": writes / count,
+        # Plugin of the last repeat
+        "plugin": plugin,
+        # Stage timing of the last repeat, with the timing option
+        "stages": plugin._plugin.timer.summary() if plugin._plugin.timer else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay packets through onMessage")
+    parser.add_argument("corpus", nargs="*", help="corpus files (.jsonl)")
+    parser.add_argument("--repeat", type=int, default=20, help="replays of the corpus")
+    parser.add_argument("--debug", action="store_true", help="replay with Mode6=Debug")
+    parser.add_argument("--options", help="replay with these Mode5 options, eg. timing=60")
+    parser.add_argument("--max-p99", type=float, help="fail when p99 is above (µs)")
+    args = parser.parse_args(argv)
+    paths = args.corpus or sorted(glob.glob(os.path.join(CORPUS, "*.jsonl")))
+    packets = read_corpus(paths)
+    if not packets:
+        parser.error("no packets in the corpus")
+    parameters = {}
+    if args.debug:
+        parameters["Mode6"] = "Debug"
+    if args.options:
+        parameters["Mode5"] = args.options
+    result = replay(packets, args.repeat, parameters)
+    print("packets:        {packets}".format(**result))
+    print("packets/s:      {packets_per_s:.0f}".format(**result))
+    print("latency µs:     p50 {p50_us:.1f}  p95 {p95_us:.1f}  p99 {p99_us:.1f}".format(**result))
+    print("device writes:  {writes} ({writes_per_packet:.2f} per packet)".format(**result))
+    if result["stages"]:
+        print("stages µs:      {stages}".format(**result))
+    if args.max_p99 is not None and result["p99_us"] > args.max_p99:
+        print("p99 {:.1f} µs is above {:.1f} µs".format(result["p99_us"], args.max_p99))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
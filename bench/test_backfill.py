@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# Import of a CSV export into an in-memory copy of the Domoticz tables.
+#
+# Usage (from the repository root):
+#   python -m pytest bench
+#
+import datetime
+import io
+import sqlite3
+
+import pytest
+
+import backfill
+from bench import domoticz
+
+HEADER = "Time,Outdoor Temperature(℃),Outdoor Humidity(%)"
+
+
+@pytest.fixture
+def db():
+    """Domoticz database with the devices of station 1 of hardware 1"""
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE DeviceStatus (ID INTEGER PRIMARY KEY, HardwareID, Unit)")
+    tables = {}
+    for u, table, short, day in backfill.SERIES:
+        db.execute("INSERT INTO DeviceStatus (HardwareID, Unit) VALUES (1, ?)", (u,))
+        tables.setdefault(table, set()).update(c for c, _ in short)
+        tables.setdefault(table + "_Calendar", set()).update(c for c, _, _ in day)
+    for table, columns in tables.items():
+        db.execute(
+            "CREATE TABLE {} ({})".format(
+                table, ", ".join(["DeviceRowID", "Date"] + sorted(columns))
+            )
+        )
+    yield db
+    db.close()
+
+
+def export(hours):
+    """Hourly rows until the current hour"""
+    now = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    rows = [HEADER]
+    for hour in range(hours, -1, -1):
+        t = now - datetime.timedelta(hours=hour)
+        rows.append("{},{},60".format(t.strftime("%Y-%m-%d %H:%M"), 10 + hour % 5))
+    return io.StringIO("\n".join(rows))
+
+
+def days(db):
+    return sorted(
+        {str(date) for (date,) in db.execute("SELECT Date FROM Temperature_Calendar")}
+    )
+
+
+def test_no_day_row_for_today(db):
+    backfill.backfill(db, 1, 1, export(48), log=lambda message: None)
+    today = datetime.date.today()
+    assert days(db) == [str(today - datetime.timedelta(days=n)) for n in (2, 1)]
+
+
+def test_days_not_added_twice(db):
+    backfill.backfill(db, 1, 1, export(72), log=lambda message: None)
+    before = db.execute("SELECT COUNT(*) FROM Temperature_Calendar").fetchone()
+    _, _, _, dayrows = backfill.backfill(db, 1, 1, export(72), log=lambda message: None)
+    assert dayrows == 0
+    assert db.execute("SELECT COUNT(*) FROM Temperature_Calendar").fetchone() == before
+
+
+def test_columns_not_in_the_file(db):
+    csvfile = io.StringIO("Time,Indoor Temperature(℃)\n2024-01-01 12:00,21.5\n")
+    rows, skipped, _, _ = backfill.backfill(db, 1, 1, csvfile, log=lambda message: None)
+    assert (rows, skipped) == (1, 0)
+
+
+# Values in hundredths and thousandths of the unit, with ties of the rounding
+@pytest.mark.parametrize(
+    "key, field, conversion, scale",
+    [
+        ("tempf", "temp", "temperature_f2iso", 100),
+        ("dailyrainin", "dailyrainmm", "distance_inch2mm", 1000),
+        ("windspeedmph", "windspeedms", "speed_mph2iso", 1000),
+    ],
+)
+def test_same_values_as_the_plugin(key, field, conversion, scale):
+    plugin = domoticz.load_plugin()
+    decoder = plugin.FieldDecoder(plugin.WUNDERGROUND_SCHEMA)
+    texts = ["{:.3f}".format(v / scale) for v in range(20000)]
+    live = [decoder.decode("{}={}".format(key, text))[field] for text in texts]
+    imported = backfill.convert(
+        texts, getattr(backfill, conversion), backfill.PRECISION[field]
+    )
+    assert live == imported
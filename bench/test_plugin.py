@@ -0,0 +1,592 @@
+# -*- coding: utf-8 -*-
+#
+# Behaviour of plugin.py with the Domoticz stand-in, on a clock which only
+# moves when a test moves it.
+#
+# Usage (from the repository root):
+#   python -m pytest bench
+#
+import os
+import time
+
+import pytest
+
+from bench import domoticz, replay
+
+PATH = "/weatherstation/updateweatherstation.php"
+START = 1760000000.0
+
+
+class Clock:
+    """The time module of the plugin, time() and monotonic() are the same"""
+
+    def __init__(self, now=START):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def start(tmp_path, clock):
+    """Function loading and starting the plugin, with the checkpoint in
+    tmp_path. Without the rate limit, unless a test sets one.
+    """
+
+    def start(options="rate=0", devices=None, log=None, **parameters):
+        parameters.setdefault("HomeFolder", str(tmp_path) + os.sep)
+        parameters["Mode5"] = options
+        plugin = domoticz.load_plugin(parameters, log=log)
+        plugin.time = clock
+        plugin.Devices.update(devices or {})
+        plugin.onStart()
+        return plugin
+
+    return start
+
+
+def utc(t):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t))
+
+
+def request(station="ST1", dateutc=None, **fields):
+    """Wunderground GET request"""
+    query = dict(ID=station, PASSWORD="x", dateutc=dateutc or "now", **fields)
+    url = PATH + "?" + "&".join("{}={}".format(k, v) for k, v in query.items())
+    return {"Verb": "GET", "URL": url.replace(" ", "+")}
+
+
+def send(plugin, clock, seconds=16, address="192.168.0.20", **fields):
+    """Move the clock and send a packet with the time of the station, returns
+    the status of the response
+    """
+    clock.now += seconds
+    fields.setdefault("dateutc", utc(clock.now))
+    connection = domoticz.Connection(Name="Station", Address=address)
+    plugin.onMessage(connection, request(**fields))
+    return connection.sent[-1]["Status"]
+
+
+def post(plugin, clock, seconds=16, station="PK1", **fields):
+    """Move the clock and send an Ecowitt packet, returns the status of the
+    response
+    """
+    clock.now += seconds
+    query = dict(PASSKEY=station, dateutc=utc(clock.now), **fields)
+    body = "&".join("{}={}".format(k, v) for k, v in query.items())
+    connection = domoticz.Connection(Name="Station", Address="192.168.0.20")
+    plugin.onMessage(
+        connection,
+        {
+            "Verb": "POST",
+            "URL": "/data/report/",
+            "Data": body.replace(" ", "+").encode(),
+        },
+    )
+    return connection.sent[-1]["Status"]
+
+
+def fetch(plugin, path, headers=None):
+    """Response to a GET request, with the status and the headers"""
+    connection = domoticz.Connection(Name="Client")
+    message = {"Verb": "GET", "URL": path}
+    if headers is not None:
+        message["Headers"] = headers
+    plugin.onMessage(connection, message)
+    return connection.sent[-1]
+
+
+def get(plugin, path):
+    return fetch(plugin, path)["Data"]
+
+
+def samples(plugin, name):
+    return [
+        line
+        for line in get(plugin, "/metrics").splitlines()
+        if line.startswith(name + "{")
+    ]
+
+
+# Spike filter
+
+
+def test_spike_replaced_by_last_good_value(start, clock):
+    plugin = start()
+    for _ in range(6):
+        send(plugin, clock, tempf=68)
+    send(plugin, clock, tempf=120)
+    station = plugin._plugin.stations["ST1"]
+    assert station.obs["temp"] == 20.0
+    assert plugin._plugin.valuesRejected() == {"temp": 1}
+
+
+def test_value_out_of_range_rejected_without_history(start, clock):
+    plugin = start()
+    send(plugin, clock, tempf=68)
+    send(plugin, clock, tempf=200)
+    assert plugin._plugin.stations["ST1"].obs["temp"] == 20.0
+    assert plugin._plugin.valuesRejected() == {"temp": 1}
+
+
+def test_median_follows_a_real_jump(start, clock):
+    plugin = start()
+    for _ in range(6):
+        send(plugin, clock, tempf=68)
+    for _ in range(8):
+        send(plugin, clock, tempf=86)
+    assert plugin._plugin.stations["ST1"].obs["temp"] == 30.0
+
+
+# Rain rate
+
+
+def test_rain_rate_from_the_daily_rain(start, clock):
+    plugin = start()
+    send(plugin, clock, dailyrainin=0.0, rainin=0.0)
+    # No history yet, the rate of the station is kept
+    assert plugin._plugin.stations["ST1"].obs["rainmm"] == 0.0
+    # 2.54 mm in 5 minutes
+    send(plugin, clock, seconds=300, dailyrainin=0.1, rainin=0.0)
+    assert plugin._plugin.stations["ST1"].obs["rainmm"] == 30.48
+
+
+def test_rain_rate_after_the_daily_reset(start, clock):
+    plugin = start()
+    send(plugin, clock, dailyrainin=0.5, rainin=0.0)
+    send(plugin, clock, seconds=120, dailyrainin=0.0, rainin=0.0)
+    send(plugin, clock, seconds=120, dailyrainin=0.0, rainin=0.0)
+    station = plugin._plugin.stations["ST1"]
+    assert station.obs["rainmm"] == 0.0
+    assert station.raincounter == 12.7
+
+
+# Rate limit
+
+
+def test_rate_limit_per_address(start, clock):
+    plugin = start(options="rate=60;burst=3")
+    statuses = [send(plugin, clock, seconds=0.1, tempf=n) for n in range(4)]
+    assert statuses == ["200 OK"] * 3 + ["429 Too Many Requests"]
+    assert send(plugin, clock, seconds=0, address="192.168.0.21") == "200 OK"
+    # A token per second
+    assert send(plugin, clock, seconds=1, tempf=60) == "200 OK"
+
+
+def test_rejected_requests_in_metrics(start, clock):
+    plugin = start(options="rate=1;burst=2")
+    send(plugin, clock)
+    assert samples(plugin, "pws_requests_rejected_total") == [
+        'pws_requests_rejected_total{reason="rate"} 0',
+        'pws_requests_rejected_total{reason="size"} 0',
+        'pws_requests_rejected_total{reason="path"} 0',
+        'pws_requests_rejected_total{reason="station"} 0',
+    ]
+    send(plugin, clock, seconds=0)
+    send(plugin, clock, seconds=0)
+    assert 'pws_requests_rejected_total{reason="rate"} 1' in samples(
+        plugin, "pws_requests_rejected_total"
+    )
+
+
+# Checkpoint
+
+
+def test_checkpoint_restores_the_rain_counter(start, clock):
+    plugin = start()
+    send(plugin, clock, dailyrainin=0.2, rainin=0.0, baromin=29.92)
+    total = plugin.Devices[plugin.unit.RAIN].sValue.split(";")[1]
+    assert total == "5.08"
+    plugin.onStop()
+    devices = dict(plugin.Devices)
+
+    # The daily rain was reset while Domoticz was stopped
+    plugin = start(devices=devices)
+    station = plugin._plugin.stations["ST1"]
+    assert station.prev_dailyrainin == 5.08
+    assert station.pressure.newest() is not None
+    send(plugin, clock, seconds=3600, dailyrainin=0.1, rainin=0.0)
+    assert plugin.Devices[plugin.unit.RAIN].sValue.split(";")[1] == "7.62"
+
+
+def test_checkpoint_restores_the_spike_filter(start, clock):
+    plugin = start()
+    for _ in range(6):
+        send(plugin, clock, tempf=68)
+    plugin.onStop()
+    devices = dict(plugin.Devices)
+
+    plugin = start(devices=devices)
+    send(plugin, clock, tempf=-40)
+    assert plugin._plugin.stations["ST1"].obs["temp"] == 20.0
+    assert plugin._plugin.valuesRejected() == {"temp": 1}
+
+
+def test_checkpoint_restores_the_rain_rate(start, clock):
+    plugin = start()
+    send(plugin, clock, dailyrainin=0.0, rainin=0.0)
+    plugin.onStop()
+    devices = dict(plugin.Devices)
+
+    plugin = start(devices=devices)
+    # 2.54 mm in 5 minutes, the first packet after the restart has a rate
+    send(plugin, clock, seconds=300, dailyrainin=0.1, rainin=0.0)
+    assert plugin._plugin.stations["ST1"].obs["rainmm"] == 30.48
+
+
+def test_checkpoint_of_another_hardware_not_restored(start, clock):
+    plugin = start()
+    send(plugin, clock, dailyrainin=0.2, rainin=0.0)
+    plugin.onStop()
+    plugin = start(HardwareID=2)
+    assert plugin._plugin.stations == {}
+
+
+# Statistics of the day
+
+
+def day_temperatures(plugin):
+    return [
+        plugin.Devices[u].sValue
+        for u in (plugin.unit.DAY_TEMP_MIN, plugin.unit.DAY_TEMP_MAX)
+    ]
+
+
+def test_daily_statistics_reset_at_midnight(start, clock):
+    plugin = start()
+    clock.now = plugin.next_midnight(START) - 3600
+    send(plugin, clock, tempf=68)
+    send(plugin, clock, tempf=50)
+    assert day_temperatures(plugin) == ["10.0", "20.0"]
+    clock.now = plugin.next_midnight(START) + 60
+    plugin.onHeartbeat()
+    send(plugin, clock, tempf=59)
+    assert day_temperatures(plugin) == ["15.0", "15.0"]
+
+
+def test_checkpoint_restores_the_daily_statistics(start, clock):
+    plugin = start()
+    clock.now = plugin.next_midnight(START) - 3600
+    send(plugin, clock, tempf=68)
+    send(plugin, clock, tempf=50)
+    plugin.onStop()
+    devices = dict(plugin.Devices)
+
+    # Restarted the same day
+    plugin = start(devices=devices)
+    send(plugin, clock, tempf=59)
+    assert day_temperatures(plugin) == ["10.0", "20.0"]
+    plugin.onStop()
+    devices = dict(plugin.Devices)
+
+    # Restarted the next day
+    clock.now = plugin.next_midnight(START) + 60
+    plugin = start(devices=devices)
+    send(plugin, clock, tempf=59)
+    assert day_temperatures(plugin) == ["15.0", "15.0"]
+
+
+# Link
+
+
+def test_silent_station_times_out(start, clock):
+    plugin = start()
+    send(plugin, clock, tempf=68)
+    plugin.onHeartbeat()
+    assert samples(plugin, "pws_station_timed_out") == [
+        'pws_station_timed_out{station="1"} 0'
+    ]
+    clock.now += plugin.LINK_TIMEOUT + 1
+    plugin.onHeartbeat()
+    assert plugin.Devices[plugin.unit.TEMP].TimedOut == 1
+    assert samples(plugin, "pws_station_timed_out") == [
+        'pws_station_timed_out{station="1"} 1'
+    ]
+    send(plugin, clock, tempf=68)
+    assert plugin.Devices[plugin.unit.TEMP].TimedOut == 0
+    assert samples(plugin, "pws_station_timed_out") == [
+        'pws_station_timed_out{station="1"} 0'
+    ]
+
+
+def test_timeout_disabled(start, clock):
+    plugin = start(options="rate=0;timeout=0")
+    send(plugin, clock, tempf=68)
+    clock.now += 86400
+    plugin.onHeartbeat()
+    assert plugin.Devices[plugin.unit.TEMP].TimedOut == 0
+
+
+def test_lost_packets_counted(start, clock):
+    plugin = start(options="rate=0;interval=16")
+    for seconds in (16, 16, 48, 16):
+        send(plugin, clock, seconds=seconds)
+    assert plugin._plugin.stations["ST1"].link.lost == 2
+
+
+# Duplicates and order
+
+
+def test_copy_of_a_packet_dropped(start, clock):
+    plugin = start()
+    dateutc = utc(clock.now + 16)
+    send(plugin, clock, dateutc=dateutc, tempf=68)
+    send(plugin, clock, seconds=5, dateutc=dateutc, tempf=68)
+    assert plugin._plugin.duplicatesDropped == 1
+
+
+def test_steady_station_without_time_not_dropped(start, clock):
+    plugin = start()
+    # The values do not change, the packets are equal
+    for _ in range(50):
+        send(plugin, clock, dateutc="now", tempf=68)
+    assert plugin._plugin.duplicatesDropped == 0
+    assert plugin._plugin.stations["ST1"].link.received == 50
+
+
+def test_retry_without_time_dropped(start, clock):
+    plugin = start()
+    send(plugin, clock, dateutc="now", tempf=68)
+    send(plugin, clock, seconds=1, dateutc="now", tempf=68)
+    assert plugin._plugin.duplicatesDropped == 1
+
+
+@pytest.mark.parametrize("interval", [2.5, 5])
+def test_realtime_station_without_time_not_dropped(start, clock, interval):
+    plugin = start()
+    for _ in range(50):
+        send(plugin, clock, seconds=interval, dateutc="now", realtime=1, rtfreq=5)
+    link = plugin._plugin.stations["ST1"].link
+    assert plugin._plugin.duplicatesDropped == 0
+    assert link.expected() == interval
+    # A copy still is, also within the shorter window
+    send(plugin, clock, seconds=0.5, dateutc="now", realtime=1, rtfreq=5)
+    assert plugin._plugin.duplicatesDropped == 1
+
+
+def test_older_packet_dropped(start, clock):
+    plugin = start()
+    send(plugin, clock, tempf=68)
+    send(plugin, clock, dateutc=utc(clock.now - 60), tempf=70)
+    assert plugin._plugin.outOfOrderDropped == 1
+    assert plugin._plugin.stations["ST1"].obs["temp"] == 20.0
+
+
+def test_wrong_clock_does_not_hold_back_the_packets(start, clock):
+    plugin = start()
+    send(plugin, clock, tempf=68)
+    # One packet from the future, eg. after the RTC of the console was reset
+    send(plugin, clock, dateutc=utc(clock.now + 86400 * 365), tempf=69)
+    for n in range(5):
+        send(plugin, clock, tempf=70 + n)
+    station = plugin._plugin.stations["ST1"]
+    assert plugin._plugin.outOfOrderDropped == 0
+    assert station.clockInvalid == 1
+    assert station.obs["time"] == clock.now
+
+
+# Stations
+
+
+def test_stations_over_the_limit_not_kept(start, clock):
+    errors = []
+    plugin = start(log=lambda level, message: errors.append(message))
+    stations = ["ST{}".format(n) for n in range(1, 7)]
+    for _ in range(3):
+        for station in stations:
+            send(plugin, clock, seconds=1, station=station, tempf=68)
+    assert sorted(plugin._plugin.stations) == stations[:4]
+    assert plugin._plugin.unknownStations == {"ST5", "ST6"}
+    assert len([m for m in errors if m.startswith("No units left")]) == 2
+
+
+def test_unknown_stations_bounded(start, clock):
+    plugin = start()
+    for n in range(100):
+        send(plugin, clock, seconds=1, station="ST{}".format(n))
+    assert len(plugin._plugin.stations) == 4
+    assert len(plugin._plugin.unknownStations) == plugin.MAX_UNKNOWN_STATIONS
+
+
+def test_unknown_requests_logged_once(start, clock):
+    messages = []
+    plugin = start(log=lambda level, message: messages.append(message))
+    for n in range(200):
+        get(plugin, "/scan/{}".format(n // 2))
+    errors = [m for m in messages if m.startswith("Unknown request")]
+    assert len(errors) == plugin.MAX_UNKNOWN_REQUESTS
+    assert messages.count("Further unknown requests are not logged") == 1
+    assert plugin._plugin.requestsRejected["path"] == 200
+
+
+def test_devices_of_the_stations(start, clock):
+    plugin = start()
+    send(plugin, clock, station="ST1", tempf=68)
+    send(plugin, clock, station="ST2", tempf=50)
+    assert plugin.Devices[plugin.unit.TEMP].sValue == "20.0"
+    second = plugin.STATION_UNITS + plugin.unit.TEMP
+    assert plugin.Devices[second].sValue == "10.0"
+    assert plugin.Devices[second].Name == "Teplota #2"
+
+
+def test_devices_created_when_reported(start, clock):
+    plugin = start()
+    send(plugin, clock, tempf=68)
+    assert plugin.unit.TEMP in plugin.Devices
+    assert plugin.unit.HUMIDITY not in plugin.Devices
+    assert plugin.unit.TEMP_HUM not in plugin.Devices
+    assert plugin.unit.WIND1 not in plugin.Devices
+    send(plugin, clock, tempf=68, humidity=50)
+    assert plugin.Devices[plugin.unit.HUMIDITY].nValue == 50
+    assert plugin.unit.TEMP_HUM in plugin.Devices
+
+
+def test_channel_with_and_without_humidity(start, clock):
+    plugin = start()
+    post(plugin, clock, temp1f=68, humidity1=50, temp2f=50)
+    first = plugin.Devices[plugin.unit.TEMP_CH]
+    second = plugin.Devices[plugin.unit.TEMP_CH + 1]
+    assert (first.Name, first.Type, first.sValue) == (
+        "Teplota + Vlhkost 1",
+        82,
+        "20.0;50;1",
+    )
+    assert (second.Name, second.Type, second.sValue) == ("Teplota 2", 80, "10.0")
+    assert plugin.unit.TEMP_CH + 2 not in plugin.Devices
+    plugin.onStop()
+    devices = dict(plugin.Devices)
+
+    # The existing devices are kept, also when the humidity is reported later
+    plugin = start(devices=devices)
+    post(plugin, clock, temp1f=68, humidity1=50, temp2f=50, humidity2=40)
+    assert plugin.Devices[plugin.unit.TEMP_CH + 1].Type == 80
+    assert plugin.Devices[plugin.unit.TEMP_CH + 1].sValue == "10.0"
+
+
+# Read requests
+
+
+def test_current_not_modified(start, clock):
+    plugin = start()
+    send(plugin, clock, tempf=68)
+    first = fetch(plugin, "/current.json")
+    etag = first["Headers"]["ETag"]
+    assert first["Status"] == "200 OK"
+    again = fetch(plugin, "/current.json", {"If-None-Match": etag})
+    assert again["Status"] == "304 Not Modified"
+    assert again["Headers"]["ETag"] == etag
+    assert "Data" not in again
+    # A new observation, a new body
+    send(plugin, clock, tempf=50)
+    changed = fetch(plugin, "/current.json", {"If-None-Match": etag})
+    assert changed["Status"] == "200 OK"
+    assert changed["Headers"]["ETag"] != etag
+    assert changed["Data"] != first["Data"]
+
+
+# Recording
+
+
+def test_recording_replays_the_same_bytes(tmp_path):
+    plugin = domoticz.load_plugin()
+    path = str(tmp_path / "record.jsonl.gz")
+    recorder = plugin.Recorder(path, 1048576)
+    bodies = [b"PASSKEY=A&tempf=68.0", b"PASSKEY=A&model=\xe9\xff&tempf=68.0", b""]
+    for body in bodies:
+        recorder.put("POST", "/data/report/", body, "192.168.0.20", START)
+    recorder.stop()
+    messages = [replay.to_message(p) for p in replay.read_corpus([path])]
+    assert [m.get("Data", b"") for m in messages] == bodies
+
+
+def test_recording_after_a_crash(tmp_path):
+    plugin = domoticz.load_plugin()
+    plugin.Recorder.FLUSH = 0.01
+    path = str(tmp_path / "record.jsonl.gz")
+    # Killed with Domoticz: the file is flushed, but never closed
+    crashed = plugin.Recorder(path, 1048576)
+    for n in range(3):
+        crashed.put("GET", "/crashed?{}".format(n), b"", "192.168.0.20", START)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and (
+        not os.path.exists(path) or len(replay.read_corpus([path])) < 3
+    ):
+        time.sleep(0.01)
+    assert len(replay.read_corpus([path])) == 3
+
+    recorder = plugin.Recorder(path, 1048576)
+    recorder.put("GET", "/started", b"", "192.168.0.20", START)
+    recorder.stop()
+    packets = replay.read_corpus([recorder.name(1), path])
+    assert [p["url"] for p in packets] == [
+        "/crashed?0",
+        "/crashed?1",
+        "/crashed?2",
+        "/started",
+    ]
+    crashed.stop()
+
+
+def test_rejections_logged_without_device_writes(start, clock):
+    messages = []
+    plugin = start(log=lambda level, message: messages.append(message), Mode4="ALLOWED")
+    for _ in range(500):
+        assert send(plugin, clock, seconds=1) == "403 Forbidden"
+    clock.now += 3600
+    plugin.onHeartbeat()
+    assert plugin._plugin.deviceWrites == 0
+    assert (
+        "Requests rejected, rate: 0, size: 0, unknown path: 0, "
+        "unknown station: 500" in messages
+    )
+    assert not [m for m in messages if m.startswith("Device writes")]
+
+
+# Pressure
+
+
+@pytest.mark.parametrize("altitude, difference", [("", 46), ("0", 0), ("800", 92)])
+def test_absolute_pressure_from_the_altitude(start, clock, altitude, difference):
+    plugin = start(Mode1=altitude)
+    send(plugin, clock, baromin=29.92)
+    relative = float(plugin.Devices[plugin.unit.BARO_REL].sValue.split(";")[0])
+    absolute = float(plugin.Devices[plugin.unit.BARO_ABS].sValue.split(";")[0])
+    assert relative == 1013
+    assert relative - absolute == difference
+
+
+# Aggregation
+
+
+def test_window_mean_and_maximum(start, clock):
+    plugin = start(Mode2="60")
+    plugin.onHeartbeat()
+    for tempf, windgustmph in ((68, 10), (50, 30), (50, 20)):
+        send(plugin, clock, seconds=10, tempf=tempf, windgustmph=windgustmph)
+    # Nothing is published before the window closes
+    assert plugin.unit.TEMP not in plugin.Devices
+    clock.now += 60
+    plugin.onHeartbeat()
+    assert plugin.Devices[plugin.unit.TEMP].sValue == "13.3"
+    assert plugin.Devices[plugin.unit.GUST].sValue == "13.4"
+
+
+def test_mean_wind_direction_around_north(start, clock):
+    plugin = start(Mode2="60")
+    plugin.onHeartbeat()
+    for direction in (359, 0, 0):
+        send(plugin, clock, seconds=10, winddir=direction, windspeedmph=10)
+    clock.now += 60
+    plugin.onHeartbeat()
+    assert plugin.Devices[plugin.unit.WIND1].sValue.split(";")[:2] == ["0", "N"]
@@ -0,0 +1,628 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Personal Weather Station
+#
+# Author: Xorfor
+#
+
+"""
+Conversions and derived values of the weather data. These do not depend on
+Domoticz, so they are shared by the plugin and the tools (eg. backfill.py).
+"""
+
+from bisect import bisect_right
+from calendar import timegm
+from functools import lru_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+################################################################################
+# Conversions
+################################################################################
+# Conversions of the units of the stations, as expressions of the value ("{}").
+# Their functions are compiled from the expressions, and the decoder of
+# plugin.py inlines the same expressions, so each formula is defined once.
+CONVERSIONS = {}
+
+
+def _conversion(name, expression, doc):
+    """Function of a conversion in CONVERSIONS, None stays None"""
+    function = eval(
+        "lambda value: None if value is None else {}".format(expression.format("value"))
+    )
+    function.__name__ = function.__qualname__ = name
+    function.__doc__ = doc
+    CONVERSIONS[function] = expression
+    return function
+
+
+# Rounding to decimals, of the scaled value as round(value, decimals) is
+# several times slower. A tie can round the other way (eg. 391.85 to 391.8),
+# so the values of the plugin and of backfill.py are all rounded this way.
+ROUNDING = "round(({}) * {scale}) / {scale}"
+round_decimals = eval(
+    "lambda value, decimals: {}".format(
+        ROUNDING.format("value", scale="10 ** decimals")
+    )
+)
+round_decimals.__name__ = round_decimals.__qualname__ = "round_decimals"
+round_decimals.__doc__ = "Value rounded to decimals, see ROUNDING"
+
+HUMIDITY_NORMAL = 0
+HUMIDITY_COMFORTABLE = 1
+HUMIDITY_DRY = 2
+HUMIDITY_WET = 3
+
+
+# Based on Mollier diagram (simplified)
+def humidity2status_indoor(hlevel, temperature):
+    if hlevel is None or temperature is None:
+        return None
+    if hlevel <= 30:
+        return HUMIDITY_DRY
+    if 35 <= hlevel <= 65 and 18 <= temperature <= 22:
+        return HUMIDITY_COMFORTABLE
+    if hlevel >= 70:
+        return HUMIDITY_WET
+    return HUMIDITY_NORMAL
+
+
+def humidity2status_outdoor(value):
+    if value is None:
+        return None
+    if value < 25:
+        return HUMIDITY_DRY
+    if 25 <= value <= 60:
+        return HUMIDITY_COMFORTABLE
+    if value > 60:
+        return HUMIDITY_WET
+    return HUMIDITY_NORMAL
+
+
+temperature_f2iso = _conversion(
+    "temperature_f2iso",
+    "({} - 32) / 1.8",
+    """Temperature conversion from Fahrenheit to ISO (Celsius)
+    Args:
+        value (float): temperature in Fahrenheit
+    Returns:
+        temperature in Celsius
+    """,
+)
+
+
+speed_mph2iso = _conversion(
+    "speed_mph2iso",
+    "{} * 0.44704",
+    """Speed conversion from mp/h to ISO (m/s)
+    Args:
+        value (float): speed in mp/h
+    Returns:
+        speed in m/s
+    """,
+)
+
+
+def speed_kmh2iso(value):
+    """Speed conversion from km/h to ISO (m/s)
+    Args:
+        value (float): speed in km/h
+    Returns:
+        speed in m/s
+    """
+    if value is None:
+        return None
+    else:
+        return value / 3.6
+
+
+def speed_knots2iso(value):
+    """Speed conversion from knots to ISO (m/s)
+    Args:
+        value (float): speed in knots
+    Returns:
+        speed in m/s
+    """
+    if value is None:
+        return None
+    else:
+        return value * 0.514444
+
+
+tenths = _conversion(
+    "tenths",
+    "{} / 10",
+    "Value sent in tenths of the unit (Weathercloud)",
+)
+
+
+# Compass points, in steps of 22.5 degrees (360/16)
+BEARINGS = (
+    "N",
+    "NNE",
+    "NE",
+    "ENE",
+    "E",
+    "ESE",
+    "SE",
+    "SSE",
+    "S",
+    "SSW",
+    "SW",
+    "WSW",
+    "W",
+    "WNW",
+    "NW",
+    "NNW",
+)
+BEARING_STEP = 360 / len(BEARINGS)
+
+
+def bearing2status(d):
+    """
+    Based on https://gist.github.com/RobertSudwarts/acf8df23a16afdb5837f
+    """
+    return BEARINGS[int((d + BEARING_STEP / 2) / BEARING_STEP) % len(BEARINGS)]
+
+
+BARO_FORECAST_NOINFO = 0
+BARO_FORECAST_SUNNY = 1
+BARO_FORECAST_PARTLYCLOUDY = 2
+BARO_FORECAST_CLOUDY = 3
+BARO_FORECAST_RAIN = 4
+BARO_FORECAST_UNKNOWN = 5
+BARO_FORECASTS = {
+    BARO_FORECAST_NOINFO,
+    BARO_FORECAST_SUNNY,
+    BARO_FORECAST_PARTLYCLOUDY,
+    BARO_FORECAST_CLOUDY,
+    BARO_FORECAST_RAIN,
+}
+
+
+def pressure2status(value):
+    if value is None:
+        return None
+    if value < 1000:
+        return BARO_FORECAST_RAIN
+    elif value < 1020:
+        return BARO_FORECAST_CLOUDY
+    elif value < 1030:
+        return BARO_FORECAST_PARTLYCLOUDY
+    else:
+        return BARO_FORECAST_SUNNY
+
+
+# Zambretti forecasts, number: text, Domoticz forecast
+ZAMBRETTI_FALLING = range(1, 10)
+ZAMBRETTI_STEADY = range(10, 20)
+ZAMBRETTI_RISING = range(20, 33)
+ZAMBRETTI = {
+    1: ("Settled fine", BARO_FORECAST_SUNNY),
+    2: ("Fine weather", BARO_FORECAST_SUNNY),
+    3: ("Fine, becoming less settled", BARO_FORECAST_PARTLYCLOUDY),
+    4: ("Fairly fine, showery later", BARO_FORECAST_PARTLYCLOUDY),
+    5: ("Showery, becoming more unsettled", BARO_FORECAST_RAIN),
+    6: ("Unsettled, rain later", BARO_FORECAST_RAIN),
+    7: ("Rain at times, worse later", BARO_FORECAST_RAIN),
+    8: ("Rain at times, becoming very unsettled", BARO_FORECAST_RAIN),
+    9: ("Very unsettled, rain", BARO_FORECAST_RAIN),
+    10: ("Settled fine", BARO_FORECAST_SUNNY),
+    11: ("Fine weather", BARO_FORECAST_SUNNY),
+    12: ("Fine, possibly showers", BARO_FORECAST_PARTLYCLOUDY),
+    13: ("Fairly fine, showers likely", BARO_FORECAST_PARTLYCLOUDY),
+    14: ("Showery, bright intervals", BARO_FORECAST_PARTLYCLOUDY),
+    15: ("Changeable, some rain", BARO_FORECAST_CLOUDY),
+    16: ("Unsettled, rain at times", BARO_FORECAST_RAIN),
+    17: ("Rain at frequent intervals", BARO_FORECAST_RAIN),
+    18: ("Very unsettled, rain", BARO_FORECAST_RAIN),
+    19: ("Stormy, much rain", BARO_FORECAST_RAIN),
+    20: ("Settled fine", BARO_FORECAST_SUNNY),
+    21: ("Fine weather", BARO_FORECAST_SUNNY),
+    22: ("Becoming fine", BARO_FORECAST_PARTLYCLOUDY),
+    23: ("Fairly fine, improving", BARO_FORECAST_PARTLYCLOUDY),
+    24: ("Fairly fine, possibly showers early", BARO_FORECAST_PARTLYCLOUDY),
+    25: ("Showery early, improving", BARO_FORECAST_CLOUDY),
+    26: ("Changeable, mending", BARO_FORECAST_CLOUDY),
+    27: ("Rather unsettled, clearing later", BARO_FORECAST_CLOUDY),
+    28: ("Unsettled, probably improving", BARO_FORECAST_CLOUDY),
+    29: ("Unsettled, short fine intervals", BARO_FORECAST_RAIN),
+    30: ("Very unsettled, finer at times", BARO_FORECAST_RAIN),
+    31: ("Stormy, possibly improving", BARO_FORECAST_RAIN),
+    32: ("Stormy, much rain", BARO_FORECAST_RAIN),
+}
+
+
+def zambretti(pressure, tendency):
+    """Zambretti forecast
+    Args:
+        pressure (float): pressure at sea level in hPa
+        tendency (float): pressure change in hPa over the last 3 hours
+    Returns:
+        (text, Domoticz forecast)
+    Ref:
+        https://en.wikipedia.org/wiki/Zambretti_Forecaster
+    """
+    if tendency <= -1.6:
+        z, numbers = 127 - 0.12 * pressure, ZAMBRETTI_FALLING
+    elif tendency >= 1.6:
+        z, numbers = 185 - 0.16 * pressure, ZAMBRETTI_RISING
+    else:
+        z, numbers = 144 - 0.13 * pressure, ZAMBRETTI_STEADY
+    z = min(max(round(z), numbers[0]), numbers[-1])
+    return ZAMBRETTI[z]
+
+
+def uv2status(value):
+    if value is None:
+        return None
+    if value < 3:
+        return 0
+    elif value < 6:
+        return 1
+    elif value < 8:
+        return 2
+    elif value < 11:
+        return 3
+    else:
+        return 4
+
+
+pressure_inches2iso = _conversion(
+    "pressure_inches2iso",
+    "{} * 33.86",
+    """Pressure conversion from inches Hg to ISO (hPa)
+    Args:
+        value (float): pressure in inches Hg
+    Returns:
+        pressure in hPa
+    """,
+)
+
+
+def pressure_mmhg2iso(value):
+    """Pressure conversion from mm Hg to ISO (hPa)
+    Args:
+        value (float): pressure in mm Hg
+    Returns:
+        pressure in hPa
+    """
+    if value is None:
+        return None
+    else:
+        return value * 1.33322
+
+
+def pressure_sea2station(value, altitude):
+    """Pressure at the altitude of the station, from the pressure at sea level
+    Args:
+        value (float): pressure at sea level in hPa
+        altitude (float): altitude in m
+    Returns:
+        pressure in hPa
+    Ref:
+        https://en.wikipedia.org/wiki/Barometric_formula
+    """
+    if value is None:
+        return None
+    else:
+        return value * (1 - 2.25577e-5 * altitude) ** 5.25588
+
+
+def distance_inch2iso(value):
+    """Distance conversion from inches to ISO (cm)
+    Args:
+        value (float): Distance in inches
+    Returns:
+        Distance in cm
+    """
+    if value is None:
+        return None
+    else:
+        return value * 2.54
+
+
+distance_inch2mm = _conversion(
+    "distance_inch2mm",
+    "{} * 25.4",
+    """Distance conversion from inches to mm
+    Args:
+        value (float): Distance in inches
+    Returns:
+        Distance in mm
+    """,
+)
+
+
+def dew_point(t, h):
+    """Calculate dewpoint
+    Args:
+        t (float): temperature in °C
+        h (float): relative humidity in %
+    Returns:
+        calculated dewpoint in °C
+    Ref:
+        https://www.ajdesigner.com/phphumidity/dewpoint_equation_dewpoint_temperature.php
+    """
+    return round((h / 100) ** (1 / 8) * (112 + 0.9 * t) + 0.1 * t - 112, 2)
+
+
+def wind_chill(t, v):
+    """Windchill temperature is defined only for temperatures at or below 10 °C
+    and wind speeds above 4.8 kilometres per hour.
+    Args:
+        t: temperature in °C
+        v: wind speed in m/s
+    Returns:
+        calculated windchill temperature in °C
+    Ref:
+        https://en.wikipedia.org/wiki/Wind_chill
+    """
+    # Calculation expects km/h instead of m/s, so
+    v = v * 3.6
+    if t < 10 and v > 4.8:
+        v = v**0.16
+        return round(13.12 + 0.6215 * t - 11.37 * v + 0.3965 * t * v, 1)
+    else:
+        return t
+
+
+WIND_SPEED_MS = 0
+WIND_SPEED_KMH = 1
+WIND_SPEED_MPH = 2
+WIND_SPEED_KNOTS = 3
+WIND_SPEED_BEAUFORT = 4
+WIND_SPEED_ISO = WIND_SPEED_MS
+WIND_SPEEDS = {
+    WIND_SPEED_MS,
+    WIND_SPEED_KMH,
+    WIND_SPEED_MPH,
+    WIND_SPEED_KNOTS,
+    WIND_SPEED_BEAUFORT,
+}
+
+
+# Factors from m/s to the other units
+WIND_SPEED_FACTORS = {
+    WIND_SPEED_KMH: 3.60000000,
+    WIND_SPEED_MPH: 2.23693629,
+    WIND_SPEED_KNOTS: 1.94384449,
+}
+# Lower bounds (m/s) of Beaufort 1..12
+BEAUFORT_BANDS = (0.3, 1.6, 3.4, 5.5, 8.0, 10.8, 13.9, 17.2, 20.8, 24.5, 28.5, 32.7)
+WIND_SPEED_OPTIONS = {
+    WIND_SPEED_MS: "0;m/s",
+    WIND_SPEED_KMH: "0;km/h",
+    WIND_SPEED_MPH: "0;mph",
+    WIND_SPEED_KNOTS: "0;kn",
+    WIND_SPEED_BEAUFORT: "0;bf",
+}
+
+
+def speed2unit(speed, unit):
+    """Convert the windspeed (in m/s) to the given unit
+    Args:
+        speed: windspeed in m/s
+        unit: the new unit for windspeed
+    Returns:
+        calculated windspeed for the given unit
+    """
+    if speed is None:
+        return None
+    if unit == WIND_SPEED_ISO:
+        return speed
+    if unit == WIND_SPEED_BEAUFORT:
+        return speed2beaufort(speed)
+    factor = WIND_SPEED_FACTORS.get(unit)
+    if factor is None:
+        return None
+    return round(speed * factor, 1)
+
+
+def speed2beaufort(speed):
+    """Beaufort number of a windspeed (in m/s), None when not valid"""
+    if not speed >= 0:
+        return None
+    return bisect_right(BEAUFORT_BANDS, speed)
+
+
+def speed2options(unit):
+    if unit in WIND_SPEED_OPTIONS:
+        return {"Custom": WIND_SPEED_OPTIONS[unit]}
+    else:
+        return {}
+
+
+def heat_index(temp, humidity):
+    """Calculate heat index (in C)
+    Formula can be found at https://en.wikipedia.org/wiki/Heat_index
+    Args:
+        temp    : temperature in C
+        humidity: in %
+    Returns:
+        calculated heat index
+    """
+    if 0 <= humidity <= 100 and temp >= 26:
+        c1 = -8.78469475556
+        c2 = 1.61139411
+        c3 = 2.33854883889
+        c4 = -0.14611605
+        c5 = -0.012308094
+        c6 = -0.0164248277778
+        c7 = 0.002211732
+        c8 = 0.00072546
+        c9 = -0.000003582
+
+        tempp = temp**2
+        humidityp = humidity**2
+
+        hi = (
+            c1
+            + c2 * temp
+            + c3 * humidity
+            + c4 * temp * humidity
+            + c5 * tempp
+            + c6 * humidityp
+            + c7 * tempp * humidity
+            + c8 * temp * humidityp
+            + c9 * tempp * humidityp
+        )
+    else:
+        hi = temp
+    return round(hi, 1)
+
+
+def float_or_none(value):
+    try:
+        return float(value)
+    except:
+        return None
+
+
+def int_or_none(value):
+    try:
+        return int(value)
+    except:
+        return None
+
+
+def dateutc2epoch(value):
+    """Seconds since the epoch of a dateutc of the stations
+
+    Args:
+        value: "YYYY-MM-DD HH:MM:SS" in UTC, as sent by the stations
+    Returns:
+        seconds, None when not in this format (eg. "now")
+    """
+    if value is None or len(value) != 19 or value[10] != " ":
+        return None
+    day = _day2epoch(value[:10])
+    if day is None:
+        return None
+    try:
+        hour, minute, second = int(value[11:13]), int(value[14:16]), int(value[17:19])
+    except ValueError:
+        return None
+    if hour > 23 or minute > 59 or second > 59 or value[13] != ":" or value[16] != ":":
+        return None
+    return day + hour * 3600 + minute * 60 + second
+
+
+@lru_cache(maxsize=8)
+def _day2epoch(day):
+    """Seconds since the epoch of a day "YYYY-MM-DD". The stations send the
+    same day all day, so the day is parsed only once.
+    """
+    try:
+        year, month, mday = int(day[:4]), int(day[5:7]), int(day[8:10])
+    except ValueError:
+        return None
+    if not (1 <= month <= 12 and 1 <= mday <= 31) or day[4] != "-" or day[7] != "-":
+        return None
+    return timegm((year, month, mday, 0, 0, 0))
+
+
+################################################################################
+# Batch functions
+################################################################################
+# Versions of the derived values and statuses for columns of data (eg. a chunk
+# of a CSV file), with None for missing values. NumPy is used for the derived
+# values when it is installed, otherwise the plain functions above are applied
+# per row. NumPy rounds by scaling, so a result can differ in the last decimal
+# for halfway values. The wind direction and the Beaufort scale are table
+# lookups, with the tables bound once per batch; the UV and pressure statuses
+# apply the functions above per value.
+def dew_point_batch(t, h):
+    """dew_point for sequences of temperatures (°C) and humidities (%)"""
+    if numpy is None:
+        return [
+            dew_point(t_, h_) if t_ is not None and h_ is not None else None
+            for t_, h_ in zip(t, h)
+        ]
+    t = numpy.array(t, dtype=float)
+    h = numpy.array(h, dtype=float)
+    with numpy.errstate(invalid="ignore"):
+        dp = numpy.round((h / 100) ** (1 / 8) * (112 + 0.9 * t) + 0.1 * t - 112, 2)
+    return _tolist(dp)
+
+
+def wind_chill_batch(t, v):
+    """wind_chill for sequences of temperatures (°C) and wind speeds (m/s)"""
+    if numpy is None:
+        return [
+            wind_chill(t_, v_) if t_ is not None and v_ is not None else None
+            for t_, v_ in zip(t, v)
+        ]
+    t = numpy.array(t, dtype=float)
+    v = numpy.array(v, dtype=float) * 3.6
+    with numpy.errstate(invalid="ignore"):
+        p = v**0.16
+        wc = numpy.round(13.12 + 0.6215 * t - 11.37 * p + 0.3965 * t * p, 1)
+        wc = numpy.where((t < 10) & (v > 4.8), wc, t)
+    wc[numpy.isnan(v)] = numpy.nan
+    return _tolist(wc)
+
+
+def heat_index_batch(temp, humidity):
+    """heat_index for sequences of temperatures (°C) and humidities (%)"""
+    if numpy is None:
+        return [
+            heat_index(t_, h_) if t_ is not None and h_ is not None else None
+            for t_, h_ in zip(temp, humidity)
+        ]
+    t = numpy.array(temp, dtype=float)
+    h = numpy.array(humidity, dtype=float)
+    with numpy.errstate(invalid="ignore"):
+        hi = (
+            -8.78469475556
+            + 1.61139411 * t
+            + 2.33854883889 * h
+            - 0.14611605 * t * h
+            - 0.012308094 * t**2
+            - 0.0164248277778 * h**2
+            + 0.002211732 * t**2 * h
+            + 0.00072546 * t * h**2
+            - 0.000003582 * t**2 * h**2
+        )
+        hi = numpy.round(numpy.where((0 <= h) & (h <= 100) & (t >= 26), hi, t), 1)
+    hi[numpy.isnan(h)] = numpy.nan
+    return _tolist(hi)
+
+
+def _tolist(values):
+    """NumPy array to a list, with None for NaN"""
+    return [None if value != value else value for value in values.tolist()]
+
+
+def bearing2status_batch(values):
+    """bearing2status for a sequence of wind directions"""
+    bearings, step, count = BEARINGS, BEARING_STEP, len(BEARINGS)
+    return [
+        bearings[int((d + step / 2) / step) % count] if d is not None else None
+        for d in values
+    ]
+
+
+def speed2unit_batch(values, unit):
+    """speed2unit for a sequence of windspeeds (in m/s)"""
+    if unit == WIND_SPEED_BEAUFORT:
+        bands = BEAUFORT_BANDS
+        return [
+            bisect_right(bands, v) if v is not None and v >= 0 else None for v in values
+        ]
+    return [speed2unit(v, unit) for v in values]
+
+
+def uv2status_batch(values):
+    """uv2status for a sequence of UV indexes"""
+    return [uv2status(v) for v in values]
+
+
+def pressure2status_batch(values):
+    """pressure2status for a sequence of pressures (hPa)"""
+    return [pressure2status(v) for v in values]
@@ -10,6 +10,18 @@
 <plugin key="xfr_pws" name="PWS" author="Xorfor" version="1.0.9" wikilink="https://github.com/Xorfor/Domoticz-PWS-Plugin">
     <params>
         <param field="Address" label="Port" width="40px" required="true" default="5000"/>
+        <param field="Mode1" label="Altitude (m)" width="60px" default="390"/>
+        <param field="Mode2" label="Aggregation" width="100px">
+            <options>
+                <option label="Off" value="0" default="true"/>
+                <option label="1 minute" value="60"/>
+                <option label="5 minutes" value="300"/>
+                <option label="10 minutes" value="600"/>
+            </options>
+        </param>
+        <param field="Mode3" label="Forward to (URLs)" width="300px" default=""/>
+        <param field="Mode4" label="Stations (PASSKEY/ID)" width="300px" default=""/>
+        <param field="Mode5" label="Options" width="300px" default=""/>
         <param field="Mode6" label="Debug" width="100px">
             <options>
                 <option label="True" value="Debug"/>
@@ -20,7 +32,46 @@
 </plugin>
 """
 import Domoticz
+import base64
+import gzip
+import http.client
+import json
+import math
+import os
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
 from enum import IntEnum, unique  # , auto
+from converters import (
+    humidity2status_indoor,
+    humidity2status_outdoor,
+    temperature_f2iso,
+    speed_mph2iso,
+    bearing2status,
+    pressure2status,
+    zambretti,
+    uv2status,
+    pressure_inches2iso,
+    pressure_sea2station,
+    distance_inch2mm,
+    dew_point,
+    wind_chill,
+    speed2unit,
+    speed2options,
+    WIND_SPEED_ISO,
+    WIND_SPEEDS,
+    heat_index,
+    float_or_none,
+    int_or_none,
+    dateutc2epoch,
+    tenths,
+    CONVERSIONS,
+    ROUNDING,
+)
 
 
 @unique
@@ -57,7 +108,24 @@ class unit(IntEnum):
     BATTERY = 25
     DEWPOINT_IN = 26
     HEAT_INDEX_IN = 27
-    
+    # Hardware wide devices, in the block of the first station
+    TIMING = 28
+    # Multi-channel sensors (Ecowitt), first unit of each range of channels
+    TEMP_CH = 29
+    SOIL_CH = 37
+    PM25_CH = 45
+    LIGHTNING = 49
+    LIGHTNING_NUM = 50
+    WH65_BATTERY = 51
+    # Statistics of the day
+    DAY_TEMP_MIN = 52
+    DAY_TEMP_MAX = 53
+    DAY_TEMP_MEAN = 54
+    DAY_GUST = 55
+    DAY_RAIN_HOURS = 56
+    DAY_SUN_HOURS = 57
+    # Health of the link with the station
+    LINK = 58
 
 
 @unique
@@ -73,335 +141,1590 @@ class used(IntEnum):
     YES = 1
 
 
+# Number of units reserved per station, so the devices of a station are
+# base + unit. Domoticz allows units 1..255, so there is room for 4 stations.
+STATION_UNITS = 64
+STATION_BASES = range(0, 256 - STATION_UNITS + 1, STATION_UNITS)
+
+# Channels of the multi-channel sensors, see unit.TEMP_CH etc.
+TEMP_CHANNELS = 8
+SOIL_CHANNELS = 8
+PM25_CHANNELS = 4
+
+
+class Station:
+    """
+        Context of a weather station, found by its PASSKEY (Ecowitt) or ID
+        (Wunderground). Each station has its own block of units, starting at
+        base, and its own rain counter.
+    """
+
+    def __init__(self, key, base):
+        self.key = key
+        self.base = base
+        self.address = None
+        self.protocol = None
+        self.raincounter = None
+        self.prev_dailyrainin = None
+        # Last observation, including the derived values, and its time
+        self.obs = None
+        self.updated = None
+        # Observations of the current window, when aggregating
+        self.window = None
+        self.pressure = PressureHistory()
+        self.rain = RainRate()
+        self.spikes = SpikeFilter()
+        self.daily = DailyStats(time.time())
+        self.link = LinkHealth()
+        # Clock of the observations, see clock()
+        self.time = None
+        self.skew = None
+        # Last time sent by the station which was not off, see ordered()
+        self.obstime = None
+        self.gaps = 0
+        self.clockInvalid = 0
+        # Rows of BasePlugin.__UNITS by unit: of the devices which exist, and
+        # of the devices which are created when their fields are reported
+        self.units = {}
+        self.pending = []
+        # Rows of the multi-channel devices which exist, in unit order
+        self.channels = []
+
+    def state(self):
+        """State for the checkpoint"""
+        return {
+            "base": self.base,
+            "raincounter": self.raincounter,
+            "prev_dailyrainin": self.prev_dailyrainin,
+            "obs": self.obs,
+            "pressure": self.pressure.state(),
+            "spikes": self.spikes.state(),
+            "rain": self.rain.state(),
+            "daily": self.daily.state(),
+        }
+
+    def restore(self, state):
+        self.raincounter = state.get("raincounter")
+        self.prev_dailyrainin = state.get("prev_dailyrainin")
+        self.obs = state.get("obs")
+        self.pressure.restore(state.get("pressure") or {})
+        self.spikes.restore(state.get("spikes") or {})
+        self.rain.restore(state.get("rain") or {})
+        self.daily.restore(state.get("daily") or {})
+
+    def clock(self, obstime, arrival):
+        """Time of an observation: the time the station sent (dateutc), or the
+        arrival time when the station did not send it or its clock is off by
+        more than MAX_CLOCK_SKEW. Also keeps the skew of the clock and counts
+        the gaps between the observations.
+        Args:
+            obstime: seconds since the epoch of dateutc, None when not sent
+            arrival: seconds since the epoch of the arrival
+        Returns:
+            seconds since the epoch
+        """
+        if obstime is not None:
+            self.skew = arrival - obstime
+            if abs(self.skew) > MAX_CLOCK_SKEW:
+                self.clockInvalid += 1
+                obstime = None
+            elif self.obstime is None or obstime > self.obstime:
+                self.obstime = obstime
+        t = arrival if obstime is None else obstime
+        if self.time is not None and t - self.time > CLOCK_GAP:
+            self.gaps += 1
+        self.time = t
+        return t
+
+    def ordered(self, obstime, arrival):
+        """Whether an observation is not older than the last one. Only times
+        which clock() accepts are compared, so one packet with a wrong clock
+        does not hold back the packets after it.
+        """
+        return (
+            self.obstime is None
+            or obstime >= self.obstime
+            or abs(arrival - obstime) > MAX_CLOCK_SKEW
+        )
+
+    def number(self):
+        """Number of the station, 1 for the first one"""
+        return self.base // STATION_UNITS + 1
+
+    def name(self, name):
+        """Device name, the devices of the first station keep the plain name"""
+        if self.base == 0:
+            return name
+        return "{} #{}".format(name, self.number())
+
+
+# Altitude (m) of the hardware without the Altitude parameter, which was added
+# later: the 46 hPa between the relative and absolute pressure used before
+DEFAULT_ALTITUDE = 390
+
+# Seconds by which the clock of a station may differ from the arrival time,
+# eg. for packets which were sent later. Otherwise the arrival time is used.
+MAX_CLOCK_SKEW = 3600
+# Seconds between the observations of a station which are counted as a gap
+CLOCK_GAP = 300
+
+# Seconds after which a connection of a station without requests is closed
+CONNECTION_IDLE = 30
+
+# Seconds of silence after which the devices of a station are marked as timed
+# out, and between the updates of the link device
+LINK_TIMEOUT = 600
+LINK_INTERVAL = 300
+
+HTTP_OK = {
+    "Status": "200 OK",
+    "Headers": {"Content-Type": "text/plain", "Connection": "keep-alive"},
+    "Data": "success",
+}
+HTTP_NOT_FOUND = {
+    "Status": "404 Not Found",
+    "Headers": {"Content-Type": "text/plain", "Connection": "close"},
+    "Data": "",
+}
+HTTP_FORBIDDEN = {
+    "Status": "403 Forbidden",
+    "Headers": {"Content-Type": "text/plain", "Connection": "close"},
+    "Data": "",
+}
+HTTP_TOO_LARGE = {
+    "Status": "413 Payload Too Large",
+    "Headers": {"Content-Type": "text/plain", "Connection": "close"},
+    "Data": "",
+}
+HTTP_TOO_MANY_REQUESTS = {
+    "Status": "429 Too Many Requests",
+    "Headers": {
+        "Content-Type": "text/plain",
+        "Connection": "close",
+        "Retry-After": "60",
+    },
+    "Data": "",
+}
+
+# Maximum size of the URL and of the body of a request, in bytes
+MAX_REQUEST_SIZE = 8192
+# Requests per minute and burst of a source address, see RateLimit
+REQUEST_RATE = 60
+REQUEST_BURST = 10
+# Keys of the stations which are not handled (not allowed, or no units left),
+# remembered to log them once
+MAX_UNKNOWN_STATIONS = 16
+# Unknown requests (verb, path), remembered to log them once
+MAX_UNKNOWN_REQUESTS = 16
+
+
+class WritePolicy:
+    """
+        When to write a device. The device is written when one of its values
+        moved past the deadband since the last write, or when the last write
+        is older than the interval. Devices without a policy are written for
+        every packet.
+            deadband, minimum absolute change of a value
+            relative, minimum change of a value, relative to the last write
+            interval, seconds after which the device is written anyway
+    """
+
+    def __init__(self, deadband=0, relative=0, interval=300):
+        self.deadband = deadband
+        self.relative = relative
+        self.interval = interval
+
+    def due(self, last, values, now):
+        if last is None:
+            return True
+        lastTime, lastValues = last
+        if now - lastTime >= self.interval or len(values) != len(lastValues):
+            return True
+        for old, new in zip(lastValues, values):
+            if old == new:
+                continue
+            if not isinstance(old, float) or not isinstance(new, float):
+                return True
+            # Small margin for the rounding of the values
+            if abs(new - old) + 1e-9 >= max(self.deadband, self.relative * abs(old)):
+                return True
+        return False
+
+
+class RecentPackets:
+    """Keys of the recently handled packets, to recognize copies
+
+    Bounded: the oldest key is dropped when there are more than SIZE keys, and
+    a key is forgotten ttl seconds after it was first seen. A copy does not
+    extend the time, so equal packets are only dropped within that time.
+    """
+
+    SIZE = 256
+    TTL = 600
+    # Seconds in which an equal packet without a time is a copy, eg. of a
+    # retry, at most. Stations in the realtime mode of Wunderground send
+    # every few seconds (rtfreq=5), so see retry().
+    RETRY_TTL = 2
+    # Part of the interval of the station in which an equal packet is a copy
+    RETRY_PART = 0.25
+
+    def __init__(self):
+        self.keys = OrderedDict()
+
+    @classmethod
+    def retry(cls, station):
+        """Seconds in which an equal packet without a time of the station is a
+        copy: RETRY_TTL, and a part of its interval when that is shorter
+        """
+        if station is not None:
+            expected = station.link.expected()
+            if expected:
+                return min(cls.RETRY_TTL, expected * cls.RETRY_PART)
+        return cls.RETRY_TTL
+
+    def seen(self, key, ttl=TTL):
+        """Whether the key was seen in the last ttl seconds, otherwise the key
+        is remembered
+        """
+        now = time.monotonic()
+        expires = self.keys.get(key)
+        if expires is not None and expires > now:
+            return True
+        self.keys[key] = now + ttl
+        self.keys.move_to_end(key)
+        if len(self.keys) > self.SIZE:
+            self.keys.popitem(last=False)
+        return False
+
+
+class RateLimit:
+    """Token bucket per source address
+
+    A source can send burst requests at once, and then rate requests per
+    second. The buckets are a bounded LRU: the least recently seen source is
+    dropped when there are more than SIZE, which gives it a full bucket again.
+    """
+
+    SIZE = 256
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = OrderedDict()
+
+    def allow(self, source, now):
+        """Whether a request of the source is allowed, which takes a token"""
+        bucket = self.buckets.get(source)
+        if bucket is None:
+            tokens = self.burst
+            if len(self.buckets) >= self.SIZE:
+                self.buckets.popitem(last=False)
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            self.buckets.move_to_end(source)
+        if tokens < 1:
+            self.buckets[source] = (tokens, now)
+            return False
+        self.buckets[source] = (tokens - 1, now)
+        return True
+
+
+# metric, type, description, ((field, labels), ...)
+METRICS = (
+    (
+        "pws_temperature_celsius",
+        "gauge",
+        "Temperature",
+        (("temp", ',sensor="outdoor"'), ("tempin", ',sensor="indoor"')),
+    ),
+    ("pws_dew_point_celsius", "gauge", "Dew point", (("dewpt", ""),)),
+    ("pws_wind_chill_celsius", "gauge", "Wind chill", (("windchill", ""),)),
+    (
+        "pws_humidity_percent",
+        "gauge",
+        "Relative humidity",
+        (("humidity", ',sensor="outdoor"'), ("humidityin", ',sensor="indoor"')),
+    ),
+    ("pws_wind_speed_ms", "gauge", "Wind speed", (("windspeedms", ""),)),
+    ("pws_wind_gust_ms", "gauge", "Wind gust", (("windgustms", ""),)),
+    ("pws_wind_direction_degrees", "gauge", "Wind direction", (("winddir", ""),)),
+    (
+        "pws_pressure_hpa",
+        "gauge",
+        "Pressure",
+        (("baromrel", ',type="relative"'), ("baromabs", ',type="absolute"')),
+    ),
+    (
+        "pws_solar_radiation_wm2",
+        "gauge",
+        "Solar radiation",
+        (("solarradiation", ""),),
+    ),
+    ("pws_uv_index", "gauge", "UV index", (("uv", ""),)),
+    ("pws_rain_rate_mm_per_hour", "gauge", "Rain rate", (("rainmm", ""),)),
+    ("pws_rain_daily_mm", "gauge", "Rain today", (("dailyrainmm", ""),)),
+    ("pws_updated_seconds", "gauge", "Time of the update", (("updated", ""),)),
+    (
+        "pws_observation_seconds",
+        "gauge",
+        "Time of the observation, by the clock of the station",
+        (("time", ""),),
+    ),
+    (
+        "pws_clock_skew_seconds",
+        "gauge",
+        "Arrival time minus the time sent by the station",
+        (("skew", ""),),
+    ),
+    (
+        "pws_observation_gaps_total",
+        "counter",
+        "Gaps of more than 5 minutes between the observations",
+        (("gaps", ""),),
+    ),
+    (
+        "pws_clock_invalid_total",
+        "counter",
+        "Observations with a station time which was off by more than an hour",
+        (("clockinvalid", ""),),
+    ),
+    (
+        "pws_packet_jitter_seconds",
+        "gauge",
+        "Mean deviation of the packet intervals from the expected interval",
+        (("jitter", ""),),
+    ),
+    (
+        "pws_packets_lost_total",
+        "counter",
+        "Packets which did not arrive, estimated from the packet intervals",
+        (("lost", ""),),
+    ),
+    (
+        "pws_station_timed_out",
+        "gauge",
+        "1 when the devices of the station are marked as timed out",
+        (("timedout", ""),),
+    ),
+)
+
+
+class Snapshot:
+    """Responses for the read requests (eg. GET /current.json), which are built
+    on the first request after a new observation and then served as they are.
+    Args:
+        builders: path: (content type, function returning the body)
+        volatile: paths which are built for every request, eg. of counters
+            which change without a new observation
+    """
+
+    def __init__(self, builders, volatile=()):
+        self.builders = builders
+        self.volatile = frozenset(volatile)
+        self.responses = {}
+
+    def invalidate(self):
+        self.responses.clear()
+
+    def response(self, path, etag=None):
+        """Response for the path, "304 Not Modified" when etag matches"""
+        response = self.responses.get(path)
+        if response is None:
+            contenttype, build = self.builders[path]
+            body = build()
+            response = {
+                "Status": "200 OK",
+                "Headers": {
+                    "Content-Type": contenttype,
+                    "ETag": '"{:08x}"'.format(zlib.crc32(body.encode("utf-8"))),
+                    "Cache-Control": "no-cache",
+                    "Connection": "keep-alive",
+                },
+                "Data": body,
+            }
+            if path not in self.volatile:
+                self.responses[path] = response
+        if etag is not None and etag == response["Headers"]["ETag"]:
+            return {
+                "Status": "304 Not Modified",
+                "Headers": {
+                    "ETag": etag,
+                    "Cache-Control": "no-cache",
+                    "Connection": "keep-alive",
+                },
+            }
+        return response
+
+
+def channel_units(temperature, default, status):
+    """Rows of the multi-channel devices for BasePlugin.__UNITS
+
+    A temperature channel is a "Temp + Hum" device when the sensor also
+    reports the humidity, otherwise a temperature device.
+    Args:
+        temperature, default, status: write policies of the devices
+    Returns:
+        list of rows, in unit order
+    """
+    rows = []
+    for n in range(1, TEMP_CHANNELS + 1):
+        fields = ("temp{}".format(n), "humidity{}".format(n))
+        rows.append(
+            [unit.TEMP_CH + n - 1, "Teplota + Vlhkost {}".format(n), 82, 1, {},
+             used.YES, temperature, fields]
+        )
+        rows.append(
+            [unit.TEMP_CH + n - 1, "Teplota {}".format(n), 80, 5, {}, used.YES,
+             temperature, fields[:1]]
+        )
+    for n in range(1, SOIL_CHANNELS + 1):
+        rows.append(
+            [unit.SOIL_CH + n - 1, "Vlhkost půdy {}".format(n), 243, 6, {},
+             used.YES, default, ("soilmoisture{}".format(n),)]
+        )
+    for n in range(1, PM25_CHANNELS + 1):
+        rows.append(
+            [unit.PM25_CH + n - 1, "PM2.5 {}".format(n), 243, 31,
+             {"Custom": "0;µg/m³"}, used.YES, default, ("pm25_{}".format(n),)]
+        )
+    rows.append(
+        [unit.LIGHTNING, "Blesky (vzdálenost)", 243, 31, {"Custom": "0;km"},
+         used.YES, default, ("lightning",)]
+    )
+    rows.append(
+        [unit.LIGHTNING_NUM, "Blesky (počet)", 243, 31, {"Custom": "0;"},
+         used.YES, default, ("lightningnum",)]
+    )
+    rows.append(
+        [unit.WH65_BATTERY, "Baterie WH65", 243, 22, {}, used.YES, status,
+         ("wh65batt",)]
+    )
+    return rows
+
+
 class BasePlugin:
     #
-    # Devices
+    # Device write policies, see WritePolicy
+    __DEFAULT = WritePolicy()
+    __TEMPERATURE = WritePolicy(deadband=0.2)
+    __SOLAR = WritePolicy(deadband=1, relative=0.05)
+    __STATUS = WritePolicy(interval=1800)
 
+    #
+    # Devices
     __UNITS = [
-        # id, name, type, subtype, options, used
-        [unit.TEMP_IND, "Teplota (vnitřní)", 80, 5, {}, used.YES],
-        [unit.TEMP, "Teplota", 80, 5, {}, used.YES],
-        [unit.DEWPOINT, "Rosný bod", 80, 5, {}, used.YES],
-        [unit.DEWPOINT_IN, "Rosný bod (vnitřní)", 80, 5, {}, used.YES],
-        [unit.CHILL, "Pocitová teplota", 80, 5, {}, used.YES],
-        [unit.HUMIDITY, "Vlhkost", 81, 1, {}, used.YES],
-        [unit.HUMIDITY_IND, "Vlhkost (vnitřní)", 81, 1, {}, used.YES],
-        [unit.TEMP_HUM, "Teplota + Vlhkost", 82, 1, {}, used.YES],
-        [unit.THB, "THB", 84, 1, {}, used.YES],
-        [unit.RAIN, "Srážky", 85, 1, {}, used.YES],
-        [unit.WIND1, "Vítr", 86, 1, {}, used.YES],
-        [unit.WIND2, "Vítr", 86, 4, {}, used.YES],
-        [unit.UVI, "UVI", 87, 1, {}, used.YES],
-        [unit.UV_ALERT, "UV Varování", 243, 22, {}, used.YES],
-        [unit.SOLAR, "Solární radiace", 243, 2, {}, used.YES],
-        [unit.WINDSPEED, "Rychlost větru", 243, 31, {"Custom": "0;m/s"}, used.YES],
-        [unit.WIND_DIRECTION, "Směr větru", 243, 31, {"Custom": "0;°"}, used.YES],
-        [unit.GUST, "Nárazy větru", 243, 31, {"Custom": "0;m/s"}, used.YES],
-        [unit.STATION, "Meteostanice", 243, 19, {}, used.YES],
-        [unit.BARO_REL, "Tlak (relativní)", 243, 26, {}, used.YES],
-        [unit.BARO_ABS, "Tlak (absoultní)", 243, 26, {}, used.YES],
-        [unit.RAIN_RATE, "Míra srážek", 243, 31, {"Custom": "0;mm/h"}, used.YES],
-        [unit.HEAT_INDEX, "Tepelný index", 80, 5, {}, used.YES],
-        [unit.HEAT_INDEX_IN, "Tepelný index (vnitřní)", 80, 5, {}, used.YES],
-        [unit.BATTERY, "Vyměnit baterie", 243, 22, {}, used.YES],
-    ]
+        # id, name, type, subtype, options, used, write policy, fields. A device
+        # is created when the station reports all its fields.
+        [unit.TEMP_IND, "Teplota (vnitřní)", 80, 5, {}, used.YES, __TEMPERATURE, ("tempin",)],
+        [unit.TEMP, "Teplota", 80, 5, {}, used.YES, __TEMPERATURE, ("temp",)],
+        [unit.DEWPOINT, "Rosný bod", 80, 5, {}, used.YES, __TEMPERATURE, ("dewpt",)],
+        [unit.DEWPOINT_IN, "Rosný bod (vnitřní)", 80, 5, {}, used.YES, __TEMPERATURE, ("tempin", "humidityin")],
+        [unit.CHILL, "Pocitová teplota", 80, 5, {}, used.YES, __TEMPERATURE, ("windchill",)],
+        [unit.HUMIDITY, "Vlhkost", 81, 1, {}, used.YES, __DEFAULT, ("humidity",)],
+        [unit.HUMIDITY_IND, "Vlhkost (vnitřní)", 81, 1, {}, used.YES, __DEFAULT, ("humidityin",)],
+        [unit.TEMP_HUM, "Teplota + Vlhkost", 82, 1, {}, used.YES, __TEMPERATURE, ("temp", "humidity")],
+        [unit.THB, "THB", 84, 1, {}, used.YES, __TEMPERATURE, ("temp", "humidity", "baromrel")],
+        [unit.RAIN, "Srážky", 85, 1, {}, used.YES, None, ("dailyrainmm",)],
+        [unit.WIND1, "Vítr", 86, 1, {}, used.YES, __DEFAULT, ("winddir", "windspeedms")],
+        [unit.WIND2, "Vítr", 86, 4, {}, used.YES, __DEFAULT, ("winddir", "windspeedms")],
+        [unit.UVI, "UVI", 87, 1, {}, used.YES, __DEFAULT, ("uv",)],
+        [unit.UV_ALERT, "UV Varování", 243, 22, {}, used.YES, __STATUS, ("uv",)],
+        [unit.SOLAR, "Solární radiace", 243, 2, {}, used.YES, __SOLAR, ("solarradiation",)],
+        [unit.WINDSPEED, "Rychlost větru", 243, 31, {"Custom": "0;m/s"}, used.YES, __DEFAULT, ("windspeedms",)],
+        [unit.WIND_DIRECTION, "Směr větru", 243, 31, {"Custom": "0;°"}, used.YES, __DEFAULT, ("winddir",)],
+        [unit.GUST, "Nárazy větru", 243, 31, {"Custom": "0;m/s"}, used.YES, __DEFAULT, ("windgustms",)],
+        [unit.STATION, "Meteostanice", 243, 19, {}, used.YES, __STATUS, ()],
+        [unit.BARO_REL, "Tlak (relativní)", 243, 26, {}, used.YES, __DEFAULT, ("baromrel",)],
+        [unit.BARO_ABS, "Tlak (absoultní)", 243, 26, {}, used.YES, __DEFAULT, ("baromabs",)],
+        [unit.RAIN_RATE, "Míra srážek", 243, 31, {"Custom": "0;mm/h"}, used.YES, __DEFAULT, ("rainmm",)],
+        [unit.HEAT_INDEX, "Tepelný index", 80, 5, {}, used.YES, __TEMPERATURE, ("temp", "humidity")],
+        [unit.HEAT_INDEX_IN, "Tepelný index (vnitřní)", 80, 5, {}, used.YES, __TEMPERATURE, ("tempin", "humidityin")],
+        [unit.BATTERY, "Vyměnit baterie", 243, 22, {}, used.YES, __STATUS, ("lowbatt",)],
+        [unit.DAY_TEMP_MIN, "Teplota (dnes min)", 80, 5, {}, used.NO, __DEFAULT, ("temp",)],
+        [unit.DAY_TEMP_MAX, "Teplota (dnes max)", 80, 5, {}, used.NO, __DEFAULT, ("temp",)],
+        [unit.DAY_TEMP_MEAN, "Teplota (dnes průměr)", 80, 5, {}, used.NO, __TEMPERATURE, ("temp",)],
+        [unit.DAY_GUST, "Nárazy větru (dnes max)", 243, 31, {"Custom": "0;m/s"}, used.NO, __DEFAULT, ("windgustms",)],
+        [unit.DAY_RAIN_HOURS, "Hodiny srážek (dnes)", 243, 31, {"Custom": "0;h"}, used.NO, __DEFAULT, ("rainmm",)],
+        [unit.DAY_SUN_HOURS, "Hodiny slunce (dnes)", 243, 31, {"Custom": "0;h"}, used.NO, __DEFAULT, ("solarradiation",)],
+        [unit.LINK, "Spojení", 243, 19, {}, used.NO, __STATUS, ()],
+    ] + channel_units(__TEMPERATURE, __DEFAULT, __STATUS)
 
     def __init__(self):
         self.enabled = False
         self.httpServerConn = None
         self.httpServerConns = {}
-        self.raincounter = None
-        self.prev_dailyrainin = None
+        self.httpServerActivity = {}
+        self.connectionsReaped = 0
+        self.recentPackets = RecentPackets()
+        # Current conditions, for dashboards and scripts
+        self.snapshot = Snapshot(
+            {
+                "/current.json": ("application/json", self.currentJson),
+                "/metrics": ("text/plain; version=0.0.4", self.currentMetrics),
+            },
+            # The counters change with every request, also rejected ones
+            volatile=("/metrics",),
+        )
+        self.duplicatesDropped = 0
+        self.outOfOrderDropped = 0
+        self.stations = {}
+        self.routes = {}
+        self.unknownRequests = set()
+        # Admission control, see handleMessage
+        self.allowedStations = set()
+        self.unknownStations = set()
+        self.maxRequestSize = MAX_REQUEST_SIZE
+        self.rateLimit = None
+        self.requestsRejected = dict.fromkeys(("rate", "size", "path", "station"), 0)
+        self.aggregation = 0
+        self.windowEnd = 0
+        # Health of the links, see LinkHealth
+        self.linkInterval = None
+        self.linkTimeout = LINK_TIMEOUT
+        self.nextLink = 0
+        self.altitude = 0
+        # Wind speed unit of the Domoticz settings, for the custom wind devices
+        self.windunit = WIND_SPEED_ISO
+        self.checkpoint = None
+        self.policies = {}
+        self.lastWrites = {}
+        self.deviceWrites = 0
+        self.deviceWritesSuppressed = 0
+        self.nextStatistics = 0
+        # Stage timers of onMessage, None when not enabled
+        self.timer = None
+        self.timingInterval = 0
+        self.nextTiming = 0
+        # Forwarding of the packets to upstream servers, None when not used
+        self.forwarder = None
+        self.forwardFailuresReported = 0
+        # Recording of the raw requests, None when not enabled
+        self.recorder = None
+        self.recordFailuresReported = 0
 
     def onConnect(self, Connection, Status, Description):
-        Domoticz.Debug(
-            "onConnect {}={}:{} {}-{}".format(
-                Connection.Name,
-                Connection.Address,
-                Connection.Port,
-                Status,
-                Description,
-            )
+        Debug(
+            "onConnect {}={}:{} {}-{}",
+            Connection.Name,
+            Connection.Address,
+            Connection.Port,
+            Status,
+            Description,
         )
-        Domoticz.Debug(str(Connection))
+        Debug("{}", Connection)
         self.httpServerConns[Connection.Name] = Connection
+        self.httpServerActivity[Connection.Name] = time.monotonic()
 
     def onDisconnect(self, Connection):
-        Domoticz.Debug(
-            "onDisconnect {}={}:{}".format(
-                Connection.Name, Connection.Address, Connection.Port
-            )
+        Debug(
+            "onDisconnect {}={}:{}",
+            Connection.Name,
+            Connection.Address,
+            Connection.Port,
         )
-        if Connection.Name in self.httpServerConns:
-            del self.httpServerConns[Connection.Name]
+        self.httpServerConns.pop(Connection.Name, None)
+        self.httpServerActivity.pop(Connection.Name, None)
+
+    def onStop(self):
+        Debug("onStop")
+        if self.checkpoint is not None and self.checkpoint.dirty:
+            self.saveCheckpoint()
+        if self.forwarder is not None:
+            self.forwarder.stop()
+        if self.recorder is not None:
+            self.recorder.stop()
 
     def onHeartbeat(self):
-        Domoticz.Debug("onHeartbeat")
-
-    def onMessage(self, Connection, Data):
-        Domoticz.Debug(
-            "onMessage {}={}:{}".format(
-                Connection.Name, Connection.Address, Connection.Port
-            )
-        )
-        DumpHTTPResponseToLog(Data)
-        dataIsValid = False
-        # Incoming Requests
-        if "Verb" in Data:
-            strVerb = Data["Verb"]
-            strURL = Data["URL"]
-            Domoticz.Debug("Request {}".format(strVerb))
-            if strVerb == "GET":
-                protocol = "Wunderground"
-                Domoticz.Debug("TK edit")
-                Domoticz.Debug(strURL)
-                strData = strURL #.split("?")[1]
-                Domoticz.Debug("strData: {}".format(strData))
-                # Convert URL parameters to dict for generic update of the devices
-                data = dict(item.split("=") for item in strData.split("&"))
-                Domoticz.Debug("data: {}".format(data))
-                if len(data) > 0:
-                    dataIsValid = True
-                    # Get data
-                    temp = temperature_f2iso(float_or_none(data.get("tempf")))
-                    tempin = temperature_f2iso(float_or_none(data.get("indoortempf")))
-                    humidity = int_or_none(data.get("humidity"))
-                    humidityin = int_or_none(data.get("indoorhumidity"))
-                    dewpt = temperature_f2iso(float_or_none(data.get("dewptf")))
-                    windchill = temperature_f2iso(float_or_none(data.get("windchillf")))
-                    windspeedms = speed_mph2iso(float_or_none(data.get("windspeedmph")))
-                    windgustms = speed_mph2iso(float_or_none(data.get("windgustmph")))
-                    winddir = int_or_none(data.get("winddir"))
-                    solarradiation = float_or_none(data.get("solarradiation"))
-                    uv = float_or_none(data.get("UV"))
-                    waretype = data.get("softwaretype")
-                    baromrel = pressure_inches2iso(float_or_none(data.get("baromin")))
-                    baromabs = pressure_inches2iso(
-                        float_or_none(data.get("baromin"))
-                    ) - 46
-                    rainmm = 10 * distance_inch2iso(float_or_none(data.get("rainin")))
-                    dailyrainmm = 10.0 * distance_inch2iso(
-                        float_or_none(data.get("dailyrainin"))
-                    )
-                    weeklyraininmm = 10.0 * distance_inch2iso(
-                        float_or_none(data.get("weeklyrainin"))
+        Debug("onHeartbeat")
+        now = time.monotonic()
+        if self.checkpoint is not None and self.checkpoint.due(now):
+            self.saveCheckpoint()
+        self.refreshSettings()
+        # Close the connections of stations which did not disconnect
+        for name, activity in list(self.httpServerActivity.items()):
+            if now - activity > CONNECTION_IDLE:
+                Debug("Close idle connection {}", name)
+                self.httpServerConns.pop(name).Disconnect()
+                del self.httpServerActivity[name]
+                self.connectionsReaped += 1
+        if now >= self.nextStatistics:
+            self.nextStatistics = now + 3600
+            # Each count on its own, eg. a flood of rejected requests writes
+            # no devices
+            if self.deviceWrites or self.deviceWritesSuppressed:
+                Domoticz.Log(
+                    "Device writes: {}, suppressed: {}".format(
+                        self.deviceWrites, self.deviceWritesSuppressed
                     )
-                    monthlyraininmm = 10.0 * distance_inch2iso(
-                        float_or_none(data.get("monthlyrainin"))
-                    )
-                    yearlyraininmm = 10.0 * distance_inch2iso(
-                        float_or_none(data.get("yearlyrainin"))
-                    )
-                    lowbatt = data.get("lowbatt")
-
-
-            elif strVerb == "POST":
-                protocol = "Ecowitt"
-                Domoticz.Debug("Ecowitt protocol")
-                strData = Data["Data"].decode("utf-8")
-                data = dict(item.split("=") for item in strData.split("&"))
-                Domoticz.Debug("data: {}".format(data))
-                if len(data) > 0:
-                    dataIsValid = True
-                    # Get data
-                    temp = temperature_f2iso(float_or_none(data.get("tempf")))
-                    tempin = temperature_f2iso(float_or_none(data.get("tempinf")))
-                    humidity = int_or_none(data.get("humidity"))
-                    humidityin = int_or_none(data.get("humidityin"))
-                    windspeedms = speed_mph2iso(float_or_none(data.get("windspeedmph")))
-                    windgustms = speed_mph2iso(float_or_none(data.get("windgustmph")))
-                    winddir = int_or_none(data.get("winddir"))
-                    baromrel = pressure_inches2iso(
-                        float_or_none(data.get("baromrelin"))
-                    )
-                    baromabs = pressure_inches2iso(
-                        float_or_none(data.get("baromabsin"))
-                    )
-                    rainmm = 10 * distance_inch2iso(float_or_none(data.get("rainin")))
-                    dailyrainmm = 10 * distance_inch2iso(
-                        float_or_none(data.get("dailyrainin"))
+                )
+            if self.httpServerConns or self.connectionsReaped:
+                Domoticz.Log(
+                    "Connections open: {}, closed idle: {}".format(
+                        len(self.httpServerConns), self.connectionsReaped
                     )
-                    softwaretype = data.get("stationtype")
-                    solarradiation = float_or_none(data.get("solarradiation"))
-                    uv = float_or_none(data.get("uv"))
-                    # dewpt not reported in Ecowitt
-                    dewpt = (
-                        dew_point(temp, humidity)
-                        if data.get("dewptf") is None
-                        else temperature_f2iso(float_or_none(data.get("dewptf")))
+                )
+            if self.duplicatesDropped or self.outOfOrderDropped:
+                Domoticz.Log(
+                    "Packets dropped, duplicate: {}, out of order: {}".format(
+                        self.duplicatesDropped, self.outOfOrderDropped
                     )
-                    # windchill not reported in Ecowitt
-                    windchill = (
-                        wind_chill(temp, windspeedms)
-                        if data.get("windchillf") is None
-                        else temperature_f2iso(float_or_none(data.get("windchillf")))
+                )
+            if any(self.requestsRejected.values()):
+                Domoticz.Log(
+                    "Requests rejected, rate: {rate}, size: {size}, "
+                    "unknown path: {path}, unknown station: {station}".format(
+                        **self.requestsRejected
                     )
-            else:
-                Domoticz.Error("Unknown protocol")
-                dataIsValid = False
-            #
-            if dataIsValid:
-                Domoticz.Debug("Protocol: {}".format(protocol))
-                # Reset counters
-                if self.raincounter is None:  # Domoticz (re)started.
-                    # Try to get the original counter
-                    old_values = Devices[unit.RAIN].sValue.split(";")
-                    # Set Domoticz counter to 0
-                    UpdateDevice(unit.RAIN, 0, "{};{}".format(0, 0))
-                    if len(old_values[0]) == 0:
-                        # Hardware first time
-                        self.raincounter = 0
-                    else:
-                        # Hardware exists so get old value
-                        self.raincounter = float(old_values[1]) - dailyrainmm
-                    self.prev_dailyrainin = dailyrainmm
-                if dailyrainmm < self.prev_dailyrainin:
-                    self.raincounter += self.prev_dailyrainin
-                self.prev_dailyrainin = dailyrainmm
-                # Calculate statuses
-                humiditystatus = humidity2status_outdoor(humidity)
-                indoorhumiditystatus = humidity2status_indoor(humidityin, tempin)
-                pressurestatus = pressure2status(baromrel)
-                # Round calculated values for presentation
-                temp = round(temp, 1) if temp is not None else None
-                tempin = round(tempin, 1) if tempin is not None else None
-                windspeedms = round(windspeedms, 1) if windspeedms is not None else None
-                dewpt = round(dewpt, 1) if dewpt is not None else None
-                windchill = round(windchill, 1) if windchill is not None else None
-                windgustms = round(windgustms, 1) if windgustms is not None else None
-                baromrel = round(baromrel) if baromrel is not None else None
-                baromabs = round(baromabs) if baromabs is not None else None
-                rainmm = round(rainmm, 2) if rainmm is not None else None
-                dailyrainmm = round(dailyrainmm, 2) if dailyrainmm is not None else None
-                solarradiation = (
-                    round(solarradiation, 1) if solarradiation is not None else None
                 )
-                # Update devices
-                UpdateDevice(unit.TEMP_IND, 0, "{}".format(tempin))
-                UpdateDevice(unit.TEMP, 0, "{}".format(temp))
-                UpdateDevice(
-                    unit.HUMIDITY,
-                    int(humidity) if humidity is not None else 0,
-                    "{}".format(humiditystatus),
+            malformed = self.malformedData()
+            if malformed:
+                Domoticz.Log("Malformed values skipped: {}".format(malformed))
+            rejected = self.valuesRejected()
+            if rejected:
+                Domoticz.Log(
+                    "Values rejected: {}".format(
+                        ", ".join(
+                            "{} {}".format(field, count)
+                            for field, count in sorted(rejected.items())
+                        )
+                    )
                 )
-                UpdateDevice(
-                    unit.HUMIDITY_IND,
-                    int(humidityin) if humidityin is not None else 0,
-                    "{}".format(indoorhumiditystatus),
+            if self.forwarder is not None:
+                forwarder = self.forwarder
+                Domoticz.Log(
+                    "Packets forwarded: {}, failed: {}, dropped: {}, retries: {}, "
+                    "queued: {}".format(
+                        forwarder.forwarded,
+                        forwarder.failed,
+                        forwarder.dropped,
+                        forwarder.retries,
+                        len(forwarder.queue),
+                    )
                 )
-                UpdateDevice(unit.DEWPOINT, 0, "{}".format(dewpt))
-                UpdateDevice(unit.DEWPOINT_IN, 0, "{:.2f}".format((tempin-((100-humidityin)/5.0))))
-                UpdateDevice(unit.CHILL, 0, "{}".format(windchill))
-                UpdateDevice(
-                    unit.TEMP_HUM, 0, "{};{};{}".format(temp, humidity, humiditystatus)
+            if self.recorder is not None:
+                Domoticz.Log(
+                    "Requests recorded: {}, failed: {}, dropped: {}".format(
+                        self.recorder.recorded,
+                        self.recorder.failed,
+                        self.recorder.dropped,
+                    )
                 )
-                UpdateDevice(
-                    unit.WIND1,
-                    0,
-                    "{};{};{};{};{};{}".format(
-                        winddir,
-                        bearing2status(winddir) if winddir is not None else None,
-                        windspeedms * 10 if windspeedms is not None else None,
-                        windgustms * 10 if windgustms is not None else None,
-                        temp,
-                        windchill,
-                    ),
+        # Links of the stations, the devices are only written when a station
+        # times out, so the heartbeat is O(stations)
+        updateLinks = now >= self.nextLink
+        if updateLinks:
+            self.nextLink = now + LINK_INTERVAL
+        for station in self.stations.values():
+            link = station.link
+            if (
+                self.linkTimeout > 0
+                and not link.timedOut
+                and now - link.heard > self.linkTimeout
+            ):
+                Domoticz.Error(
+                    "Station '{}' silent for {:.0f} s, devices timed out".format(
+                        station.key, now - link.heard
+                    )
                 )
-                UpdateDevice(
-                    unit.WIND2,
+                self.setTimedOut(station, 1)
+            elif updateLinks and unit.LINK in station.units:
+                self.updateDevice(
+                    station.base + unit.LINK,
                     0,
-                    "{};{};{};{};{};{}".format(
-                        winddir,
-                        bearing2status(winddir) if winddir is not None else None,
-                        windspeedms * 10 if windspeedms is not None else None,
-                        windgustms * 10 if windgustms is not None else None,
-                        temp,
-                        windchill,
-                    ),
-                )
-                # Custom device, so we have to handle the alternative windspeed units
-                windunit = int(Settings["WindUnit"])
-                Domoticz.Debug("WindUnit: {}".format(windunit))
-                UpdateDeviceOptions(unit.WINDSPEED, Options=speed2options(windunit))
-                UpdateDevice(
-                    unit.WINDSPEED, 0, "{}".format(speed2unit(windspeedms, windunit))
-                )
-                # Custom device, so we have to handle the alternative windspeed units
-                UpdateDeviceOptions(unit.GUST, Options=speed2options(windunit))
-                UpdateDevice(
-                    unit.GUST, 0, "{}".format(speed2unit(windgustms, windunit))
+                    link.summary(),
+                    int(bool(link.timedOut)),
                 )
-                UpdateDevice(unit.GUST, 0, "{}".format(windgustms))
-                UpdateDevice(unit.WIND_DIRECTION, 0, "{}".format(winddir))
-                UpdateDevice(
-                    unit.SOLAR,
-                    int(solarradiation) if solarradiation is not None else 0,
-                    "{}".format(solarradiation),
-                )
-                UpdateDevice(
-                    unit.UVI, int(uv) if uv is not None else 0, "{};{}".format(uv, temp)
+        # The forwarder does not log from its thread
+        if (
+            self.forwarder is not None
+            and self.forwarder.failed > self.forwardFailuresReported
+        ):
+            Domoticz.Error(
+                "Forwarding of {} packets failed: {}".format(
+                    self.forwarder.failed - self.forwardFailuresReported,
+                    self.forwarder.error,
                 )
-                UpdateDevice(
-                    unit.UV_ALERT,
-                    uv2status(uv) if uv is not None else 0,
-                    "{} UVI".format(uv),
+            )
+            self.forwardFailuresReported = self.forwarder.failed
+        if (
+            self.recorder is not None
+            and self.recorder.failed > self.recordFailuresReported
+        ):
+            Domoticz.Error(
+                "Recording of {} requests failed: {}".format(
+                    self.recorder.failed - self.recordFailuresReported,
+                    self.recorder.error,
                 )
-                UpdateDevice(
-                    unit.STATION,
-                    0,
-                    "{} ({}): {}: [{},{},{},{},{}]".format(Connection.Address, softwaretype, protocol, rainmm, dailyrainmm, weeklyraininmm, monthlyraininmm, yearlyraininmm),
+            )
+            self.recordFailuresReported = self.recorder.failed
+        if self.timer is not None and now >= self.nextTiming:
+            self.nextTiming = now + self.timingInterval
+            summary = self.timer.summary()
+            if summary is not None:
+                Domoticz.Log("Timing p50/p95/p99 µs (packets): {}".format(summary))
+                if unit.TIMING in Devices:
+                    UpdateDevice(unit.TIMING, 0, summary)
+            self.timer.reset()
+
+        # Statistics of the day, which start again at midnight
+        clock = time.time()
+        for station in self.stations.values():
+            if clock >= station.daily.end:
+                Debug("Statistics of {} reset", station.daily.day)
+                station.daily.reset(clock)
+                self.checkpoint.dirty = True
+
+        # Aggregation, publish the observations of the window which closed
+        if self.aggregation:
+            now = time.time()
+            if now >= self.windowEnd:
+                self.windowEnd = (now // self.aggregation + 1) * self.aggregation
+                for station in self.stations.values():
+                    if station.window.count:
+                        if self.timer is not None:
+                            self.timer.start()
+                        self.publish(station, station.window.flush())
+
+    def saveCheckpoint(self):
+        self.checkpoint.save(
+            {
+                "stations": {
+                    key: station.state()
+                    for key, station in self.stations.items()
+                }
+            }
+        )
+
+    def reject(self, Connection, response, reason):
+        """Cheap response to a request which is not handled"""
+        Connection.Send(response)
+        self.requestsRejected[reason] += 1
+
+    def valuesRejected(self):
+        """Number of values rejected by the spike filters, by field"""
+        rejected = {}
+        for station in self.stations.values():
+            for field, count in station.spikes.rejected.items():
+                rejected[field] = rejected.get(field, 0) + count
+        return rejected
+
+    def malformedData(self):
+        """Number of malformed values, of all the decoders"""
+        return sum(decoder.malformed for _, decoder, _ in self.routes.values())
+
+    def updateDevice(self, Unit, nValue, sValue, TimedOut=0):
+        """Update the device according to the write policy of the unit"""
+        policy = self.policies.get(Unit)
+        if policy is not None:
+            now = time.monotonic()
+            values = device_values(nValue, sValue, TimedOut)
+            if not policy.due(self.lastWrites.get(Unit), values, now):
+                self.deviceWritesSuppressed += 1
+                return
+            self.lastWrites[Unit] = (now, values)
+        self.deviceWrites += 1
+        UpdateDevice(Unit, nValue, sValue, TimedOut)
+
+    def setTimedOut(self, station, TimedOut):
+        """Mark the devices of the station as timed out, or clear the mark. The
+        devices keep their values.
+        """
+        for offset in station.units:
+            Unit = station.base + offset
+            if offset == unit.LINK:
+                summary = station.link.summary()
+                if TimedOut:
+                    summary = "Bez spojení, " + summary
+                self.updateDevice(Unit, 0, summary, TimedOut)
+            elif Unit in Devices and Devices[Unit].TimedOut != TimedOut:
+                device = Devices[Unit]
+                self.deviceWrites += 1
+                UpdateDevice(Unit, device.nValue, device.sValue, TimedOut)
+        station.link.timedOut = bool(TimedOut)
+        self.snapshot.invalidate()
+
+    def station(self, key):
+        """Context of the station, which is added on the first packet. None
+        when there are no units left for a new station
+        """
+        try:
+            return self.stations[key]
+        except KeyError:
+            station = self.addStation(key)
+            if station is not None:
+                self.stations[key] = station
+            return station
+
+    def addStation(self, key):
+        used = {s.base for s in self.stations.values()}
+        for base in STATION_BASES:
+            if base not in used:
+                break
+        else:
+            # The packets of the station keep coming, only the stations are
+            # kept in self.stations, which is bounded by STATION_BASES
+            if self.unknownStation(key):
+                Domoticz.Error(
+                    "No units left for station '{}', only {} stations are "
+                    "supported".format(key, len(STATION_BASES))
                 )
-                UpdateDevice(
-                    unit.BATTERY,
-                    int(lowbatt*10),
-                    "Výměna když hodnota je > 0: {}".format(lowbatt),
+            return None
+        station = self.newStation(key, base)
+        Domoticz.Log(
+            "New station '{}', units {}..{}".format(
+                key, base + 1, base + STATION_UNITS - 1
+            )
+        )
+        # Remember the station with its devices, for a restart
+        UpdateDeviceOptions(base + unit.STATION, Options={"StationKey": key})
+        return station
+
+    def unknownStation(self, key):
+        """Remember a station which is not handled, True when it is new and
+        to be logged
+        """
+        unknown = self.unknownStations
+        if key in unknown or len(unknown) >= MAX_UNKNOWN_STATIONS:
+            return False
+        self.unknownStations.add(key)
+        return True
+
+    def unknownRequest(self, verb, path):
+        """Remember a request which is not handled, True when it is new and
+        to be logged. Scanners try many paths, so only the first
+        MAX_UNKNOWN_REQUESTS are logged.
+        """
+        unknown = self.unknownRequests
+        if (verb, path) in unknown or len(unknown) >= MAX_UNKNOWN_REQUESTS:
+            return False
+        unknown.add((verb, path))
+        return True
+
+    def newStation(self, key, base):
+        station = Station(key, base)
+        if self.aggregation:
+            station.window = Window()
+        station.link.interval = self.linkInterval
+        self.registerDevices(station)
+        return station
+
+    def registerDevices(self, station):
+        """Find the devices of the station which exist. The others are created
+        when their fields are first reported, see createDevices.
+        """
+        for row in self.__UNITS:
+            Unit = station.base + row[0]
+            if row[0] in station.units:
+                continue
+            if Unit in Devices:
+                # Rows can share a unit, eg. the variants of a channel
+                if Devices[Unit].Type == row[2]:
+                    self.addDevice(station, row)
+            elif not row[7]:
+                self.createDevice(station, row)
+            else:
+                station.pending.append(row)
+        self.applyWindUnit(station)
+
+    def createDevices(self, station, obs):
+        """Create the devices for which the observation has all the fields"""
+        created = False
+        for row in station.pending:
+            if row[0] in station.units:
+                continue
+            for field in row[7]:
+                if obs.get(field) is None:
+                    break
+            else:
+                self.createDevice(station, row)
+                created = True
+        if created:
+            station.pending = [
+                row for row in station.pending if row[0] not in station.units
+            ]
+            self.applyWindUnit(station)
+
+    def createDevice(self, station, row):
+        Unit = station.base + row[0]
+        Domoticz.Device(
+            Unit=Unit,
+            Name=station.name(row[1]),
+            Type=row[2],
+            Subtype=row[3],
+            Options=row[4],
+            Used=row[5],
+        ).Create()
+        Domoticz.Log("New device {}: {}".format(Unit, station.name(row[1])))
+        self.addDevice(station, row)
+
+    def addDevice(self, station, row):
+        station.units[row[0]] = row
+        if unit.TEMP_CH <= row[0] <= unit.WH65_BATTERY:
+            station.channels.append(row)
+            station.channels.sort(key=lambda row: row[0])
+        if row[6] is not None:
+            self.policies[station.base + row[0]] = row[6]
+
+    def refreshSettings(self):
+        """Read the Domoticz settings which the plugin applies itself. The
+        devices are only updated when a setting changed.
+        """
+        windunit = int_or_none(Settings.get("WindUnit"))
+        if windunit not in WIND_SPEEDS:
+            windunit = WIND_SPEED_ISO
+        if windunit != self.windunit:
+            Domoticz.Log("Wind speed unit changed: {}".format(windunit))
+            self.windunit = windunit
+            for station in self.stations.values():
+                self.applyWindUnit(station)
+
+    def applyWindUnit(self, station):
+        """Unit of the custom wind devices, Domoticz converts the other ones"""
+        options = speed2options(self.windunit)
+        for offset in (unit.WINDSPEED, unit.GUST, unit.DAY_GUST):
+            Unit = station.base + offset
+            if Unit in Devices:
+                UpdateDeviceOptions(Unit, Options=options)
+
+    def onMessage(self, Connection, Data):
+        timer = self.timer
+        if timer is None:
+            self.handleMessage(Connection, Data, None)
+        else:
+            start = timer.start()
+            self.handleMessage(Connection, Data, timer)
+            timer.add("total", time.perf_counter_ns() - start)
+
+    def handleMessage(self, Connection, Data, timer):
+        Debug(
+            "onMessage {}={}:{}", Connection.Name, Connection.Address, Connection.Port
+        )
+        if _debug:
+            DumpHTTPResponseToLog(Data)
+        # Incoming Requests
+        if "Verb" not in Data:
+            return
+        now = time.monotonic()
+        if Connection.Name in self.httpServerActivity:
+            self.httpServerActivity[Connection.Name] = now
+        # Admission, before anything of the request is parsed
+        if self.rateLimit is not None and not self.rateLimit.allow(
+            Connection.Address, now
+        ):
+            self.reject(Connection, HTTP_TOO_MANY_REQUESTS, "rate")
+            return
+        url = Data.get("URL", "")
+        maxsize = self.maxRequestSize
+        if len(url) > maxsize or len(Data.get("Data") or b"") > maxsize:
+            self.reject(Connection, HTTP_TOO_LARGE, "size")
+            return
+        strVerb = Data["Verb"]
+        Debug("Request {}", strVerb)
+        path, _, query = url.partition("?")
+        if strVerb == "GET" and path in self.snapshot.builders:
+            headers = Data.get("Headers") or {}
+            etag = headers.get("If-None-Match") or headers.get("if-none-match")
+            Connection.Send(self.snapshot.response(path, etag))
+            return
+        if self.recorder is not None:
+            data = Data.get("Data") or b""
+            self.recorder.put(strVerb, url, data, Connection.Address, time.time())
+        route = self.routes.get((strVerb, route_path(path)))
+        if route is None:
+            # Rejected before the data is looked at
+            self.reject(Connection, HTTP_NOT_FOUND, "path")
+            if self.unknownRequest(strVerb, path):
+                Domoticz.Error("Unknown request: {} {}".format(strVerb, path))
+                if len(self.unknownRequests) == MAX_UNKNOWN_REQUESTS:
+                    Domoticz.Log("Further unknown requests are not logged")
+            return
+        protocol, decoder, source = route
+        if source == FROM_BODY:
+            # Decoded as bytes, see FieldDecoder
+            strData = Data.get("Data") or b""
+        elif source == FROM_PATH and not query:
+            strData = path2query(path, route_path(path))
+        else:
+            strData = query
+        Debug("strData: {}", strData)
+        key = decoder.peek(strData, "station") or ""
+        if self.allowedStations and key not in self.allowedStations:
+            self.reject(Connection, HTTP_FORBIDDEN, "station")
+            if self.unknownStation(key):
+                Domoticz.Error(
+                    "Station '{}' of {} not allowed".format(key, Connection.Address)
                 )
-                UpdateDevice(
-                    unit.THB,
-                    0,
-                    "{};{};{};{};{}".format(
-                        temp, humidity, humiditystatus, baromrel, pressurestatus
-                    ),
+            return
+        # Respond before handling the data, so the station does not wait
+        Connection.Send(HTTP_OK)
+        # Drop copies of packets which were already handled, before decoding
+        dateutc = decoder.peek(strData, "dateutc")
+        obstime = dateutc2epoch(dateutc)
+        arrival = time.time()
+        if obstime is None:
+            # Without a time, equal packets are also sent by a station of
+            # which the values did not change, only retries are copies
+            retry = RecentPackets.retry(self.stations.get(key))
+            if self.recentPackets.seen(hash(strData), retry):
+                self.duplicatesDropped += 1
+                Debug("Duplicate packet of station '{}' dropped", key)
+                return
+        else:
+            if self.recentPackets.seen((key, dateutc)):
+                self.duplicatesDropped += 1
+                Debug("Duplicate packet of station '{}' dropped", key)
+                return
+            station = self.stations.get(key)
+            if station is not None and not station.ordered(obstime, arrival):
+                self.outOfOrderDropped += 1
+                Debug("Packet of station '{}' from {} out of order", key, dateutc)
+                return
+        if self.forwarder is not None:
+            self.forwarder.put(strVerb, strData)
+        if timer is not None:
+            timer.lap("request")
+        obs = decoder.decode(strData)
+        Debug("obs: {}", obs)
+        if timer is not None:
+            timer.lap("decode")
+        if not decoder.valid(obs):
+            return
+        Debug("Protocol: {}", protocol)
+        station = self.station(obs["station"] or "")
+        if station is None:
+            return
+        station.address = Connection.Address
+        station.protocol = protocol
+        station.link.add(now)
+        if station.link.timedOut is not False:
+            # Also after a restart, the devices may have timed out before
+            if station.link.timedOut:
+                Domoticz.Log(
+                    "Station '{}' is back, after {:.0f} s".format(
+                        station.key, station.link.silence
+                    )
                 )
-                UpdateDevice(unit.BARO_REL, 0, "{};{}".format(baromrel, pressurestatus))
-                UpdateDevice(
-                    unit.BARO_ABS,
-                    0,
-                    "{};{}".format(baromabs, pressure2status(baromabs)),
+            self.setTimedOut(station, 0)
+        # The clock of the station drives the rates, so delayed packets count
+        # at the time they were measured
+        t = obs["time"] = station.clock(obstime, arrival)
+        station.spikes.apply(obs)
+        # The rain counter follows every packet, also when aggregating
+        if obs["dailyrainmm"] is not None:
+            self.countRain(station, obs["dailyrainmm"])
+            rate = station.rain.rate(t, station.raincounter + obs["dailyrainmm"])
+            if rate is not None:
+                obs["rainmm"] = rate
+        station.daily.add(obs, t)
+        self.checkpoint.dirty = True
+        if station.window is not None:
+            station.window.add(obs)
+        else:
+            self.publish(station, obs)
+
+    def countRain(self, station, dailyrainmm):
+        base = station.base
+        # Reset counters
+        if station.raincounter is None:  # Domoticz (re)started.
+            # Try to get the original counter
+            if base + unit.RAIN in Devices:
+                old_values = Devices[base + unit.RAIN].sValue.split(";")
+            else:
+                old_values = [""]
+            if len(old_values[0]) == 0:
+                # Hardware first time
+                station.raincounter = 0
+            else:
+                # Hardware exists so get old value
+                station.raincounter = float(old_values[1]) - dailyrainmm
+            station.prev_dailyrainin = dailyrainmm
+        if dailyrainmm < station.prev_dailyrainin:
+            station.raincounter += station.prev_dailyrainin
+            self.checkpoint.urgent = True
+        station.prev_dailyrainin = dailyrainmm
+
+    def publish(self, station, obs):
+        """Update the devices of the station with the observation"""
+        base = station.base
+        # Derived values, when not reported by the station (eg. Ecowitt)
+        temp = obs["temp"]
+        tempin = obs["tempin"]
+        humidity = obs["humidity"]
+        humidityin = obs["humidityin"]
+        windspeedms = obs["windspeedms"]
+        windgustms = obs["windgustms"]
+        winddir = obs["winddir"]
+        if obs["dewpt"] is None and temp is not None and humidity is not None:
+            obs["dewpt"] = round(dew_point(temp, humidity), 1)
+        if obs["windchill"] is None and temp is not None and windspeedms is not None:
+            obs["windchill"] = round(wind_chill(temp, windspeedms), 1)
+        if obs["baromabs"] is None and obs["baromrel"] is not None:
+            obs["baromabs"] = round(
+                pressure_sea2station(obs["baromrel"], self.altitude)
+            )
+        dewpt = obs["dewpt"]
+        windchill = obs["windchill"]
+        baromrel = obs["baromrel"]
+        baromabs = obs["baromabs"]
+        rainmm = obs["rainmm"]
+        dailyrainmm = obs["dailyrainmm"]
+        solarradiation = obs["solarradiation"]
+        uv = obs["uv"]
+        lowbatt = obs["lowbatt"]
+        # Calculate statuses
+        humiditystatus = humidity2status_outdoor(humidity)
+        indoorhumiditystatus = humidity2status_indoor(humidityin, tempin)
+        pressurestatus = self.forecast(station, baromrel, obs.get("time"))
+        timer = self.timer
+        if timer is not None:
+            timer.lap("derive")
+        # Devices of the sensors which are reported for the first time
+        if station.pending:
+            self.createDevices(station, obs)
+        # Update the devices which exist
+        units = station.units
+        if unit.TEMP_IND in units:
+            self.updateDevice(base + unit.TEMP_IND, 0, "{}".format(tempin))
+        if unit.TEMP in units:
+            self.updateDevice(base + unit.TEMP, 0, "{}".format(temp))
+        if unit.HUMIDITY in units:
+            self.updateDevice(
+                base + unit.HUMIDITY,
+                int(humidity) if humidity is not None else 0,
+                "{}".format(humiditystatus),
+            )
+        if unit.HUMIDITY_IND in units:
+            self.updateDevice(
+                base + unit.HUMIDITY_IND,
+                int(humidityin) if humidityin is not None else 0,
+                "{}".format(indoorhumiditystatus),
+            )
+        if unit.DEWPOINT in units:
+            self.updateDevice(base + unit.DEWPOINT, 0, "{}".format(dewpt))
+        if unit.DEWPOINT_IN in units and tempin is not None and humidityin is not None:
+            self.updateDevice(
+                base + unit.DEWPOINT_IN,
+                0,
+                "{:.2f}".format((tempin - ((100 - humidityin) / 5.0))),
+            )
+        if unit.CHILL in units:
+            self.updateDevice(base + unit.CHILL, 0, "{}".format(windchill))
+        if unit.TEMP_HUM in units:
+            self.updateDevice(
+                base + unit.TEMP_HUM,
+                0,
+                "{};{};{}".format(temp, humidity, humiditystatus),
+            )
+        if unit.WIND1 in units or unit.WIND2 in units:
+            wind = "{};{};{};{};{};{}".format(
+                winddir,
+                bearing2status(winddir) if winddir is not None else None,
+                windspeedms * 10 if windspeedms is not None else None,
+                windgustms * 10 if windgustms is not None else None,
+                temp,
+                windchill,
+            )
+            if unit.WIND1 in units:
+                self.updateDevice(base + unit.WIND1, 0, wind)
+            if unit.WIND2 in units:
+                self.updateDevice(base + unit.WIND2, 0, wind)
+        # Custom devices, so we have to handle the alternative windspeed units
+        windunit = self.windunit
+        if unit.WINDSPEED in units:
+            self.updateDevice(
+                base + unit.WINDSPEED,
+                0,
+                "{}".format(speed2unit(windspeedms, windunit)),
+            )
+        if unit.GUST in units:
+            self.updateDevice(
+                base + unit.GUST, 0, "{}".format(speed2unit(windgustms, windunit))
+            )
+        if unit.WIND_DIRECTION in units:
+            self.updateDevice(base + unit.WIND_DIRECTION, 0, "{}".format(winddir))
+        if unit.SOLAR in units:
+            self.updateDevice(
+                base + unit.SOLAR,
+                int(solarradiation) if solarradiation is not None else 0,
+                "{}".format(solarradiation),
+            )
+        if unit.UVI in units:
+            self.updateDevice(
+                base + unit.UVI,
+                int(uv) if uv is not None else 0,
+                "{};{}".format(uv, temp),
+            )
+        if unit.UV_ALERT in units:
+            self.updateDevice(
+                base + unit.UV_ALERT,
+                uv2status(uv) if uv is not None else 0,
+                "{} UVI".format(uv),
+            )
+        if unit.STATION in units:
+            self.updateDevice(
+                base + unit.STATION,
+                0,
+                "{} ({}): {}: [{},{},{},{},{}]".format(
+                    station.address,
+                    obs["softwaretype"],
+                    station.protocol,
+                    rainmm,
+                    dailyrainmm,
+                    obs["weeklyrainmm"],
+                    obs["monthlyrainmm"],
+                    obs["yearlyrainmm"],
+                ),
+            )
+        if unit.BATTERY in units and lowbatt is not None:
+            self.updateDevice(
+                base + unit.BATTERY,
+                int(lowbatt * 10),
+                "Výměna když hodnota je > 0: {}".format(lowbatt),
+            )
+        if unit.THB in units:
+            self.updateDevice(
+                base + unit.THB,
+                0,
+                "{};{};{};{};{}".format(
+                    temp, humidity, humiditystatus, baromrel, pressurestatus
+                ),
+            )
+        if unit.BARO_REL in units:
+            self.updateDevice(
+                base + unit.BARO_REL, 0, "{};{}".format(baromrel, pressurestatus)
+            )
+        if unit.BARO_ABS in units:
+            self.updateDevice(
+                base + unit.BARO_ABS, 0, "{};{}".format(baromabs, pressurestatus)
+            )
+        if (
+            unit.RAIN in units
+            and rainmm is not None
+            and dailyrainmm is not None
+            and station.raincounter is not None
+        ):
+            self.updateDevice(
+                base + unit.RAIN,
+                0,
+                "{};{}".format(
+                    rainmm * 100, round(station.raincounter + dailyrainmm, 3)
+                ),
+            )
+        if unit.RAIN_RATE in units:
+            self.updateDevice(base + unit.RAIN_RATE, 0, "{}".format(rainmm))
+        if unit.HEAT_INDEX in units and temp is not None and humidity is not None:
+            self.updateDevice(
+                base + unit.HEAT_INDEX, 0, "{:.2f}".format(heat_index(temp, humidity))
+            )
+        if (
+            unit.HEAT_INDEX_IN in units
+            and tempin is not None
+            and humidityin is not None
+        ):
+            self.updateDevice(
+                base + unit.HEAT_INDEX_IN,
+                0,
+                "{:.2f}".format(heat_index(tempin, humidityin)),
+            )
+        # Statistics of the day
+        daily = station.daily
+        if unit.DAY_TEMP_MIN in units and daily.tempmin is not None:
+            self.updateDevice(base + unit.DAY_TEMP_MIN, 0, "{}".format(daily.tempmin))
+        if unit.DAY_TEMP_MAX in units and daily.tempmax is not None:
+            self.updateDevice(base + unit.DAY_TEMP_MAX, 0, "{}".format(daily.tempmax))
+        if unit.DAY_TEMP_MEAN in units and daily.tempcount:
+            self.updateDevice(
+                base + unit.DAY_TEMP_MEAN, 0, "{:.1f}".format(daily.tempmean())
+            )
+        if unit.DAY_GUST in units and daily.gustmax is not None:
+            self.updateDevice(
+                base + unit.DAY_GUST,
+                0,
+                "{}".format(speed2unit(daily.gustmax, windunit)),
+            )
+        if unit.DAY_RAIN_HOURS in units:
+            self.updateDevice(
+                base + unit.DAY_RAIN_HOURS, 0, "{:.1f}".format(daily.rain / 3600)
+            )
+        if unit.DAY_SUN_HOURS in units:
+            self.updateDevice(
+                base + unit.DAY_SUN_HOURS, 0, "{:.1f}".format(daily.sunshine / 3600)
+            )
+        # Multi-channel sensors, only the channels which exist
+        for row in station.channels:
+            value = obs.get(row[7][0])
+            if value is None:
+                continue
+            if row[2] == 82:
+                other = obs.get(row[7][1])
+                nValue, sValue = 0, "{};{};{}".format(
+                    value, other, humidity2status_outdoor(other)
                 )
-                UpdateDevice(
-                    unit.RAIN,
-                    0,
-                    "{};{}".format(
-                        rainmm * 100, round(self.raincounter + dailyrainmm, 3)
-                    ),
-                    AlwaysUpdate=True,
+            elif row[3] == 22:
+                nValue, sValue = (4, "Vyměnit baterie") if value else (1, "OK")
+            else:
+                nValue, sValue = 0, "{}".format(value)
+            self.updateDevice(base + row[0], nValue, sValue)
+        station.obs = obs
+        station.updated = int(time.time())
+        self.snapshot.invalidate()
+        if timer is not None:
+            timer.lap("update")
+
+    def currentJson(self):
+        """Last observation of the stations, by station number"""
+        stations = {}
+        for station in self.stations.values():
+            if station.obs is not None:
+                current = {
+                    "protocol": station.protocol,
+                    "updated": station.updated,
+                }
+                for field, value in station.obs.items():
+                    if field != "station":
+                        current[field] = value
+                stations[station.number()] = current
+        return json.dumps({"stations": stations}, separators=(",", ":"))
+
+    def currentMetrics(self):
+        """Last observation of the stations and the counters of the plugin, in
+        the Prometheus text format
+        """
+        current = [
+            (
+                station.number(),
+                dict(
+                    station.obs,
+                    updated=station.updated,
+                    skew=station.skew,
+                    gaps=station.gaps,
+                    clockinvalid=station.clockInvalid,
+                    jitter=station.link.jitter,
+                    lost=station.link.lost,
+                    timedout=int(bool(station.link.timedOut)),
+                ),
+            )
+            for station in self.stations.values()
+            if station.obs is not None
+        ]
+        lines = []
+        for metric, kind, description, samples in METRICS:
+            values = []
+            for field, labels in samples:
+                for number, obs in current:
+                    value = obs.get(field)
+                    if value is not None:
+                        values.append(
+                            '{}{{station="{}"{}}} {}'.format(
+                                metric, number, labels, value
+                            )
+                        )
+            if values:
+                lines.append("# HELP {} {}".format(metric, description))
+                lines.append("# TYPE {} {}".format(metric, kind))
+                lines.extend(values)
+        for metric, description, value in (
+            (
+                'pws_packets_dropped_total{reason="duplicate"}',
+                "Packets dropped",
+                self.duplicatesDropped,
+            ),
+            (
+                'pws_packets_dropped_total{reason="out_of_order"}',
+                None,
+                self.outOfOrderDropped,
+            ),
+            (
+                'pws_requests_rejected_total{reason="rate"}',
+                "Requests rejected by the admission control and routing",
+                self.requestsRejected["rate"],
+            ),
+            (
+                'pws_requests_rejected_total{reason="size"}',
+                None,
+                self.requestsRejected["size"],
+            ),
+            (
+                'pws_requests_rejected_total{reason="path"}',
+                None,
+                self.requestsRejected["path"],
+            ),
+            (
+                'pws_requests_rejected_total{reason="station"}',
+                None,
+                self.requestsRejected["station"],
+            ),
+            (
+                "pws_values_malformed_total",
+                "Malformed values skipped by the decoders",
+                self.malformedData(),
+            ),
+            ("pws_device_writes_total", "Device updates", self.deviceWrites),
+            (
+                "pws_device_writes_suppressed_total",
+                "Device updates suppressed by the write policy",
+                self.deviceWritesSuppressed,
+            ),
+        ):
+            if description is not None:
+                name = metric.partition("{")[0]
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} counter".format(name))
+            lines.append("{} {}".format(metric, value))
+        links = [
+            (station.number(), station.link)
+            for station in self.stations.values()
+            if station.link.received > 1
+        ]
+        if links:
+            lines.append(
+                "# HELP pws_packet_interval_seconds Seconds between the packets"
+            )
+            lines.append("# TYPE pws_packet_interval_seconds histogram")
+            for number, link in links:
+                count = 0
+                for bound, n in zip(LinkHealth.BOUNDS + ("+Inf",), link.counts):
+                    count += n
+                    lines.append(
+                        'pws_packet_interval_seconds_bucket{{station="{}",le="{}"}} '
+                        "{}".format(number, bound, count)
+                    )
+                lines.append(
+                    'pws_packet_interval_seconds_sum{{station="{}"}} {}'.format(
+                        number, link.sum
+                    )
                 )
-                UpdateDevice(unit.RAIN_RATE, 0, "{}".format(rainmm))
-                UpdateDevice(
-                    unit.HEAT_INDEX, 0, "{:.2f}".format(heat_index(temp, humidity))
+                lines.append(
+                    'pws_packet_interval_seconds_count{{station="{}"}} {}'.format(
+                        number, count
+                    )
                 )
-                UpdateDevice(
-                    unit.HEAT_INDEX_IN, 0, "{:.2f}".format(heat_index(tempin, humidityin))
+        rejected = self.valuesRejected()
+        if rejected:
+            lines.append(
+                "# HELP pws_values_rejected_total Values rejected by the spike filter"
+            )
+            lines.append("# TYPE pws_values_rejected_total counter")
+            for field, count in sorted(rejected.items()):
+                lines.append(
+                    'pws_values_rejected_total{{field="{}"}} {}'.format(field, count)
                 )
+        return "\n".join(lines) + "\n"
+
+    def forecast(self, station, baromrel, t=None):
+        """Zambretti forecast from the 3 hour pressure tendency. Until there is
+        enough history, the forecast is based on the pressure only.
+        """
+        if baromrel is None:
+            return None
+        now = t or time.time()
+        tendency = station.pressure.tendency(now, baromrel)
+        station.pressure.add(now, baromrel)
+        if tendency is None:
+            return pressure2status(baromrel)
+        forecast = zambretti(baromrel, tendency)
+        Debug("Zambretti {:+.1f} hPa/3h: {}", tendency, forecast[0])
+        return forecast[1]
 
     def onStart(self):
-        if Parameters["Mode6"] == "Debug":
-            Domoticz.Debugging(1)
-        else:
-            Domoticz.Debugging(0)
-        Domoticz.Debug("onStart")
-        # Devices
-        for unit in self.__UNITS:
-            if unit[0] not in Devices:
+        # Mode6 can only be changed by updating the hardware, which restarts the
+        # plugin, so the debug level only has to be checked here
+        Debugging(Parameters["Mode6"] == "Debug")
+        # Aggregation window in seconds, 0 to update the devices for every packet
+        self.aggregation = int_or_none(Parameters["Mode2"]) or 0
+        # Altitude, for the absolute pressure when the station does not send it
+        self.altitude = float_or_none(Parameters["Mode1"])
+        if self.altitude is None:
+            self.altitude = DEFAULT_ALTITUDE
+            Domoticz.Log(
+                "Altitude not set, {} m is used for the absolute pressure".format(
+                    DEFAULT_ALTITUDE
+                )
+            )
+        options = ParseOptions(Parameters["Mode5"])
+        # Stage timers, summarized every timing seconds
+        self.timingInterval = int_or_none(options.get("timing")) or 0
+        if self.timingInterval > 0:
+            self.timer = StageTimer()
+            self.nextTiming = time.monotonic() + self.timingInterval
+            if unit.TIMING not in Devices:
                 Domoticz.Device(
-                    Unit=unit[0],
-                    Name=unit[1],
-                    Type=unit[2],
-                    Subtype=unit[3],
-                    Options=unit[4],
-                    Used=unit[5],
+                    Unit=unit.TIMING,
+                    Name="Časování",
+                    Type=243,
+                    Subtype=19,
+                    Used=used.NO,
                 ).Create()
+        # Link health, the expected seconds between the packets (estimated when
+        # not set) and the seconds of silence after which the devices time out
+        self.linkInterval = float_or_none(options.get("interval")) or None
+        timeout = float_or_none(options.get("timeout"))
+        if timeout is not None:
+            self.linkTimeout = timeout
+        Domoticz.Debug("onStart")
+        self.refreshSettings()
+        # Stations, found by the key in the Options of their station device.
+        # Their devices are created when a station sends its first packet.
+        for Unit in Devices:
+            if Unit % STATION_UNITS == unit.STATION:
+                key = Devices[Unit].Options.get("StationKey")
+                if key is not None:
+                    self.stations[key] = self.newStation(key, Unit - unit.STATION)
+        # State of the stations before the restart
+        self.checkpoint = Checkpoint(
+            os.path.join(
+                Parameters["HomeFolder"],
+                "pws-state-{}.json".format(Parameters["HardwareID"]),
+            )
+        )
+        stations = self.checkpoint.load().get("stations", {})
+        for key, state in stations.items():
+            if key not in self.stations:
+                if state["base"] in {s.base for s in self.stations.values()}:
+                    continue
+                self.stations[key] = self.newStation(key, state["base"])
+            self.stations[key].restore(state)
+        Debug("Restored {} stations from {}", len(stations), self.checkpoint.path)
+        # Protocol decoders by verb and path, compiled once
+        self.routes = {
+            (verb, path): (protocol, FieldDecoder(schema), data)
+            for verb, path, protocol, schema, data in ROUTES
+        }
+        # Admission control, the stations which may send and the limits of the
+        # requests
+        self.allowedStations = set(ParseList(Parameters["Mode4"]))
+        if self.allowedStations:
+            Domoticz.Log("Stations allowed: {}".format(len(self.allowedStations)))
+        self.maxRequestSize = int_or_none(options.get("maxsize")) or MAX_REQUEST_SIZE
+        rate = float_or_none(options.get("rate"))
+        if rate is None:
+            rate = REQUEST_RATE
+        if rate > 0:
+            burst = int_or_none(options.get("burst")) or REQUEST_BURST
+            self.rateLimit = RateLimit(rate / 60, burst)
+        # Upstream servers, the packets are forwarded as they are received
+        urls = ParseList(Parameters["Mode3"])
+        targets = []
+        for url in urls:
+            target = urlsplit(url)
+            if target.scheme in ("http", "https") and target.netloc:
+                targets.append(target)
+            else:
+                Domoticz.Error("Forward URL not valid: {}".format(url))
+        if targets:
+            self.forwarder = Forwarder(targets)
+            Domoticz.Log(
+                "Forwarding to {}".format(", ".join(t.netloc for t in targets))
+            )
+        # Recording of the raw requests, record MB in total
+        record = float_or_none(options.get("record")) or 0
+        if record > 0:
+            path = os.path.join(
+                Parameters["HomeFolder"],
+                "pws-record-{}.jsonl.gz".format(Parameters["HardwareID"]),
+            )
+            self.recorder = Recorder(path, int(record * 1048576 / Recorder.FILES))
+            Domoticz.Log("Recording requests to {}".format(path))
         # Connections
         self.httpServerConn = Domoticz.Connection(
             Name="Server",
@@ -422,6 +1745,11 @@ def onStart():
     _plugin.onStart()
 
 
+def onStop():
+    global _plugin
+    _plugin.onStop()
+
+
 def onConnect(Connection, Status, Description):
     global _plugin
     _plugin.onConnect(Connection, Status, Description)
@@ -445,6 +1773,39 @@ def onHeartbeat():
 ################################################################################
 # Generic helper functions
 ################################################################################
+_debug = False
+
+
+def Debugging(enabled):
+    """Set the debug level. The hot path only checks the _debug flag, so no
+    debug messages are formatted when debugging is off.
+    """
+    global _debug
+    _debug = bool(enabled)
+    Domoticz.Debugging(1 if _debug else 0)
+
+
+def Debug(message, *args):
+    """Debug message, only formatted when debugging is on"""
+    if _debug:
+        Domoticz.Debug(message.format(*args) if args else message)
+
+
+def ParseOptions(value):
+    """Options of the form "key=value;key=value", as a dict"""
+    options = {}
+    for item in (value or "").split(";"):
+        key, _, value = item.partition("=")
+        if key.strip():
+            options[key.strip().lower()] = value.strip()
+    return options
+
+
+def ParseList(value):
+    """Items separated by spaces, ";" or ",", as a list"""
+    return (value or "").replace(";", " ").replace(",", " ").split()
+
+
 def DumpConfigToLog():
     for x in Parameters:
         if Parameters[x] != "":
@@ -481,11 +1842,23 @@ def UpdateDevice(Unit, nValue, sValue, TimedOut=0, AlwaysUpdate=True):
             or AlwaysUpdate
         ):
             Devices[Unit].Update(nValue=nValue, sValue=str(sValue), TimedOut=TimedOut)
-            Domoticz.Debug(
-                "Update {}: {} - {} - {}".format(
-                    Devices[Unit].Name, nValue, sValue, TimedOut
+            if _debug:
+                Domoticz.Debug(
+                    "Update {}: {} - {} - {}".format(
+                        Devices[Unit].Name, nValue, sValue, TimedOut
+                    )
                 )
-            )
+
+
+def device_values(nValue, sValue, TimedOut=0):
+    """Values of a device update, as numbers where possible, to compare updates"""
+    values = [float(nValue), float(TimedOut)]
+    for value in str(sValue).split(";"):
+        try:
+            values.append(float(value))
+        except ValueError:
+            values.append(value)
+    return values
 
 
 def UpdateDeviceOptions(Unit, Options={}):
@@ -502,328 +1875,1339 @@ def UpdateDeviceOptions(Unit, Options={}):
 
 
 ################################################################################
-# Plugin functions
+# Protocol decoders
 ################################################################################
-HUMIDITY_NORMAL = 0
-HUMIDITY_COMFORTABLE = 1
-HUMIDITY_DRY = 2
-HUMIDITY_WET = 3
-
-# Based on Mollier diagram (simplified)
-def humidity2status_indoor(hlevel, temperature):
-    if hlevel is None or temperature is None:
-        return None
-    if hlevel <= 30:
-        return HUMIDITY_DRY
-    if 35 <= hlevel <= 65 and 18 <= temperature <= 22:
-        return HUMIDITY_COMFORTABLE
-    if hlevel >= 70:
-        return HUMIDITY_WET
-    return HUMIDITY_NORMAL
+class FieldDecoder:
+    """Single-pass decoder for the "key=value&key=value" data of a station
+
+    The schema is compiled once into a lookup table, so decoding walks the
+    data only once and converts only the keys it knows. The data is decoded
+    as it is received, bytes for a body and str for a query, so the body is
+    not copied to a str first and the values of unknown keys are never
+    decoded. Every field of the schema is present in the result, None when
+    not reported or not valid, except for the CHANNEL_FIELDS, which are only
+    present when reported. Malformed data (a segment without "=", a bad
+    escape or text which is not UTF-8) is skipped and counted in malformed.
+
+    Most values of a station do not change between two packets (the rain
+    totals, the texts, slow temperatures), so the converted values are kept
+    by their "key=value" segment and such a segment is only a lookup. The
+    cache is cleared when it has CACHE segments.
+    Args:
+        schema: sequence of (wire key, field, converters, precision). The
+            converters are applied in order to the raw value, without
+            converters the value is URL-decoded text. Precision is the number
+            of decimals to round to, 0 for an int and None to keep the value
+            as it is.
+    """
+
+    CACHE = 1024
+
+    def __init__(self, schema):
+        self.fields = FIELDS
+        self.empty = dict.fromkeys(FIELDS)
+        for _, field, _, _ in schema:
+            if field not in FIELDS and field not in CHANNEL_FIELDS:
+                raise ValueError("Unknown field {}".format(field))
+        self.table = {
+            key: (field, _compile_converters(converters or (unquote,), precision))
+            for key, field, converters, precision in schema
+        }
+        # The same entries by the key as bytes, for a body
+        self.table.update(
+            {key.encode("ascii"): entry for key, entry in self.table.items()}
+        )
+        # First wire key of a field, for peek
+        self.keys = {}
+        for key, field, _, _ in schema:
+            self.keys.setdefault(field, key)
+        # Converted values by segment ("key=value"), see decode
+        self.cache = {}
+        self.malformed = 0
+
+    def decode(self, data):
+        obs = self.empty.copy()
+        table = self.table
+        if isinstance(data, str):
+            amp, eq, percent = "&", "=", "%"
+        else:
+            amp, eq, percent = b"&", b"=", b"%"
+        cache = self.cache
+        for item in data.split(amp):
+            hit = cache.get(item)
+            if hit is not None:
+                if hit[0] is not None:
+                    obs[hit[0]] = hit[1]
+                continue
+            key, sep, value = item.partition(eq)
+            entry = table.get(key)
+            if entry is None or not sep:
+                if not sep:
+                    if item:
+                        self.malformed += 1
+                elif len(cache) < self.CACHE:
+                    # Unknown key, skipped
+                    cache[item] = (None, None)
+                continue
+            try:
+                converted = entry[1](value)
+            except MalformedData:
+                self.malformed += 1
+                continue
+            except (TypeError, ValueError, OverflowError):
+                # Numbers are converted as they are, escaped ones are rare
+                if percent in value:
+                    try:
+                        obs[entry[0]] = entry[1](unquote(value))
+                    except MalformedData:
+                        self.malformed += 1
+                    except (TypeError, ValueError, OverflowError):
+                        pass
+                continue
+            obs[entry[0]] = converted
+            if len(cache) >= self.CACHE:
+                cache.clear()
+            cache[item] = (entry[0], converted)
+        return obs
+
+    def peek(self, data, field):
+        """Value of one field as text, without decoding all the data"""
+        key = self.keys.get(field)
+        if key is None:
+            return None
+        if not isinstance(data, str):
+            key = key.encode("ascii")
+            amp, eq = b"&", b"="
+        else:
+            amp, eq = "&", "="
+        if data.startswith(key + eq):
+            start = len(key) + 1
+        else:
+            start = data.find(amp + key + eq)
+            if start < 0:
+                return None
+            start += len(key) + 2
+        end = data.find(amp, start)
+        try:
+            return unquote(data[start:] if end < 0 else data[start:end])
+        except MalformedData:
+            self.malformed += 1
+            return None
 
+    def valid(self, obs):
+        for value in obs.values():
+            if value is not None:
+                return True
+        return False
 
-def humidity2status_outdoor(value):
-    if value is None:
-        return None
-    if value < 25:
-        return HUMIDITY_DRY
-    if 25 <= value <= 60:
-        return HUMIDITY_COMFORTABLE
-    if value > 60:
-        return HUMIDITY_WET
-    return HUMIDITY_NORMAL
 
+class MalformedData(ValueError):
+    pass
 
-def temperature_f2iso(value):
-    """Temperature conversion from Fahrenheit to ISO (Celsius)
-    Args:
-        value (float): temperature in Fahrenheit
-    Returns:
-        temperature in Celsius
-    """
-    if value is None:
-        return None
-    else:
-        return (value - 32) / 1.8
 
+# %XX escapes, in upper and lower case
+_ESCAPES = {
+    bytes((a, b)): bytes((int(bytes((a, b)), 16),))
+    for a in b"0123456789abcdefABCDEF"
+    for b in b"0123456789abcdefABCDEF"
+}
 
-def speed_mph2iso(value):
-    """Speed conversion from mp/h to ISO (m/s)
-    Args:
-        value (float): speed in mp/h
-    Returns:
-        speed in m/s
+
+def unquote(value):
+    """URL-decoded text of a value (str or bytes): "+" is a space and %XX a
+    byte of the UTF-8 text. Raises MalformedData for a bad escape or text
+    which is not UTF-8.
     """
-    if value is None:
-        return None
-    else:
-        return value * 0.44704
+    if isinstance(value, str):
+        if "%" not in value and "+" not in value:
+            return value
+        # The escapes of the time (eg. 2020-05-03%2009%3A45%3A52) are the
+        # usual ones, they are replaced without a round trip to bytes
+        value = value.replace("+", " ").replace("%20", " ").replace("%3A", ":")
+        if "%" not in value:
+            return value
+        value = value.encode("utf-8")
+    elif b"%" not in value:
+        try:
+            value = value.decode("utf-8")
+        except UnicodeDecodeError:
+            raise MalformedData("Not UTF-8") from None
+        return value.replace("+", " ") if "+" in value else value
+    if b"+" in value:
+        value = value.replace(b"+", b" ")
+    if b"%" in value:
+        parts = value.split(b"%")
+        for i in range(1, len(parts)):
+            escape = _ESCAPES.get(parts[i][:2])
+            if escape is None:
+                raise MalformedData("Bad escape %{}".format(parts[i][:2]))
+            parts[i] = escape + parts[i][2:]
+        value = b"".join(parts)
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        raise MalformedData("Not UTF-8") from None
+
 
+# Converters which are inlined into the compiled function, as an expression
+# of the value: the conversions of the units (see converters.CONVERSIONS).
+# They are only applied after float() or int(), so the value is never None.
+_INLINE_CONVERTERS = {float: "float({})", int: "int({})"}
+_INLINE_CONVERTERS.update(CONVERSIONS)
 
-def bearing2status(d):
+
+def _compile_converters(converters, precision):
+    """Compile a chain of converters, followed by the rounding, into one function
+
+    The common converters are inlined, so a number is converted without a
+    Python call. Rounding to decimals is inlined too, converters.ROUNDING as
+    in backfill.py. Invalid values raise a TypeError,
+    ValueError or OverflowError, which is handled by the decoder.
     """
-    Based on https://gist.github.com/RobertSudwarts/acf8df23a16afdb5837f
+    namespace = {}
+    expression = "value"
+    for i, converter in enumerate(converters):
+        inline = _INLINE_CONVERTERS.get(converter)
+        if inline is None:
+            name = "_{}".format(i)
+            namespace[name] = converter
+            expression = "{}({})".format(name, expression)
+        else:
+            expression = inline.format(expression)
+    if precision is None and len(converters) == 1:
+        # Nothing to compile, eg. int or unquote
+        return converters[0]
+    if precision == 0:
+        expression = "round({})".format(expression)
+    elif precision is not None:
+        expression = ROUNDING.format(expression, scale=10 ** precision)
+    return eval("lambda value: {}".format(expression), namespace)
+
+
+# Fields of the observation, the same for all protocols
+FIELDS = (
+    "temp",
+    "tempin",
+    "humidity",
+    "humidityin",
+    "dewpt",
+    "windchill",
+    "windspeedms",
+    "windgustms",
+    "winddir",
+    "solarradiation",
+    "uv",
+    "station",
+    "dateutc",
+    "softwaretype",
+    "baromrel",
+    "baromabs",
+    "rainmm",
+    "dailyrainmm",
+    "weeklyrainmm",
+    "monthlyrainmm",
+    "yearlyrainmm",
+    "lowbatt",
+    # Time of the observation (seconds since the epoch), set by the plugin
+    "time",
+)
+
+# Fields of the multi-channel sensors, which are only in the observation when
+# they are reported, so the work per packet depends on the sensors present
+CHANNEL_FIELDS = (
+    tuple("temp{}".format(n) for n in range(1, TEMP_CHANNELS + 1))
+    + tuple("humidity{}".format(n) for n in range(1, TEMP_CHANNELS + 1))
+    + tuple("soilmoisture{}".format(n) for n in range(1, SOIL_CHANNELS + 1))
+    + tuple("pm25_{}".format(n) for n in range(1, PM25_CHANNELS + 1))
+    + ("lightning", "lightningnum", "lightningtime", "wh65batt")
+)
+
+# wire key, field, converters, precision
+WUNDERGROUND_SCHEMA = (
+    ("tempf", "temp", (float, temperature_f2iso), 1),
+    ("indoortempf", "tempin", (float, temperature_f2iso), 1),
+    ("humidity", "humidity", (int,), None),
+    ("indoorhumidity", "humidityin", (int,), None),
+    ("dewptf", "dewpt", (float, temperature_f2iso), 1),
+    ("windchillf", "windchill", (float, temperature_f2iso), 1),
+    ("windspeedmph", "windspeedms", (float, speed_mph2iso), 1),
+    ("windgustmph", "windgustms", (float, speed_mph2iso), 1),
+    ("winddir", "winddir", (int,), None),
+    ("solarradiation", "solarradiation", (float,), 1),
+    ("UV", "uv", (float,), None),
+    ("ID", "station", (), None),
+    ("dateutc", "dateutc", (), None),
+    ("softwaretype", "softwaretype", (), None),
+    ("baromin", "baromrel", (float, pressure_inches2iso), 0),
+    ("absbaromin", "baromabs", (float, pressure_inches2iso), 0),
+    ("rainin", "rainmm", (float, distance_inch2mm), 2),
+    ("dailyrainin", "dailyrainmm", (float, distance_inch2mm), 2),
+    ("weeklyrainin", "weeklyrainmm", (float, distance_inch2mm), None),
+    ("monthlyrainin", "monthlyrainmm", (float, distance_inch2mm), None),
+    ("yearlyrainin", "yearlyrainmm", (float, distance_inch2mm), None),
+    ("lowbatt", "lowbatt", (float,), None),
+)
+
+ECOWITT_SCHEMA = (
+    ("tempf", "temp", (float, temperature_f2iso), 1),
+    ("tempinf", "tempin", (float, temperature_f2iso), 1),
+    ("humidity", "humidity", (int,), None),
+    ("humidityin", "humidityin", (int,), None),
+    ("dewptf", "dewpt", (float, temperature_f2iso), 1),
+    ("windchillf", "windchill", (float, temperature_f2iso), 1),
+    ("windspeedmph", "windspeedms", (float, speed_mph2iso), 1),
+    ("windgustmph", "windgustms", (float, speed_mph2iso), 1),
+    ("winddir", "winddir", (int,), None),
+    ("solarradiation", "solarradiation", (float,), 1),
+    ("uv", "uv", (float,), None),
+    ("PASSKEY", "station", (), None),
+    ("dateutc", "dateutc", (), None),
+    ("stationtype", "softwaretype", (), None),
+    ("baromrelin", "baromrel", (float, pressure_inches2iso), 0),
+    ("baromabsin", "baromabs", (float, pressure_inches2iso), 0),
+    ("rainin", "rainmm", (float, distance_inch2mm), 2),
+    ("rainratein", "rainmm", (float, distance_inch2mm), 2),
+    ("dailyrainin", "dailyrainmm", (float, distance_inch2mm), 2),
+    ("weeklyrainin", "weeklyrainmm", (float, distance_inch2mm), None),
+    ("monthlyrainin", "monthlyrainmm", (float, distance_inch2mm), None),
+    ("yearlyrainin", "yearlyrainmm", (float, distance_inch2mm), None),
+    ("lowbatt", "lowbatt", (float,), None),
+)
+ECOWITT_SCHEMA += tuple(
+    ("temp{}f".format(n), "temp{}".format(n), (float, temperature_f2iso), 1)
+    for n in range(1, TEMP_CHANNELS + 1)
+)
+ECOWITT_SCHEMA += tuple(
+    ("humidity{}".format(n), "humidity{}".format(n), (int,), None)
+    for n in range(1, TEMP_CHANNELS + 1)
+)
+ECOWITT_SCHEMA += tuple(
+    ("soilmoisture{}".format(n), "soilmoisture{}".format(n), (int,), None)
+    for n in range(1, SOIL_CHANNELS + 1)
+)
+ECOWITT_SCHEMA += tuple(
+    ("pm25_ch{}".format(n), "pm25_{}".format(n), (float,), 1)
+    for n in range(1, PM25_CHANNELS + 1)
+)
+ECOWITT_SCHEMA += (
+    ("lightning", "lightning", (float,), 1),
+    ("lightning_num", "lightningnum", (int,), None),
+    ("lightning_time", "lightningtime", (int,), None),
+    ("wh65batt", "wh65batt", (int,), None),
+)
+
+AMBIENT_SCHEMA = (
+    ("tempf", "temp", (float, temperature_f2iso), 1),
+    ("tempinf", "tempin", (float, temperature_f2iso), 1),
+    ("humidity", "humidity", (int,), None),
+    ("humidityin", "humidityin", (int,), None),
+    ("dewptf", "dewpt", (float, temperature_f2iso), 1),
+    ("windspeedmph", "windspeedms", (float, speed_mph2iso), 1),
+    ("windgustmph", "windgustms", (float, speed_mph2iso), 1),
+    ("winddir", "winddir", (int,), None),
+    ("solarradiation", "solarradiation", (float,), 1),
+    ("uv", "uv", (float,), None),
+    ("PASSKEY", "station", (), None),
+    ("dateutc", "dateutc", (), None),
+    ("stationtype", "softwaretype", (), None),
+    ("baromrelin", "baromrel", (float, pressure_inches2iso), 0),
+    ("baromabsin", "baromabs", (float, pressure_inches2iso), 0),
+    ("hourlyrainin", "rainmm", (float, distance_inch2mm), 2),
+    ("dailyrainin", "dailyrainmm", (float, distance_inch2mm), 2),
+    ("weeklyrainin", "weeklyrainmm", (float, distance_inch2mm), None),
+    ("monthlyrainin", "monthlyrainmm", (float, distance_inch2mm), None),
+    ("yearlyrainin", "yearlyrainmm", (float, distance_inch2mm), None),
+)
+
+# Weathercloud sends most values in tenths of the metric units
+WEATHERCLOUD_SCHEMA = (
+    ("temp", "temp", (float, tenths), 1),
+    ("tempin", "tempin", (float, tenths), 1),
+    ("hum", "humidity", (int,), None),
+    ("humin", "humidityin", (int,), None),
+    ("dew", "dewpt", (float, tenths), 1),
+    ("chill", "windchill", (float, tenths), 1),
+    ("wspd", "windspeedms", (float, tenths), 1),
+    ("wspdhi", "windgustms", (float, tenths), 1),
+    ("wdir", "winddir", (int,), None),
+    ("solarrad", "solarradiation", (float, tenths), 1),
+    ("uvi", "uv", (float, tenths), None),
+    ("wid", "station", (), None),
+    ("ver", "softwaretype", (), None),
+    ("bar", "baromrel", (float, tenths), 0),
+    ("rainrate", "rainmm", (float, tenths), 2),
+    ("rain", "dailyrainmm", (float, tenths), 2),
+)
+
+# Where the data of the request is
+FROM_QUERY = 0
+FROM_BODY = 1
+# Path segments /key/value/..., or the query when there is one
+FROM_PATH = 2
+
+# verb, path, protocol, schema, data. The paths are the defaults of the
+# station software, in lower case and without a trailing /.
+ROUTES = (
+    (
+        "GET",
+        "/weatherstation/updateweatherstation.php",
+        "Wunderground",
+        WUNDERGROUND_SCHEMA,
+        FROM_QUERY,
+    ),
+    ("POST", "/data/report", "Ecowitt", ECOWITT_SCHEMA, FROM_BODY),
+    ("GET", "/endpoint", "Ambient Weather", AMBIENT_SCHEMA, FROM_QUERY),
+    ("GET", "/v01/set", "Weathercloud", WEATHERCLOUD_SCHEMA, FROM_PATH),
+)
+PATH_ROUTES = tuple(path for _, path, _, _, data in ROUTES if data == FROM_PATH)
+
+
+def route_path(path):
+    """Path of the request as in ROUTES"""
+    path = path.rstrip("/").lower() or "/"
+    for prefix in PATH_ROUTES:
+        if path.startswith(prefix + "/"):
+            return prefix
+    return path
+
+
+def path2query(path, prefix):
+    """Path segments /prefix/key/value/key/value as key=value&key=value"""
+    segments = path[len(prefix) + 1 :].strip("/").split("/")
+    return "&".join(
+        "{}={}".format(key, value) for key, value in zip(segments[::2], segments[1::2])
+    )
+
+
+################################################################################
+# Spike filter
+################################################################################
+class RollingMedian:
+    """Median of the last size values
+
+    The values are also kept in order, so adding a value and the median are
+    a bisection instead of a sort. The median absolute deviation (MAD) is
+    only needed for the values which are not close to the median, so it is
+    calculated when asked for.
     """
-    dirs = [
-        "N",
-        "NNE",
-        "NE",
-        "ENE",
-        "E",
-        "ESE",
-        "SE",
-        "SSE",
-        "S",
-        "SSW",
-        "SW",
-        "WSW",
-        "W",
-        "WNW",
-        "NW",
-        "NNW",
-    ]
-    count = len(dirs)  # Number of entries in list
-    step = 360 / count  # Wind direction is in steps of 22.5 degrees (360/16)
-    ix = int((d + (step / 2)) / step)  # Calculate index in the list
-    return dirs[ix % count]
-
-
-BARO_FORECAST_NOINFO = 0
-BARO_FORECAST_SUNNY = 1
-BARO_FORECAST_PARTLYCLOUDY = 2
-BARO_FORECAST_CLOUDY = 3
-BARO_FORECAST_RAIN = 4
-BARO_FORECAST_UNKNOWN = 5
-BARO_FORECASTS = {
-    BARO_FORECAST_NOINFO,
-    BARO_FORECAST_SUNNY,
-    BARO_FORECAST_PARTLYCLOUDY,
-    BARO_FORECAST_CLOUDY,
-    BARO_FORECAST_RAIN,
+
+    __slots__ = ("size", "values", "ordered")
+
+    def __init__(self, size):
+        self.size = size
+        self.values = deque()
+        self.ordered = []
+
+    def add(self, value):
+        if len(self.values) == self.size:
+            del self.ordered[bisect_left(self.ordered, self.values.popleft())]
+        self.values.append(value)
+        insort(self.ordered, value)
+
+    def median(self):
+        ordered = self.ordered
+        middle = len(ordered) // 2
+        if len(ordered) % 2:
+            return ordered[middle]
+        return (ordered[middle - 1] + ordered[middle]) / 2
+
+    def mad(self, median):
+        deviations = sorted(abs(value - median) for value in self.ordered)
+        middle = len(deviations) // 2
+        if len(deviations) % 2:
+            return deviations[middle]
+        return (deviations[middle - 1] + deviations[middle]) / 2
+
+
+# field: minimum, maximum, threshold (in MADs), minimum deviation. A value
+# outside the range is always rejected, a value further from the median of
+# the last values than the threshold (and than the minimum deviation) is a
+# spike. Fields without a threshold are only checked against the range,
+# eg. wind and solar radiation, which change fast by nature.
+SPIKE_LIMITS = {
+    "temp": (-60, 60, 6, 2.0),
+    "tempin": (-20, 50, 6, 2.0),
+    "dewpt": (-60, 40, 6, 2.0),
+    "windchill": (-80, 60, None, None),
+    "humidity": (0, 100, 6, 10),
+    "humidityin": (0, 100, 6, 10),
+    "baromrel": (870, 1090, 6, 3),
+    "baromabs": (500, 1090, 6, 3),
+    "windspeedms": (0, 75, None, None),
+    "windgustms": (0, 110, None, None),
+    "winddir": (0, 360, None, None),
+    "solarradiation": (0, 2000, None, None),
+    "uv": (0, 20, None, None),
+    "rainmm": (0, 500, None, None),
+    "dailyrainmm": (0, 2000, None, None),
 }
+SPIKE_LIMITS.update(
+    ("temp{}".format(n), (-60, 60, 6, 2.0)) for n in range(1, TEMP_CHANNELS + 1)
+)
+SPIKE_LIMITS.update(
+    ("humidity{}".format(n), (0, 100, 6, 10)) for n in range(1, TEMP_CHANNELS + 1)
+)
+
+
+class SpikeFilter:
+    """Rejects the values of a station which are out of range, or which are
+    spikes compared to the median of the last SIZE values (a Hampel filter).
+    A rejected value is replaced by the last good value. The spikes are kept
+    in the window, so after a real jump the median follows within SIZE / 2
+    packets.
+    """
 
+    SIZE = 15
+    # Values needed before the median is used
+    MIN_VALUES = 5
+    # MAD of a normal distribution, relative to the standard deviation
+    MAD_SCALE = 1.4826
 
-def pressure2status(value):
-    if value is None:
-        return None
-    if value < 1000:
-        return BARO_FORECAST_RAIN
-    elif value < 1020:
-        return BARO_FORECAST_CLOUDY
-    elif value < 1030:
-        return BARO_FORECAST_PARTLYCLOUDY
-    else:
-        return BARO_FORECAST_SUNNY
-
-
-def uv2status(value):
-    if value is None:
-        return None
-    if value < 3:
-        return 0
-    elif value < 6:
-        return 1
-    elif value < 8:
-        return 2
-    elif value < 11:
-        return 3
-    else:
-        return 4
-
-
-def pressure_inches2iso(value):
-    """Pressure conversion from inches Hg to ISO (hPa)
-    Args:
-        value (float): pressure in inches Hg
-    Returns:
-        pressure in hPa
+    def __init__(self):
+        self.windows = {}
+        self.last = {}
+        self.rejected = {}
+
+    def apply(self, obs):
+        """Replace the rejected values of the observation"""
+        get = obs.get
+        for field, limits in SPIKE_LIMITS.items():
+            value = get(field)
+            if value is None:
+                continue
+            low, high, threshold, floor = limits
+            if low <= value <= high:
+                if threshold is None:
+                    self.last[field] = value
+                    continue
+                window = self.windows.get(field)
+                if window is None:
+                    window = self.windows[field] = RollingMedian(self.SIZE)
+                spike = False
+                if len(window.values) >= self.MIN_VALUES:
+                    median = window.median()
+                    deviation = abs(value - median)
+                    spike = deviation > floor and deviation > (
+                        threshold * self.MAD_SCALE * window.mad(median)
+                    )
+                window.add(value)
+                if not spike:
+                    self.last[field] = value
+                    continue
+            last = self.last.get(field)
+            Debug("Value of {} rejected: {}, last good {}", field, value, last)
+            obs[field] = last
+            self.rejected[field] = self.rejected.get(field, 0) + 1
+
+    def state(self):
+        """State for the checkpoint, the windows with the oldest value first"""
+        return {
+            "windows": {
+                field: list(window.values) for field, window in self.windows.items()
+            },
+            "last": self.last,
+        }
+
+    def restore(self, state):
+        self.windows = {}
+        for field, values in (state.get("windows") or {}).items():
+            window = self.windows[field] = RollingMedian(self.SIZE)
+            for value in values[-self.SIZE :]:
+                window.add(value)
+        self.last = dict(state.get("last") or {})
+
+
+################################################################################
+# Daily statistics
+################################################################################
+class DailyStats:
+    """Statistics of a station for the current (local) day
+
+    Updated for every packet with constant memory, so no history has to be
+    scanned. The hours of rain and sunshine are the time between packets
+    while it rained (rain rate > 0) or the sun shone (solar radiation of at
+    least SUNSHINE, the WMO threshold). Gaps of more than MAX_INTERVAL are
+    not counted.
     """
-    if value is None:
-        return None
-    else:
-        return value * 33.86
 
+    SUNSHINE = 120
+    MAX_INTERVAL = 600
+
+    def __init__(self, now):
+        self.reset(now)
+
+    def reset(self, now):
+        self.day = time.strftime("%Y-%m-%d", time.localtime(now))
+        self.end = next_midnight(now)
+        self.tempmin = None
+        self.tempmax = None
+        self.tempsum = 0.0
+        self.tempcount = 0
+        self.gustmax = None
+        self.rain = 0.0
+        self.sunshine = 0.0
+        self.raining = False
+        self.sunny = False
+        self.last = None
+
+    def add(self, obs, now):
+        temp = obs["temp"]
+        if temp is not None:
+            if self.tempmin is None or temp < self.tempmin:
+                self.tempmin = temp
+            if self.tempmax is None or temp > self.tempmax:
+                self.tempmax = temp
+            self.tempsum += temp
+            self.tempcount += 1
+        gust = obs["windgustms"]
+        if gust is not None and (self.gustmax is None or gust > self.gustmax):
+            self.gustmax = gust
+        # The time since the last packet counts for the weather of that packet
+        if self.last is not None and 0 < now - self.last <= self.MAX_INTERVAL:
+            if self.raining:
+                self.rain += now - self.last
+            if self.sunny:
+                self.sunshine += now - self.last
+        rainmm = obs["rainmm"]
+        solarradiation = obs["solarradiation"]
+        self.raining = rainmm is not None and rainmm > 0
+        self.sunny = solarradiation is not None and solarradiation >= self.SUNSHINE
+        self.last = now
+
+    def tempmean(self):
+        return self.tempsum / self.tempcount if self.tempcount else None
+
+    def state(self):
+        return {
+            "day": self.day,
+            "tempmin": self.tempmin,
+            "tempmax": self.tempmax,
+            "tempsum": self.tempsum,
+            "tempcount": self.tempcount,
+            "gustmax": self.gustmax,
+            "rain": self.rain,
+            "sunshine": self.sunshine,
+        }
+
+    def restore(self, state):
+        """Statistics before a restart, when they are of the same day"""
+        if state.get("day") != self.day:
+            return
+        self.tempmin = state.get("tempmin")
+        self.tempmax = state.get("tempmax")
+        self.tempsum = state.get("tempsum") or 0.0
+        self.tempcount = state.get("tempcount") or 0
+        self.gustmax = state.get("gustmax")
+        self.rain = state.get("rain") or 0.0
+        self.sunshine = state.get("sunshine") or 0.0
+
+
+def next_midnight(now):
+    """Time of the next local midnight, also on the days of a DST change"""
+    t = time.localtime(now)
+    return time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, 0, 0, 0, 0, 0, -1))
 
-def distance_inch2iso(value):
-    """Distance conversion from inches to ISO (cm)
-    Args:
-        value (float): Distance in inches
-    Returns:
-        Distance in cm
+
+################################################################################
+# Aggregation
+################################################################################
+class Mean:
+    __slots__ = ("total", "count")
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value, obs):
+        self.total += value
+        self.count += 1
+
+    def result(self):
+        return self.total / self.count if self.count else None
+
+
+class Maximum:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, value, obs):
+        if self.value is None or value > self.value:
+            self.value = value
+
+    def result(self):
+        return self.value
+
+
+class Last:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, value, obs):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+class WindVector:
+    """Mean wind direction, of the vectors weighted by the wind speed, in
+    whole degrees 0..359
+
+    When there was no wind at all, the mean of the directions is used.
     """
-    if value is None:
-        return None
-    else:
-        return value * 2.54
 
+    __slots__ = ("x", "y", "ux", "uy")
 
-def dew_point(t, h):
-    """Calculate dewpoint
-    Args:
-        t (float): temperature in °C
-        h (float): relative humidity in %
-    Returns:
-        calculated dewpoint in °C
-    Ref:
-        https://www.ajdesigner.com/phphumidity/dewpoint_equation_dewpoint_temperature.php
+    def __init__(self):
+        self.x = self.y = self.ux = self.uy = 0.0
+
+    def add(self, value, obs):
+        radians = math.radians(value)
+        speed = obs.get("windspeedms") or 0
+        self.x += speed * math.sin(radians)
+        self.y += speed * math.cos(radians)
+        self.ux += math.sin(radians)
+        self.uy += math.cos(radians)
+
+    def result(self):
+        x, y = (self.x, self.y) if self.x or self.y else (self.ux, self.uy)
+        if not x and not y:
+            return None
+        # Rounded before the modulo, so 359.6 is 0 and not 360
+        return round(math.degrees(math.atan2(x, y))) % 360
+
+
+# field: accumulator, precision. Fields which are not listed keep the last value
+AGGREGATES = {
+    "temp": (Mean, 1),
+    "tempin": (Mean, 1),
+    "dewpt": (Mean, 1),
+    "windchill": (Mean, 1),
+    "humidity": (Mean, 0),
+    "humidityin": (Mean, 0),
+    "baromrel": (Mean, 0),
+    "baromabs": (Mean, 0),
+    "windspeedms": (Mean, 1),
+    "windgustms": (Maximum, None),
+    "winddir": (WindVector, None),
+    "solarradiation": (Mean, 1),
+    "uv": (Maximum, None),
+    "rainmm": (Maximum, None),
+}
+AGGREGATES.update(
+    ("temp{}".format(n), (Mean, 1)) for n in range(1, TEMP_CHANNELS + 1)
+)
+AGGREGATES.update(
+    ("humidity{}".format(n), (Mean, 0)) for n in range(1, TEMP_CHANNELS + 1)
+)
+AGGREGATES.update(
+    ("soilmoisture{}".format(n), (Mean, 0)) for n in range(1, SOIL_CHANNELS + 1)
+)
+AGGREGATES.update(
+    ("pm25_{}".format(n), (Mean, 1)) for n in range(1, PM25_CHANNELS + 1)
+)
+
+
+class Window:
+    """Observations of a station during an aggregation window
+
+    Every field has one accumulator, so the memory does not depend on the
+    number of observations in the window.
     """
-    return round((h / 100) ** (1 / 8) * (112 + 0.9 * t) + 0.1 * t - 112, 2)
 
+    def __init__(self):
+        self.count = 0
+        self.accumulators = {}
+
+    def add(self, obs):
+        accumulators = self.accumulators
+        for field, value in obs.items():
+            accumulator = accumulators.get(field)
+            if accumulator is None:
+                accumulator = accumulators[field] = AGGREGATES.get(field, (Last,))[0]()
+            if value is not None:
+                accumulator.add(value, obs)
+        self.count += 1
+
+    def flush(self):
+        """Aggregated observation of the window, which is started again"""
+        obs = {}
+        for field, accumulator in self.accumulators.items():
+            value = accumulator.result()
+            precision = AGGREGATES.get(field, (Last, None))[1]
+            if value is not None and precision is not None:
+                value = round(value, precision) if precision else round(value)
+            obs[field] = value
+        self.count = 0
+        self.accumulators = {}
+        return obs
 
-def wind_chill(t, v):
-    """ Windchill temperature is defined only for temperatures at or below 10 °C 
-    and wind speeds above 4.8 kilometres per hour.
-    Args:
-        t: temperature in °C
-        v: wind speed in m/s
-    Returns:
-        calculated windchill temperature in °C
-    Ref: 
-        https://en.wikipedia.org/wiki/Wind_chill
+
+################################################################################
+# Pressure history
+################################################################################
+class PressureHistory:
+    """Pressure samples of the last 3 hours, for the pressure tendency
+
+    The samples are kept in a fixed size ring buffer, one sample per STEP
+    seconds, so the memory does not depend on the push rate of the station.
     """
-    # Calculation expects km/h instead of m/s, so
-    v = v * 3.6
-    if t < 10 and v > 4.8:
-        v = v ** 0.16
-        return round(13.12 + 0.6215 * t - 11.37 * v + 0.3965 * t * v, 1)
-    else:
-        return t
 
+    STEP = 600
+    PERIOD = 3 * 3600
+    SIZE = PERIOD // STEP + 1
 
-WIND_SPEED_MS = 0
-WIND_SPEED_KMH = 1
-WIND_SPEED_MPH = 2
-WIND_SPEED_KNOTS = 3
-WIND_SPEED_BEAUFORT = 4
-WIND_SPEED_ISO = WIND_SPEED_MS
-WIND_SPEEDS = {
-    WIND_SPEED_MS,
-    WIND_SPEED_KMH,
-    WIND_SPEED_MPH,
-    WIND_SPEED_KNOTS,
-    WIND_SPEED_BEAUFORT,
-}
+    def __init__(self):
+        self.times = array("d", [0.0]) * self.SIZE
+        self.values = array("d", [0.0]) * self.SIZE
+        self.count = 0
+        self.head = 0  # Next sample
+
+    def newest(self):
+        return (self.head - 1) % self.SIZE
+
+    def oldest(self):
+        return self.head if self.count == self.SIZE else 0
+
+    def add(self, t, value):
+        if self.count:
+            age = t - self.times[self.newest()]
+            if age < self.STEP:
+                return
+            if age > self.PERIOD:
+                # The history is too old after a gap
+                self.count = self.head = 0
+        self.times[self.head] = t
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.SIZE
+        self.count = min(self.count + 1, self.SIZE)
+
+    def state(self):
+        """State for the checkpoint, oldest sample first"""
+        indices = [(self.oldest() + i) % self.SIZE for i in range(self.count)]
+        return {
+            "times": [self.times[i] for i in indices],
+            "values": [self.values[i] for i in indices],
+        }
+
+    def restore(self, state):
+        self.count = self.head = 0
+        for t, value in zip(state.get("times", []), state.get("values", [])):
+            self.add(t, value)
+
+    def tendency(self, t, value):
+        """Change of the pressure in hPa per 3 hours, None without at least an
+        hour of history
+        """
+        if not self.count:
+            return None
+        oldest = self.oldest()
+        span = t - self.times[oldest]
+        if span < 3600 or t - self.times[self.newest()] > self.PERIOD:
+            return None
+        return (value - self.values[oldest]) * self.PERIOD / span
 
 
-def speed2unit(speed, unit):
-    """Convert the windspeed (in m/s) to the given unit
-    Args:
-        speed: windspeed in m/s
-        unit: the new unit for windspeed
-    Returns:
-        calculated windspeed for the given unit
+################################################################################
+# Rain rate
+################################################################################
+class RainRate:
+    """Rain rate from the increase of the rain total during the last PERIOD
+    seconds, by the clock of the station. The station only reports the rain
+    in steps of a tip of the bucket (0.1 to 0.3 mm), so a rate from a single
+    interval would jump between 0 and tens of mm/h.
     """
-    if unit in WIND_SPEEDS:
-        if unit == WIND_SPEED_ISO:
-            return speed
-        elif unit == WIND_SPEED_KMH:
-            return round(speed * 3.60000000, 1)
-        elif unit == WIND_SPEED_MPH:
-            return round(speed * 2.23693629, 1)
-        elif unit == WIND_SPEED_KNOTS:
-            return round(speed * 1.94384449, 1)
-        elif unit == WIND_SPEED_BEAUFORT:
-            if 0 <= speed < 0.3:
-                return 0
-            elif 0.3 <= speed < 1.6:
-                return 1
-            elif 1.6 <= speed < 3.4:
-                return 2
-            elif 3.4 <= speed < 5.5:
-                return 3
-            elif 5.5 <= speed < 8.0:
-                return 4
-            elif 8.0 <= speed < 10.8:
-                return 5
-            elif 10.8 <= speed < 13.9:
-                return 6
-            elif 13.9 <= speed < 17.2:
-                return 7
-            elif 17.2 <= speed < 20.8:
-                return 8
-            elif 20.8 <= speed < 24.5:
-                return 9
-            elif 24.5 <= speed < 28.5:
-                return 10
-            elif 28.5 <= speed < 32.7:
-                return 11
-            elif 32.7 <= speed:
-                return 12
-        else:
+
+    PERIOD = 900
+    # Seconds of history needed for a rate
+    MIN_SPAN = 60
+    SIZE = 64
+
+    def __init__(self):
+        self.samples = deque(maxlen=self.SIZE)
+
+    def rate(self, t, total):
+        """Rain rate in mm/h, after adding the total (mm) at time t. None
+        without enough history.
+        """
+        samples = self.samples
+        while samples and t - samples[0][0] > self.PERIOD:
+            samples.popleft()
+        if samples and (total < samples[-1][1] or t < samples[-1][0]):
+            samples.clear()
+        samples.append((t, total))
+        start, first = samples[0]
+        if t - start < self.MIN_SPAN:
             return None
-    else:
-        return None
+        return round((total - first) * 3600 / (t - start), 2)
 
+    def state(self):
+        """State for the checkpoint, the samples as (time, total)"""
+        return {"samples": list(self.samples)}
 
-def speed2options(unit):
-    if unit in WIND_SPEEDS:
-        if unit == WIND_SPEED_ISO:
-            return {"Custom": "0;m/s"}
-        elif unit == WIND_SPEED_KMH:
-            return {"Custom": "0;km/h"}
-        elif unit == WIND_SPEED_MPH:
-            return {"Custom": "0;mph"}
-        elif unit == WIND_SPEED_KNOTS:
-            return {"Custom": "0;kn"}
-        elif unit == WIND_SPEED_BEAUFORT:
-            return {"Custom": "0;bf"}
-        else:
-            return {}
-    else:
-        return {}
+    def restore(self, state):
+        self.samples.clear()
+        self.samples.extend(tuple(sample) for sample in state.get("samples", []))
 
 
-def heat_index(temp, humidity):
-    """Calculate heat index (in C)
-    Formula can be found at https://en.wikipedia.org/wiki/Heat_index
+################################################################################
+# Link health
+################################################################################
+class LinkHealth:
+    """Health of the link with a station, from the arrival times of its
+    packets. The intervals between the packets are counted in fixed buckets.
+    An interval of about n times the expected interval means n - 1 packets
+    were lost, and the jitter is the mean deviation from that multiple (a
+    moving average, as in RFC 3550).
     Args:
-        temp    : temperature in C
-        humidity: in %
-    Returns:
-        calculated heat index
+        interval: expected seconds between the packets, None to take the
+            median of the recent intervals
     """
-    Domoticz.Debug("temp:     {}".format(temp))
-    Domoticz.Debug("humidity: {}".format(humidity))
-    
-    if 0 <= humidity <= 100 and temp >= 26:
-        c1 = -8.78469475556
-        c2 = 1.61139411
-        c3 = 2.33854883889
-        c4 = -0.14611605
-        c5 = -0.012308094
-        c6 = -0.0164248277778
-        c7 = 0.002211732
-        c8 = 0.00072546
-        c9 = -0.000003582
-
-        tempp = temp ** 2
-        humidityp = humidity ** 2
-
-        hi = (
-            c1
-            + c2 * temp
-            + c3 * humidity
-            + c4 * temp * humidity
-            + c5 * tempp
-            + c6 * humidityp
-            + c7 * tempp * humidity
-            + c8 * temp * humidityp
-            + c9 * tempp * humidityp
+
+    BOUNDS = (5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600)
+    # Intervals of the median, and the minimum to estimate the interval
+    SIZE = 15
+    MIN_INTERVALS = 5
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.sum = 0
+        self.received = 0
+        self.lost = 0
+        self.jitter = 0.0
+        self.intervals = RollingMedian(self.SIZE)
+        # Arrival of the last packet, and since when the link is watched
+        self.last = None
+        self.heard = time.monotonic()
+        # Whether the devices are marked as timed out, None when not known
+        # (eg. after a restart)
+        self.timedOut = None
+        self.silence = 0
+
+    def add(self, now):
+        """Count a packet which arrived at now (monotonic seconds)"""
+        self.received += 1
+        self.silence = now - self.heard
+        self.heard = now
+        last = self.last
+        self.last = now
+        if last is None:
+            return
+        interval = now - last
+        self.counts[bisect_left(self.BOUNDS, interval)] += 1
+        self.sum += interval
+        self.intervals.add(interval)
+        expected = self.expected()
+        if expected:
+            packets = max(1, round(interval / expected))
+            self.lost += packets - 1
+            self.jitter += (abs(interval - packets * expected) - self.jitter) / 16
+
+    def expected(self):
+        """Expected seconds between the packets, None when not known yet"""
+        if self.interval:
+            return self.interval
+        if len(self.intervals.values) < self.MIN_INTERVALS:
+            return None
+        return self.intervals.median()
+
+    def loss(self):
+        """Fraction of the packets which were lost"""
+        if not self.lost:
+            return 0.0
+        return self.lost / (self.lost + self.received)
+
+    def summary(self):
+        """Text for the link device"""
+        expected = self.expected()
+        if expected is None:
+            return "Paketů {}".format(self.received)
+        return (
+            "Interval {:.0f} s, jitter {:.1f} s, ztráty {:.1f} %, "
+            "paketů {}".format(expected, self.jitter, self.loss() * 100, self.received)
         )
-    else:
-        hi = temp
-    return round(hi, 1)
 
 
-def float_or_none(value):
-    try:
-        return float(value)
-    except:
-        return None
+################################################################################
+# Checkpoint
+################################################################################
+class Checkpoint:
+    """State of the plugin in a file, to continue after a restart
 
+    The file is replaced atomically, so a crash leaves either the old or the
+    new state. Saving is batched: when there are changes, at most once per
+    INTERVAL seconds, or at the next heartbeat for urgent changes like a
+    reset of the rain counter.
+    """
 
-def int_or_none(value):
-    try:
-        return int(value)
-    except:
+    INTERVAL = 300
+
+    def __init__(self, path):
+        self.path = path
+        self.dirty = False
+        self.urgent = False
+        self.saved = time.monotonic()
+
+    def due(self, now):
+        return self.dirty and (self.urgent or now - self.saved >= self.INTERVAL)
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            Domoticz.Error("Checkpoint {} not loaded: {}".format(self.path, e))
+            return {}
+
+    def save(self, state):
+        self.dirty = self.urgent = False
+        self.saved = time.monotonic()
+        temp = self.path + ".tmp"
+        try:
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump(state, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path)
+        except OSError as e:
+            Domoticz.Error("Checkpoint {} not saved: {}".format(self.path, e))
+
+
+################################################################################
+# Timing
+################################################################################
+class Histogram:
+    """Counts of durations in fixed buckets, 4 per doubling from 1 µs to about
+    1 s, so a percentile is known within 19%.
+    """
+
+    BOUNDS = tuple(int(1000 * 2 ** (i / 4)) for i in range(80))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+
+    def add(self, ns):
+        self.counts[bisect_right(self.BOUNDS, ns)] += 1
+        self.count += 1
+
+    def percentile(self, p):
+        """Upper bound of the bucket of the p-th percentile, in ns"""
+        rank = max(1, math.ceil(self.count * p / 100))
+        for i, count in enumerate(self.counts):
+            rank -= count
+            if rank <= 0:
+                return self.BOUNDS[min(i, len(self.BOUNDS) - 1)]
         return None
+
+
+class StageTimer:
+    """Durations of the stages of a packet, from time.perf_counter_ns. lap()
+    adds the time since the previous lap (or start) to a stage.
+    """
+
+    STAGES = ("request", "decode", "derive", "update", "total")
+
+    def __init__(self):
+        self.histograms = {}
+        self.last = 0
+        self.reset()
+
+    def reset(self):
+        self.histograms = {stage: Histogram() for stage in self.STAGES}
+
+    def start(self):
+        self.last = time.perf_counter_ns()
+        return self.last
+
+    def lap(self, stage):
+        now = time.perf_counter_ns()
+        self.histograms[stage].add(now - self.last)
+        self.last = now
+
+    def add(self, stage, ns):
+        self.histograms[stage].add(ns)
+
+    def summary(self):
+        """p50/p95/p99 in µs and count per stage, None when nothing measured"""
+        items = []
+        for stage, histogram in self.histograms.items():
+            if histogram.count:
+                items.append(
+                    "{} {}/{}/{} ({})".format(
+                        stage,
+                        *(histogram.percentile(p) // 1000 for p in (50, 95, 99)),
+                        histogram.count
+                    )
+                )
+        return ", ".join(items) or None
+
+
+################################################################################
+# Forwarding
+################################################################################
+class Forwarder:
+    """Forwards the packets to upstream servers from a worker thread, so the
+    plugin never waits for the network. The queue is bounded: when the
+    upstream servers can not keep up, the oldest packets are dropped. The
+    connections are kept open between packets. Domoticz must not be called
+    from the thread, so the results are only counted.
+    Args:
+        targets: urlsplit() of the upstream URLs. Wunderground packets are
+            sent as GET with the data appended to the query, Ecowitt packets
+            as POST with the data as body.
+    """
+
+    QUEUE = 500
+    TIMEOUT = 10
+    RETRIES = 3
+    # Seconds before the first retry, doubled for every next one
+    BACKOFF = 2
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.connections = {}
+        self.stopping = False
+        self.forwarded = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retries = 0
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.run, name="PWS forwarder", daemon=True
+        )
+        self.thread.start()
+
+    def put(self, verb, data):
+        with self.condition:
+            if len(self.queue) >= self.QUEUE:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((verb, data))
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join(self.TIMEOUT)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    break
+                verb, data = self.queue.popleft()
+            for target in self.targets:
+                self.forward(target, verb, data)
+        for connection in self.connections.values():
+            connection.close()
+
+    def forward(self, target, verb, data):
+        """Send a packet to a target, with retries for network and server
+        errors. Other errors (4xx) are not retried.
+        """
+        for attempt in range(self.RETRIES + 1):
+            if attempt:
+                self.retries += 1
+                with self.condition:
+                    delay = self.BACKOFF * 2 ** (attempt - 1)
+                    if self.condition.wait_for(lambda: self.stopping, delay):
+                        return
+            try:
+                status = self.request(target, verb, data)
+            except (OSError, http.client.HTTPException) as e:
+                self.error = "{}: {}".format(target.netloc, str(e) or type(e).__name__)
+                continue
+            if status < 400:
+                self.forwarded += 1
+                return
+            self.error = "{}: HTTP {}".format(target.netloc, status)
+            if status < 500:
+                break
+        self.failed += 1
+
+    def request(self, target, verb, data):
+        """Status of the request. An open connection may have been closed by
+        the server meanwhile, then the request is repeated on a new one.
+        """
+        key = (target.scheme, target.netloc)
+        connection = self.connections.pop(key, None)
+        if connection is not None:
+            try:
+                return self.send(connection, key, target, verb, data)
+            except (OSError, http.client.HTTPException):
+                connection.close()
+        if target.scheme == "https":
+            connection = http.client.HTTPSConnection(
+                target.netloc, timeout=self.TIMEOUT
+            )
+        else:
+            connection = http.client.HTTPConnection(target.netloc, timeout=self.TIMEOUT)
+        try:
+            return self.send(connection, key, target, verb, data)
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+
+    def send(self, connection, key, target, verb, data):
+        path = target.path or "/"
+        if verb == "GET":
+            query = target.query + "&" + data if target.query else data
+            connection.request("GET", "{}?{}".format(path, query))
+        else:
+            connection.request(
+                "POST",
+                path,
+                body=data if isinstance(data, bytes) else data.encode("utf-8"),
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+            )
+        response = connection.getresponse()
+        response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            self.connections[key] = connection
+        return response.status
+
+
+################################################################################
+# Recording
+################################################################################
+class Recorder:
+    """Records the raw requests from a worker thread, so the plugin never
+    waits for the disk. Each request is a line of JSON, {"verb", "url", "data",
+    "address", "time"}, as in the corpus of bench.replay, appended to a gzip
+    file. A body which is not UTF-8 is kept as it is, base64-encoded in
+    "data64" instead of "data". A start (and a failure) begins a new file,
+    the file before is rotated. When the file is above its size, it is rotated: the last FILES files
+    are kept. The queue is bounded: when the disk can not keep up, the oldest
+    requests are dropped.
+    Args:
+        path: path of the current file, the rotated files are numbered.
+        size: size of a file in bytes (compressed).
+    """
+
+    QUEUE = 1000
+    FILES = 4
+    # Seconds after which the buffered lines are flushed to the file
+    FLUSH = 60
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.file = None
+        self.raw = None
+        self.recorded = 0
+        self.dropped = 0
+        self.failed = 0
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.run, name="PWS recorder", daemon=True
+        )
+        self.thread.start()
+
+    def put(self, verb, url, data, address, received):
+        with self.condition:
+            if len(self.queue) >= self.QUEUE:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((verb, url, data, address, received))
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join(10)
+
+    def run(self):
+        flushed = time.monotonic()
+        while True:
+            with self.condition:
+                if not self.queue and not self.stopping:
+                    self.condition.wait(self.FLUSH)
+                requests = list(self.queue)
+                self.queue.clear()
+                stopping = self.stopping
+            try:
+                if requests:
+                    self.write(requests)
+                now = time.monotonic()
+                if self.file is not None and (
+                    stopping or not requests or now - flushed >= self.FLUSH
+                ):
+                    self.file.flush()
+                    flushed = now
+                    if self.raw.tell() >= self.size:
+                        self.rotate()
+            except (OSError, ValueError) as e:
+                self.failed += len(requests)
+                self.error = str(e) or type(e).__name__
+                self.close()
+            if stopping:
+                break
+        self.close()
+
+    def write(self, requests):
+        if self.file is None:
+            # Always a new file: a file which was not closed, eg. after a
+            # crash of Domoticz, ends in a gzip member without its end, and
+            # nothing appended after it could be read
+            if os.path.exists(self.path):
+                self.rotate()
+            self.raw = open(self.path, "wb")
+            self.file = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        lines = []
+        for verb, url, data, address, received in requests:
+            request = {"verb": verb, "url": url, "data": data}
+            if isinstance(data, bytes):
+                try:
+                    request["data"] = data.decode("utf-8")
+                except UnicodeDecodeError:
+                    del request["data"]
+                    request["data64"] = base64.b64encode(data).decode("ascii")
+            request["address"] = address
+            request["time"] = received
+            lines.append(json.dumps(request, separators=(",", ":")))
+        lines.append("")
+        self.file.write("\n".join(lines).encode("utf-8"))
+        self.recorded += len(requests)
+
+    def name(self, index):
+        if not index:
+            return self.path
+        folder, name = os.path.split(self.path)
+        base, extension = name.split(".", 1)
+        return os.path.join(folder, "{}.{}.{}".format(base, index, extension))
+
+    def rotate(self):
+        self.close()
+        for index in range(self.FILES - 1, 0, -1):
+            if os.path.exists(self.name(index - 1)):
+                os.replace(self.name(index - 1), self.name(index))
+
+    def close(self):
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self.raw.close()
+        self.file = None
+        self.raw = None